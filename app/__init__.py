@@ -1,275 +1,209 @@
 import os
+import secrets
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
+from app.cache import Cache
+from app.instrumentation import Instrumentation
+from app.writebehind import WriteBehind
+from app.live import LiveUpdates
+from app.reference import ReferenceData
+from app.passwords import PasswordHashing
+from app.tokens import ApiTokens
+from app.analytics import Analytics
+from app.database import database_url, engine_options, configure_engine
 
 # Initialize extensions
 db = SQLAlchemy()
 login_manager = LoginManager()
 bcrypt = Bcrypt()
+cache = Cache()
+instrumentation = Instrumentation()
+write_behind = WriteBehind()
+live_updates = LiveUpdates()
+reference_data = ReferenceData()
+password_hashing = PasswordHashing()
+api_tokens = ApiTokens()
+analytics = Analytics()
 
 def create_app(config_class=None):
     app = Flask(__name__)
 
     # Configuration
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+    # Keys product trace hashes; defaults to SECRET_KEY
+    app.config['TRACE_HASH_KEY'] = os.environ.get('TRACE_HASH_KEY')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['TESTING'] = False
+    # bcrypt cost of new password hashes; each step doubles the work
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['TRACKING_BATCH_LIMIT'] = 1000
+    # Seconds the warehouse list's statistics are reused; tracking writes drop them sooner
+    app.config['WAREHOUSE_STATS_TTL'] = 10
+    app.config['SEED_TEST_DATA'] = os.environ.get('SEED_TEST_DATA', '').lower() in ('1', 'true', 'yes')
+    app.config['INSTRUMENTATION_ENABLED'] = os.environ.get('INSTRUMENTATION_ENABLED', '').lower() in ('1', 'true', 'yes')
+    app.config['TRACKING_WRITE_BEHIND'] = os.environ.get('TRACKING_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
 
     if config_class:
         app.config.from_object(config_class)
 
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
     # Initialize extensions
     db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, app.config)
     login_manager.init_app(app)
+    api_tokens.init_app(app, login_manager)
     bcrypt.init_app(app)
+    password_hashing.init_app(app)
+    cache.init_app(app)
+    instrumentation.init_app(app)
+    live_updates.init_app(app)
+    reference_data.init_app(app)
+    analytics.init_app(app)
 
     login_manager.login_view = 'auth.login'
     login_manager.login_message_category = 'info'
+    # Machine clients get a 401 rather than a redirect to the login form
+    login_manager.blueprint_login_views = {'api': None}
 
     # Register blueprints
     from app.auth.routes import auth
     from app.warehouse.routes import warehouse
     from app.product.routes import product
     from app.dashboard.routes import dashboard
+    from app.api.routes import api
+    from app.trace.routes import trace
 
     app.register_blueprint(auth)
     app.register_blueprint(warehouse)
     app.register_blueprint(product)
     app.register_blueprint(dashboard)
+    app.register_blueprint(api)
+    app.register_blueprint(trace)
+
+    from app.commands import register_commands
+    register_commands(app)
 
     # Create database tables
     with app.app_context():
         db.create_all()
-        # Initialize test data
-        init_test_data()
-
-    return app
-
-def init_test_data():
-    """Initialize test users and sample data"""
-    from app.models import User, Warehouse, Product, ProductTracking
-    from datetime import datetime, timedelta
-    import hashlib
+        # Sample data is opt-in; it costs a transaction on every start
+        if app.config['SEED_TEST_DATA']:
+            init_test_data()
 
-    # Create test users if they don't exist
-    if not User.query.filter_by(username='farmer1').first():
-        farmer = User(username='farmer1', email='farmer1@example.com',
-                     role='farmer', farm_location='Farm A')
-        farmer.set_password('password123')
-        db.session.add(farmer)
-
-    if not User.query.filter_by(username='farmer2').first():
-        farmer2 = User(username='farmer2', email='farmer2@example.com',
-                      role='farmer', farm_location='Farm B')
-        farmer2.set_password('password123')
-        db.session.add(farmer2)
-
-    if not User.query.filter_by(username='plant_manager').first():
-        plant_mgr = User(username='plant_manager', email='plant@example.com',
-                        role='plant_manager')
-        plant_mgr.set_password('password123')
-        db.session.add(plant_mgr)
-
-    if not User.query.filter_by(username='warehouse_manager').first():
-        warehouse_mgr = User(username='warehouse_manager', email='warehouse@example.com',
-                           role='warehouse_manager')
-        warehouse_mgr.set_password('password123')
-        db.session.add(warehouse_mgr)
-
-    # Create sample warehouses
-    if not Warehouse.query.filter_by(name='Main Processing Plant').first():
-        plant = Warehouse(name='Main Processing Plant', type='processing',
-                         location='Plant Location A', capacity=1000.0)
-        db.session.add(plant)
-
-    if not Warehouse.query.filter_by(name='Central Warehouse').first():
-        warehouse = Warehouse(name='Central Warehouse', type='warehouse',
-                            location='Warehouse Location B', capacity=5000.0)
-        db.session.add(warehouse)
-
-    if not Warehouse.query.filter_by(name='Regional Distribution Center').first():
-        dist_center = Warehouse(name='Regional Distribution Center', type='warehouse',
-                               location='Distribution Location C', capacity=3000.0)
-        db.session.add(dist_center)
-
-    db.session.commit()
+    # Replays orphaned journals, so the tables have to exist
+    write_behind.init_app(app)
 
-    # Create sample products with various statuses
-    farmer1 = User.query.filter_by(username='farmer1').first()
-    farmer2 = User.query.filter_by(username='farmer2').first()
-    plant = Warehouse.query.filter_by(name='Main Processing Plant').first()
-    warehouse = Warehouse.query.filter_by(name='Central Warehouse').first()
-    dist_center = Warehouse.query.filter_by(name='Regional Distribution Center').first()
-    plant_mgr = User.query.filter_by(username='plant_manager').first()
-    warehouse_mgr = User.query.filter_by(username='warehouse_manager').first()
-
-    if farmer1 and plant and warehouse:
-        # Product 1: Tomatoes - fully tracked through the system
-        tomato_hash = hashlib.sha256(f"{farmer1.id}-tomato-500.0-{datetime.utcnow()}".encode()).hexdigest()
-        if not Product.query.filter_by(unique_hash=tomato_hash).first():
-            product1 = Product(
-                farmer_id=farmer1.id,
-                product_type='tomato',
-                variety='Roma',
-                quantity=500.0,
-                quality_grade='A'
-            )
-            product1.generate_hash()
-            db.session.add(product1)
-            db.session.commit()
-
-            # Add tracking history
-            tracking1 = ProductTracking(
-                product_id=product1.id,
-                warehouse_id=plant.id,
-                status='received',
-                quantity=500.0,
-                quality_notes='Fresh tomatoes, good quality',
-                processed_by=plant_mgr.id,
-                transition_date=datetime.utcnow() - timedelta(days=5)
-            )
-            db.session.add(tracking1)
-
-            tracking2 = ProductTracking(
-                product_id=product1.id,
-                warehouse_id=plant.id,
-                status='processing',
-                quantity=480.0,
-                quality_notes='Washed and sorted',
-                processed_by=plant_mgr.id,
-                transition_date=datetime.utcnow() - timedelta(days=4)
-            )
-            db.session.add(tracking2)
-
-            tracking3 = ProductTracking(
-                product_id=product1.id,
-                warehouse_id=warehouse.id,
-                status='stored',
-                quantity=460.0,
-                quality_notes='Ready for distribution',
-                processed_by=warehouse_mgr.id,
-                transition_date=datetime.utcnow() - timedelta(days=2)
-            )
-            db.session.add(tracking3)
-
-            # Update warehouse stock
-            plant.current_stock += 480.0
-            warehouse.current_stock += 460.0
-
-        # Product 2: Potatoes - currently processing
-        if not Product.query.filter(Product.farmer_id == farmer1.id, Product.product_type == 'potato').first():
-            product2 = Product(
-                farmer_id=farmer1.id,
-                product_type='potato',
-                variety='Russet',
-                quantity=800.0,
-                quality_grade='B'
-            )
-            product2.generate_hash()
-            db.session.add(product2)
-            db.session.commit()
-
-            tracking = ProductTracking(
-                product_id=product2.id,
-                warehouse_id=plant.id,
-                status='processing',
-                quantity=800.0,
-                quality_notes='Currently being washed and graded',
-                processed_by=plant_mgr.id,
-                transition_date=datetime.utcnow() - timedelta(hours=6)
-            )
-            db.session.add(tracking)
-            plant.current_stock += 800.0
-
-        # Product 3: Lettuce - just received
-        if not Product.query.filter(Product.farmer_id == farmer1.id, Product.product_type == 'lettuce').first():
-            product3 = Product(
-                farmer_id=farmer1.id,
-                product_type='lettuce',
-                variety='Romaine',
-                quantity=200.0,
-                quality_grade='A'
-            )
-            product3.generate_hash()
-            db.session.add(product3)
-            db.session.commit()
-
-            tracking = ProductTracking(
-                product_id=product3.id,
-                warehouse_id=plant.id,
-                status='received',
-                quantity=200.0,
-                quality_notes='Fresh harvest, excellent condition',
-                processed_by=plant_mgr.id,
-                transition_date=datetime.utcnow() - timedelta(hours=2)
-            )
-            db.session.add(tracking)
-            plant.current_stock += 200.0
-
-    if farmer2 and dist_center:
-        # Product 4: Carrots - stored and ready for shipping
-        if not Product.query.filter(Product.farmer_id == farmer2.id, Product.product_type == 'carrot').first():
-            product4 = Product(
-                farmer_id=farmer2.id,
-                product_type='carrot',
-                variety='Nantes',
-                quantity=300.0,
-                quality_grade='A'
-            )
-            product4.generate_hash()
-            db.session.add(product4)
-            db.session.commit()
-
-            tracking1 = ProductTracking(
-                product_id=product4.id,
-                warehouse_id=plant.id,
-                status='received',
-                quantity=300.0,
-                quality_notes='Clean carrots, good size distribution',
-                processed_by=plant_mgr.id,
-                transition_date=datetime.utcnow() - timedelta(days=3)
-            )
-            db.session.add(tracking1)
-
-            tracking2 = ProductTracking(
-                product_id=product4.id,
-                warehouse_id=dist_center.id,
-                status='stored',
-                quantity=290.0,
-                quality_notes='Washed, trimmed, and packed',
-                processed_by=warehouse_mgr.id,
-                transition_date=datetime.utcnow() - timedelta(days=1)
-            )
-            db.session.add(tracking2)
+    return app
 
-            plant.current_stock += 300.0
-            dist_center.current_stock += 290.0
+# bcrypt hash of 'password123', computed once so seeding never pays for key stretching
+TEST_PASSWORD_HASH = '$2b$12$Ck2klrrfxURb.yyvV003duWZJQUwoz65sTQ3JAWrd8FJ5cfAZYryq'
 
-        # Product 5: Peppers - rejected due to quality
-        if not Product.query.filter(Product.farmer_id == farmer2.id, Product.product_type == 'pepper').first():
-            product5 = Product(
-                farmer_id=farmer2.id,
-                product_type='pepper',
-                variety='Bell',
-                quantity=150.0,
-                quality_grade='C'
-            )
-            product5.generate_hash()
-            db.session.add(product5)
-            db.session.commit()
+def init_test_data():
+    """Insert the sample users, warehouses and products in one transaction.
 
-            tracking = ProductTracking(
-                product_id=product5.id,
-                warehouse_id=plant.id,
-                status='rejected',
-                quantity=150.0,
-                quality_notes='Quality below standards - soft spots detected',
-                processed_by=plant_mgr.id,
-                transition_date=datetime.utcnow() - timedelta(hours=12)
-            )
-            db.session.add(tracking)
+    Does nothing if the sample users already exist. Returns True when data was added.
+    """
+    from app.models import User, Warehouse, Product, ProductTracking, trace_hash
+    from app.tracking import rebuild_product_state, rebuild_rollups, rebuild_stage_transitions
+    from datetime import datetime, timedelta
 
+    if db.session.query(User.query.filter_by(username='farmer1').exists()).scalar():
+        return False
+
+    now = datetime.utcnow()
+    users = [
+        dict(username=username, email=email, role=role, farm_location=farm_location,
+             password_hash=TEST_PASSWORD_HASH)
+        for username, email, role, farm_location in [
+            ('farmer1', 'farmer1@example.com', 'farmer', 'Farm A'),
+            ('farmer2', 'farmer2@example.com', 'farmer', 'Farm B'),
+            ('plant_manager', 'plant@example.com', 'plant_manager', None),
+            ('warehouse_manager', 'warehouse@example.com', 'warehouse_manager', None),
+        ]
+    ]
+    # Stock reflects the sample history below; capacity and stock are in kg
+    warehouses = [
+        dict(name=name, type=type, location=location, capacity=capacity, current_stock=stock)
+        for name, type, location, capacity, stock in [
+            ('Main Processing Plant', 'processing', 'Plant Location A', 5000.0, 1780.0),
+            ('Central Warehouse', 'warehouse', 'Warehouse Location B', 10000.0, 460.0),
+            ('Regional Distribution Center', 'warehouse', 'Distribution Location C', 6000.0, 290.0),
+        ]
+    ]
+
+    plant = 'Main Processing Plant'
+    # (farmer, type, variety, quantity, grade, [(warehouse, status, quantity, notes, processor, age)])
+    samples = [
+        # Tomatoes - fully tracked through the system
+        ('farmer1', 'tomato', 'Roma', 500.0, 'A', [
+            (plant, 'received', 500.0, 'Fresh tomatoes, good quality', 'plant_manager', timedelta(days=5)),
+            (plant, 'processing', 480.0, 'Washed and sorted', 'plant_manager', timedelta(days=4)),
+            ('Central Warehouse', 'stored', 460.0, 'Ready for distribution', 'warehouse_manager',
+             timedelta(days=2)),
+        ]),
+        # Potatoes - currently processing
+        ('farmer1', 'potato', 'Russet', 800.0, 'B', [
+            (plant, 'processing', 800.0, 'Currently being washed and graded', 'plant_manager',
+             timedelta(hours=6)),
+        ]),
+        # Lettuce - just received
+        ('farmer1', 'lettuce', 'Romaine', 200.0, 'A', [
+            (plant, 'received', 200.0, 'Fresh harvest, excellent condition', 'plant_manager',
+             timedelta(hours=2)),
+        ]),
+        # Carrots - stored and ready for shipping
+        ('farmer2', 'carrot', 'Nantes', 300.0, 'A', [
+            (plant, 'received', 300.0, 'Clean carrots, good size distribution', 'plant_manager',
+             timedelta(days=3)),
+            ('Regional Distribution Center', 'stored', 290.0, 'Washed, trimmed, and packed', 'warehouse_manager',
+             timedelta(days=1)),
+        ]),
+        # Peppers - rejected due to quality
+        ('farmer2', 'pepper', 'Bell', 150.0, 'C', [
+            (plant, 'rejected', 150.0, 'Quality below standards - soft spots detected', 'plant_manager',
+             timedelta(hours=12)),
+        ]),
+    ]
+
+    # Core executemany inserts, then one lookup per table for the new keys; an ORM flush
+    # would issue one INSERT per row to get each id back.
+    db.session.execute(User.__table__.insert(), users)
+    db.session.execute(Warehouse.__table__.insert(), warehouses)
+    user_ids = dict(db.session.execute(db.select(User.username, User.id).where(
+        User.username.in_([u['username'] for u in users]))).all())
+    warehouse_ids = dict(db.session.execute(db.select(Warehouse.name, Warehouse.id).where(
+        Warehouse.name.in_([w['name'] for w in warehouses]))).all())
+
+    # Trace hashes derive from ids, so rows go in under random placeholders that find the new ids
+    products = [dict(unique_hash=secrets.token_hex(32), farmer_id=user_ids[farmer], product_type=product_type,
+                     variety=variety, quantity=quantity, quality_grade=grade, created_at=now)
+                for farmer, product_type, variety, quantity, grade, history in samples]
+    db.session.execute(Product.__table__.insert(), products)
+    product_ids = dict(db.session.execute(db.select(Product.unique_hash, Product.id).where(
+        Product.unique_hash.in_([p['unique_hash'] for p in products]))).all())
+    table = Product.__table__
+    db.session.execute(db.update(table).where(table.c.id == db.bindparam('pid')),
+                       [dict(pid=product_id, unique_hash=trace_hash(product_id)) for product_id in product_ids.values()])
+
+    db.session.execute(ProductTracking.__table__.insert(), [
+        dict(product_id=product_ids[product['unique_hash']], warehouse_id=warehouse_ids[warehouse],
+             status=status, quantity=quantity, quality_notes=notes, processed_by=user_ids[processor],
+             transition_date=now - age)
+        for product, (_, _, _, _, _, history) in zip(products, samples)
+        for warehouse, status, quantity, notes, processor, age in history
+    ])
+    rebuild_product_state()
+    rebuild_rollups()
+    rebuild_stage_transitions()
     db.session.commit()
+    return True
@@ -0,0 +1,326 @@
+"""Columnar in-memory snapshot of tracking history for ad hoc aggregates.
+
+Questions like "kg shipped per product type per week" would otherwise scan the
+whole history through the ORM, one ProductTracking object per row. The snapshot
+keeps each tracking event as a row of NumPy columns: id, product id, warehouse
+id, status code, quantity and epoch seconds. Product types, farmers and
+warehouse types are dimension arrays indexed by id, so grouping by them is a
+lookup rather than a join.
+
+The first use in a process loads the whole history, archive included, in
+LOAD_CHUNK row batches. Every later query first reads the events with an id
+above the newest one loaded, an index range on the primary key, so answers are
+current and a refresh costs about as much as the new rows. On PostgreSQL an id
+is handed out at insert but only becomes visible at commit, so a transaction
+can commit after events with higher ids have been loaded. Each refresh
+therefore also lists the ids in a window of REFRESH_WINDOW ids below the
+newest, and loads any it has not seen. Products and warehouses are read after
+the events, so every one an event refers to is already committed, and the new
+rows are only published once their dimensions are in place. Each event takes
+roughly 33 bytes, about 35 MB per million events per worker process.
+"""
+import calendar
+import threading
+import numpy as np
+from app.product.forms import PRODUCT_TYPES, TRACKING_STATUSES
+from app.warehouse.forms import WAREHOUSE_TYPES
+
+STATUSES = [status for status, _ in TRACKING_STATUSES]
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+# Rows fetched per round trip while loading
+LOAD_CHUNK = 100_000
+
+# Ids below the newest loaded one that each refresh checks for late commits
+REFRESH_WINDOW = 10_000
+
+DAY = 86400
+# Weeks start on Monday; 1970-01-05 was the first Monday after the epoch
+WEEK_ORIGIN = 4 * DAY
+BUCKET_WIDTHS = {'day': DAY, 'week': 7 * DAY}
+
+ANALYTICS_DIMENSIONS = ('product_type', 'farmer', 'warehouse', 'warehouse_type', 'status')
+
+COLUMNS = (('id', np.int64), ('product_id', np.int32), ('warehouse_id', np.int32),
+           ('status', np.int8), ('quantity', np.float64), ('timestamp', np.int64))
+
+def epoch_expression(column):
+    """SQL epoch seconds of a DateTime column"""
+    from app import db
+    if db.engine.dialect.name == 'postgresql':
+        return db.cast(db.func.extract('epoch', column), db.BigInteger)
+    return db.cast(db.func.strftime('%s', column), db.Integer)
+
+def _status_code(column):
+    from app import db
+    return db.case({status: code for status, code in STATUS_CODES.items()}, value=column, else_=-1)
+
+def epoch(moment):
+    """Epoch seconds of a naive UTC datetime"""
+    return calendar.timegm(moment.timetuple())
+
+# Group keys spanning at most this many values are counted in a dense array
+# rather than sorted
+DENSE_GROUPS = 1 << 22
+
+def _group(codes, weights):
+    """(distinct codes, summed weights, counts) of int64 codes, in code order"""
+    if not len(codes):
+        return codes, np.zeros(0), np.zeros(0, dtype=np.int64)
+    low = codes.min()
+    if codes.max() - low < DENSE_GROUPS:
+        codes = codes - low
+        counts = np.bincount(codes)
+        groups = np.flatnonzero(counts)
+        return groups + low, np.bincount(codes, weights=weights)[groups], counts[groups]
+    groups, inverse = np.unique(codes, return_inverse=True)
+    inverse = inverse.ravel()
+    return groups, np.bincount(inverse, weights=weights), np.bincount(inverse)
+
+def _grow(array, length, size):
+    """array with room for at least size entries, keeping the first length"""
+    if len(array) >= size:
+        return array
+    grown = np.zeros(max(size, 2 * len(array), 1024), dtype=array.dtype)
+    grown[:length] = array[:length]
+    return grown
+
+class TrackingSnapshot:
+    """Tracking history as NumPy columns, appended to as new events are recorded"""
+
+    def __init__(self, window=REFRESH_WINDOW):
+        self._lock = threading.Lock()
+        self._columns = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS}
+        self.length = 0
+        # Rows written to the columns; readers only see the first `length`
+        self._loaded = 0
+        self.last_id = None
+        self.window = window
+        # Sorted ids loaded from the hot table within the window below last_id
+        self._recent_ids = np.zeros(0, dtype=np.int64)
+        self.last_product_id = 0
+        self.product_types = [value for value, _ in PRODUCT_TYPES]
+        self.product_type = np.full(0, -1, dtype=np.int16)
+        self.farmer = np.zeros(0, dtype=np.int32)
+        self.warehouse_types = [value for value, _ in WAREHOUSE_TYPES]
+        self.warehouse_type = np.zeros(0, dtype=np.int16)
+        self.warehouse_names = {}
+
+    def refresh(self):
+        """Load events, products and warehouses added since the last refresh; returns the new event count"""
+        with self._lock:
+            start = self._loaded
+            added = self._load_trackings()
+            self._load_products(self._columns['product_id'][start:self._loaded])
+            self._load_warehouses()
+            # Readers take their length first, so they never see rows without their dimensions
+            self.length = self._loaded
+            return added
+
+    def _load_trackings(self):
+        from app import db
+        from app.models import ProductTracking, tracking_history
+        first_load = self.last_id is None
+        if first_load:
+            # First load: the archive too, which only ever holds ids already issued
+            source = tracking_history()
+            self.last_id = 0
+            condition = source.c.id > 0
+        else:
+            source = ProductTracking.__table__
+            condition = source.c.id > self.last_id
+            late = self._late_ids(source)
+            if len(late):
+                condition = db.or_(condition, source.c.id.in_(late.tolist()))
+        query = (db.select(source.c.id, source.c.product_id, source.c.warehouse_id,
+                           _status_code(source.c.status), source.c.quantity,
+                           epoch_expression(source.c.transition_date))
+                 .where(condition).order_by(source.c.id))
+        added, loaded = 0, []
+        # Core rather than ORM execution, and a transpose into plain tuples: NumPy probing
+        # each Row for the array protocol costs more than the query itself
+        result = db.session.connection().execute(query.execution_options(yield_per=LOAD_CHUNK))
+        for rows in result.partitions():
+            values = list(zip(*rows))
+            start, end = self._loaded, self._loaded + len(rows)
+            for (name, dtype), column_values in zip(COLUMNS, values):
+                column = _grow(self._columns[name], start, end)
+                column[start:end] = np.array(column_values, dtype=dtype)
+                self._columns[name] = column
+            self._loaded = end
+            self.last_id = max(self.last_id, int(values[0][-1]))
+            loaded.append(np.array(values[0], dtype=np.int64))
+            added += len(rows)
+        recent = np.concatenate([self._recent_ids] + loaded)
+        self._recent_ids = np.unique(recent[recent > self.last_id - self.window])
+        if first_load:
+            # _late_ids compares with the hot table, so archived ids are left out. A row
+            # committed since the load is not in both and is picked up as late
+            self._recent_ids = np.intersect1d(self._recent_ids, self._window_ids(ProductTracking.__table__),
+                                              assume_unique=True)
+        return added
+
+    def _late_ids(self, source):
+        """Committed ids within the window below last_id that were not visible when it was loaded"""
+        from app import db
+        # Counting reads no rows; the ids are only listed when the window has changed
+        count, total = db.session.connection().execute(db.select(db.func.count(), db.func.sum(source.c.id))
+                                                       .where(self._in_window(source))).one()
+        if (count, total or 0) == (len(self._recent_ids), int(self._recent_ids.sum())):
+            return self._recent_ids[:0]
+        return np.setdiff1d(self._window_ids(source), self._recent_ids, assume_unique=True)
+
+    def _in_window(self, source):
+        from app import db
+        return db.and_(source.c.id > self.last_id - self.window, source.c.id <= self.last_id)
+
+    def _window_ids(self, source):
+        from app import db
+        ids = db.session.connection().execute(db.select(source.c.id).where(self._in_window(source))).scalars()
+        return np.fromiter(ids, dtype=np.int64)
+
+    def _load_products(self, product_ids):
+        """Products added since the last load, and any of product_ids committed after it"""
+        from app import db
+        from app.models import Product
+        known = product_ids[product_ids < len(self.product_type)]
+        missing = np.unique(known[self.product_type[known] < 0])
+        condition = Product.id > self.last_product_id
+        if len(missing):
+            condition = db.or_(condition, Product.id.in_(missing.tolist()))
+        rows = db.session.execute(db.select(Product.id, Product.product_type, Product.farmer_id)
+                                  .where(condition).order_by(Product.id)).all()
+        if not rows:
+            return
+        size = max(rows[-1].id + 1, len(self.product_type))
+        product_type, farmer = np.full(size, -1, dtype=np.int16), np.zeros(size, dtype=np.int32)
+        product_type[:len(self.product_type)] = self.product_type
+        farmer[:len(self.farmer)] = self.farmer
+        codes = {value: code for code, value in enumerate(self.product_types)}
+        for row in rows:
+            if row.product_type not in codes:
+                codes[row.product_type] = len(self.product_types)
+                self.product_types.append(row.product_type)
+            product_type[row.id] = codes[row.product_type]
+            farmer[row.id] = row.farmer_id
+        self.product_type, self.farmer = product_type, farmer
+        self.last_product_id = max(self.last_product_id, rows[-1].id)
+
+    def _load_warehouses(self):
+        from app import db
+        from app.models import Warehouse
+        rows = db.session.execute(db.select(Warehouse.id, Warehouse.name, Warehouse.type)).all()
+        warehouse_type = np.full(max((row.id for row in rows), default=0) + 1, -1, dtype=np.int16)
+        for row in rows:
+            if row.type not in self.warehouse_types:
+                self.warehouse_types.append(row.type)
+            warehouse_type[row.id] = self.warehouse_types.index(row.type)
+        self.warehouse_type = warehouse_type
+        self.warehouse_names = {row.id: row.name for row in rows}
+
+    def columns(self):
+        """Views of the loaded rows, consistent with each other"""
+        length = self.length
+        return {name: column[:length] for name, column in self._columns.items()}
+
+    def _mask(self, columns, status, start, end, warehouse_ids):
+        mask = np.ones(len(columns['id']), dtype=bool)
+        if status is not None:
+            mask &= columns['status'] == STATUS_CODES[status]
+        if start is not None:
+            mask &= columns['timestamp'] >= epoch(start)
+        if end is not None:
+            mask &= columns['timestamp'] < epoch(end)
+        if warehouse_ids is not None:
+            mask &= np.isin(columns['warehouse_id'], list(warehouse_ids))
+        return mask
+
+    def _keys(self, columns, dimension):
+        if dimension == 'product_type':
+            return self.product_type[columns['product_id']]
+        if dimension == 'farmer':
+            return self.farmer[columns['product_id']]
+        if dimension == 'warehouse':
+            return columns['warehouse_id']
+        if dimension == 'warehouse_type':
+            return self.warehouse_type[columns['warehouse_id']]
+        return columns['status']
+
+    def label(self, dimension, key):
+        if dimension == 'product_type':
+            return self.product_types[key]
+        if dimension == 'warehouse':
+            return self.warehouse_names.get(key)
+        if dimension == 'warehouse_type':
+            return self.warehouse_types[key]
+        if dimension == 'status':
+            return STATUSES[key]
+        return key
+
+    def aggregate(self, by, status=None, start=None, end=None, granularity=None, warehouse_ids=None):
+        """Kg and event counts per group, and per day or week bucket when granularity is given.
+
+        Covers events in [start, end) (naive UTC datetimes). Returns a list of
+        dicts with key, kg and events, plus bucket (epoch seconds of its start)
+        when bucketed, sorted by key and bucket.
+        """
+        columns = self.columns()
+        mask = self._mask(columns, status, start, end, warehouse_ids)
+        keys = self._keys(columns, by)[mask].astype(np.int64)
+        quantities = columns['quantity'][mask]
+        if not granularity:
+            groups, kg, events = _group(keys, quantities)
+            return [dict(key=int(key), kg=float(total), events=int(count))
+                    for key, total, count in zip(groups, kg, events)]
+        width = BUCKET_WIDTHS[granularity]
+        origin = WEEK_ORIGIN if granularity == 'week' else 0
+        buckets = (columns['timestamp'][mask] - origin) // width
+        # One code per (key, bucket) pair, ordered by key and then bucket
+        first, low = buckets.min(initial=0), keys.min(initial=0)
+        span = int(buckets.max(initial=0) - first + 1)
+        groups, kg, events = _group((keys - low) * span + (buckets - first), quantities)
+        return [dict(key=int(code // span + low), bucket=int((code % span + first) * width + origin),
+                     kg=float(total), events=int(count))
+                for code, total, count in zip(groups, kg, events)]
+
+    def top(self, by, n, status=None, start=None, end=None, warehouse_ids=None):
+        """The n groups with the most kg, largest first"""
+        columns = self.columns()
+        mask = self._mask(columns, status, start, end, warehouse_ids)
+        keys = self._keys(columns, by)[mask].astype(np.int64)
+        groups, kg, events = _group(keys, columns['quantity'][mask])
+        if len(groups) > n:
+            # Partial selection of the n largest, then sort only those
+            chosen = np.argpartition(-kg, n - 1)[:n]
+        else:
+            chosen = np.arange(len(groups))
+        chosen = chosen[np.lexsort((groups[chosen], -kg[chosen]))]
+        return [dict(key=int(groups[i]), kg=float(kg[i]), events=int(events[i])) for i in chosen]
+
+def label_groups(snapshot, by, groups):
+    """Add a display label to each group; farmers are looked up by id"""
+    from app import db
+    from app.models import User
+    if by == 'farmer':
+        names = dict(db.session.execute(db.select(User.id, User.username).where(
+            User.id.in_({group['key'] for group in groups}))).all())
+        for group in groups:
+            group['label'] = names.get(group['key'])
+        return groups
+    for group in groups:
+        group['label'] = snapshot.label(by, group['key'])
+    return groups
+
+def tracking_snapshot():
+    """This process's snapshot for the current app, brought up to date"""
+    from flask import current_app
+    snapshot = current_app.extensions['analytics']
+    snapshot.refresh()
+    return snapshot
+
+class Analytics:
+    """Flask extension holding each app's tracking snapshot; loaded on first use"""
+
+    def init_app(self, app):
+        app.config.setdefault('ANALYTICS_REFRESH_WINDOW', REFRESH_WINDOW)
+        app.extensions['analytics'] = TrackingSnapshot(window=app.config['ANALYTICS_REFRESH_WINDOW'])
@@ -0,0 +1,390 @@
+from datetime import datetime, timezone
+from flask import Blueprint, Response, jsonify, request, current_app, stream_with_context
+from flask_login import login_required, current_user
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import MultiDict
+from app import db, cache, write_behind
+from app.cache import farmer_tag, warehouse_type_tag
+from app.models import ApiToken, Product, Warehouse
+from app.product.forms import ProductTrackingForm
+from app.warehouse.forms import WAREHOUSE_TYPES
+from app.tracking import record_trackings, bucket_start
+from app.search import search, search_available, SEARCH_PER_PAGE, SEARCH_MAX_PAGE
+from app.export import tracking_export_query, stream_rows, iter_csv, iter_ndjson, gzip_chunks
+from app.dashboard.trends import trend_series, BUCKET_STEPS
+from app.dashboard.yields import cached_yield_report, YIELD_DIMENSIONS
+from app.changes import wait_for_changes, serialize_change
+from app.tokens import TokenUser, issue_token, revoke_token
+from app.warehouse.stats import cached_warehouse_stats
+from app.history import history_filters, history_page, serialize_history
+from app.analytics import ANALYTICS_DIMENSIONS, BUCKET_WIDTHS, STATUS_CODES, label_groups, tracking_snapshot
+
+# Default and maximum number of buckets returned per granularity
+TREND_PERIODS = {'hour': (48, 24 * 31), 'day': (30, 366)}
+
+# Default and maximum number of groups for the analytics top-N
+ANALYTICS_TOP = (10, 1000)
+
+# Default and maximum changes per page, and the longest long-poll wait in seconds
+CHANGES_LIMIT = (100, 1000)
+CHANGES_MAX_WAIT = 30
+
+EXPORT_FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+}
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+def _is_id(value):
+    # JSON true would otherwise pass as product 1
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def parse_tracking_event(item, warehouse_choices, product_ids):
+    """Validate one JSON tracking event with the same rules as ProductTrackingForm.
+
+    Returns (event, errors); event is None when the item is invalid.
+    """
+    if not isinstance(item, dict):
+        return None, {'event': ['Must be a JSON object.']}
+    formdata = MultiDict({name: str(item[name]) for name in ('warehouse_id', 'status', 'quantity', 'quality_notes')
+                          if item.get(name) is not None})
+    form = ProductTrackingForm(formdata=formdata, meta={'csrf': False})
+    form.warehouse_id.choices = warehouse_choices
+    form.validate()
+    errors = {name: messages for name, messages in form.errors.items() if name != 'submit'}
+
+    if not _is_id(item.get('product_id')) or item['product_id'] not in product_ids:
+        errors['product_id'] = ['Unknown product.']
+    key = item.get('idempotency_key')
+    if key is not None and (not isinstance(key, str) or not 0 < len(key) <= 64):
+        errors['idempotency_key'] = ['Must be a string of 1 to 64 characters.']
+    transition_date = None
+    if item.get('transition_date'):
+        try:
+            transition_date = datetime.fromisoformat(str(item['transition_date']))
+        except ValueError:
+            errors['transition_date'] = ['Must be an ISO 8601 timestamp.']
+        else:
+            if transition_date.tzinfo is not None:
+                # Stored as naive UTC, like every other timestamp
+                transition_date = transition_date.astimezone(timezone.utc).replace(tzinfo=None)
+    if errors:
+        return None, errors
+
+    return dict(
+        product_id=item['product_id'],
+        warehouse_id=form.warehouse_id.data,
+        status=form.status.data,
+        quantity=form.quantity.data,
+        quality_notes=form.quality_notes.data or None,
+        transition_date=transition_date,
+        idempotency_key=key
+    ), None
+
+@api.route('/trackings/batch', methods=['POST'])
+@login_required
+def ingest_trackings():
+    """Record a batch of tracking events from a scanner"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers cannot update product tracking.'), 403
+
+    payload = request.get_json(silent=True)
+    items = payload.get('events') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify(error='Expected a JSON object with a non-empty "events" list.'), 400
+    if len(items) > current_app.config['TRACKING_BATCH_LIMIT']:
+        return jsonify(error=f"At most {current_app.config['TRACKING_BATCH_LIMIT']} events per batch."), 413
+
+    warehouses = Warehouse.query.with_entities(Warehouse.id, Warehouse.name, Warehouse.type).all()
+    warehouse_choices = [(w.id, w.name) for w in warehouses]
+    requested = {item.get('product_id') for item in items if isinstance(item, dict) and _is_id(item.get('product_id'))}
+    farmers = dict(db.session.execute(db.select(Product.id, Product.farmer_id).where(
+        Product.id.in_(requested))).all())
+    product_ids = set(farmers)
+
+    results, events, positions = [None] * len(items), [], []
+    for index, item in enumerate(items):
+        event, errors = parse_tracking_event(item, warehouse_choices, product_ids)
+        if errors:
+            results[index] = {'index': index, 'status': 'invalid', 'errors': errors}
+            continue
+        event['processed_by'] = current_user.id
+        events.append(event)
+        positions.append(index)
+
+    try:
+        outcomes = record_trackings(events)
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent batch claimed one of our idempotency keys first; a retry will see it
+        db.session.rollback()
+        return jsonify(error='Conflicting concurrent batch, retry.'), 409
+
+    warehouse_types = {w.id: w.type for w in warehouses}
+    written = [event for event, (outcome, _) in zip(events, outcomes) if outcome == 'created']
+    cache.invalidate(*{farmer_tag(farmers[e['product_id']]) for e in written},
+                     *{warehouse_type_tag(warehouse_types[e['warehouse_id']]) for e in written})
+
+    for index, (outcome, detail) in zip(positions, outcomes):
+        if outcome == 'rejected':
+            results[index] = {'index': index, 'status': outcome, 'error': detail}
+        else:
+            results[index] = {'index': index, 'status': outcome, 'tracking_id': detail}
+
+    summary = {outcome: sum(1 for r in results if r['status'] == outcome)
+               for outcome in ('created', 'duplicate', 'rejected', 'invalid')}
+    return jsonify(results=results, **summary)
+
+@api.route('/trackings/queue')
+@login_required
+def tracking_queue_status():
+    """Depth and progress of this worker's write-behind tracking queue"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers do not have access to the tracking queue.'), 403
+    return jsonify(write_behind.status())
+
+@api.route('/trackings/export')
+@login_required
+def export_trackings():
+    """Stream tracking history as CSV or NDJSON, optionally gzipped"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify(error=f"Unknown format, expected one of {', '.join(EXPORT_FORMATS)}."), 400
+    try:
+        start, end = (datetime.fromisoformat(request.args[name]) if request.args.get(name) else None
+                      for name in ('start', 'end'))
+    except ValueError:
+        return jsonify(error='start and end must be ISO 8601 dates.'), 400
+
+    farmer_id = request.args.get('farmer_id', type=int)
+    if current_user.role == 'farmer':
+        farmer_id = current_user.id
+    query = tracking_export_query(warehouse_id=request.args.get('warehouse_id', type=int),
+                                  farmer_id=farmer_id, start=start, end=end)
+
+    encode, mimetype = EXPORT_FORMATS[fmt]
+    chunks = encode(stream_rows(query))
+    filename = f'trackings.{fmt}'
+    if request.args.get('gzip') in ('1', 'true'):
+        chunks, mimetype, filename = gzip_chunks(chunks), 'application/gzip', filename + '.gz'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@api.route('/trends')
+@login_required
+def trends():
+    """Hourly or daily kg per status from the rollup table, for trend charts"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers do not have access to warehouse trends.'), 403
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in BUCKET_STEPS:
+        return jsonify(error='granularity must be hour or day.'), 400
+    default, maximum = TREND_PERIODS[granularity]
+    periods = min(max(request.args.get('periods', default, type=int), 1), maximum)
+
+    warehouse_ids = None
+    types = [value for value, label in WAREHOUSE_TYPES]
+    if request.args.get('warehouse_id'):
+        warehouse = db.session.get(Warehouse, request.args.get('warehouse_id', type=int))
+        warehouse_ids = [warehouse.id] if warehouse else []
+        types = [warehouse.type] if warehouse else []
+    elif request.args.get('type'):
+        warehouse_ids = list(db.session.scalars(
+            db.select(Warehouse.id).where(Warehouse.type == request.args['type'])))
+        types = [request.args['type']]
+    product_type = request.args.get('product_type')
+
+    now = datetime.utcnow()
+
+    def buckets():
+        series = trend_series(granularity, periods, warehouse_ids=warehouse_ids,
+                              product_type=product_type, now=now)
+        return [dict(bucket, start=bucket['start'].isoformat()) for bucket in series]
+
+    # Buckets are relative to the current hour or day, so that is part of the key
+    key = (f'trends:{granularity}:{periods}:{warehouse_ids}:{product_type}:'
+           f'{bucket_start(now, granularity).isoformat()}')
+    return jsonify(granularity=granularity,
+                   buckets=cache.cached(key, buckets, tags=[warehouse_type_tag(t) for t in types]))
+
+@api.route('/yields')
+@login_required
+def yields():
+    """Per-stage yield, loss, dwell time and rejection rate by product type, farmer or warehouse"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers do not have access to yield reports.'), 403
+    dimension = request.args.get('by', 'product_type')
+    if dimension not in YIELD_DIMENSIONS:
+        return jsonify(error=f"by must be one of {', '.join(YIELD_DIMENSIONS)}."), 400
+    try:
+        start, end = (datetime.fromisoformat(request.args[name]) if request.args.get(name) else None
+                      for name in ('start', 'end'))
+    except ValueError:
+        return jsonify(error='start and end must be ISO 8601 dates.'), 400
+    return jsonify(by=dimension, groups=cached_yield_report(dimension, start, end))
+
+@api.route('/warehouses')
+@login_required
+def warehouse_stats():
+    """Utilization, products on hand per status, last-24h movement and last activity per warehouse"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers do not have access to warehouse statistics.'), 403
+    warehouses = cached_warehouse_stats()
+    return jsonify(warehouses=[
+        dict(stats, last_activity=stats['last_activity'].isoformat() if stats['last_activity'] else None)
+        for stats in warehouses])
+
+def history_response(**scope):
+    """A page of tracking history as JSON, filtered by the request's status, start, end and after"""
+    try:
+        filters = history_filters(request.args)
+        trackings, next_cursor = history_page(cursor=request.args.get('after'), **scope, **filters)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(items=[serialize_history(tracking) for tracking in trackings], next_cursor=next_cursor)
+
+@api.route('/warehouses/<int:warehouse_id>/history')
+@login_required
+def warehouse_history(warehouse_id):
+    """Newest-first tracking history of a warehouse, one page per call; archived rows with archived=1"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers do not have access to warehouse details.'), 403
+    if db.session.get(Warehouse, warehouse_id) is None:
+        return jsonify(error='Unknown warehouse.'), 404
+    return history_response(warehouse_id=warehouse_id, include_archived=request.args.get('archived') == '1')
+
+@api.route('/products/<int:product_id>/history')
+@login_required
+def product_history(product_id):
+    """Newest-first tracking history of a product, archive included, one page per call"""
+    farmer_id = db.session.scalar(db.select(Product.farmer_id).where(Product.id == product_id))
+    if farmer_id is None:
+        return jsonify(error='Unknown product.'), 404
+    if current_user.role == 'farmer' and farmer_id != current_user.id:
+        return jsonify(error='You can only view your own products.'), 403
+    return history_response(product_id=product_id)
+
+@api.route('/analytics')
+@login_required
+def analytics():
+    """Kg and event counts over the whole tracking history, from the in-memory snapshot"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers do not have access to tracking analytics.'), 403
+    dimension = request.args.get('by', 'product_type')
+    if dimension not in ANALYTICS_DIMENSIONS:
+        return jsonify(error=f"by must be one of {', '.join(ANALYTICS_DIMENSIONS)}."), 400
+    status = request.args.get('status') or None
+    if status is not None and status not in STATUS_CODES:
+        return jsonify(error='Unknown status.'), 400
+    granularity = request.args.get('granularity') or None
+    if granularity is not None and granularity not in BUCKET_WIDTHS:
+        return jsonify(error='granularity must be day or week.'), 400
+    try:
+        start, end = (datetime.fromisoformat(request.args[name]) if request.args.get(name) else None
+                      for name in ('start', 'end'))
+    except ValueError:
+        return jsonify(error='start and end must be ISO 8601 dates.'), 400
+    warehouse_ids = None
+    if request.args.get('warehouse_id'):
+        warehouse_ids = [request.args.get('warehouse_id', type=int)]
+
+    snapshot = tracking_snapshot()
+    if request.args.get('top'):
+        if granularity is not None:
+            return jsonify(error='top cannot be combined with granularity.'), 400
+        top = min(max(request.args.get('top', ANALYTICS_TOP[0], type=int), 1), ANALYTICS_TOP[1])
+        groups = snapshot.top(dimension, top, status=status, start=start, end=end, warehouse_ids=warehouse_ids)
+    else:
+        groups = snapshot.aggregate(dimension, status=status, start=start, end=end, granularity=granularity,
+                                    warehouse_ids=warehouse_ids)
+    for group in groups:
+        if 'bucket' in group:
+            group['bucket'] = datetime.utcfromtimestamp(group['bucket']).isoformat()
+    return jsonify(by=dimension, status=status, granularity=granularity,
+                   groups=label_groups(snapshot, dimension, groups))
+
+@api.route('/search')
+@login_required
+def full_text_search():
+    """Ranked full-text search over product types, varieties and quality notes"""
+    if not search_available():
+        return jsonify(error='Search needs the SQLite FTS5 index.'), 501
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify(error='Missing q parameter.'), 400
+    page = min(max(request.args.get('page', 1, type=int), 1), SEARCH_MAX_PAGE)
+    per_page = min(max(request.args.get('per_page', SEARCH_PER_PAGE, type=int), 1), 100)
+
+    farmer_id = current_user.id if current_user.role == 'farmer' else None
+    results = search(query, per_page + 1, (page - 1) * per_page, farmer_id=farmer_id)
+    next_page = page + 1 if len(results) > per_page and page < SEARCH_MAX_PAGE else None
+    results = results[:per_page]
+    for result in results:
+        result['snippet'] = str(result['snippet'])
+        if 'transition_date' in result:
+            result['transition_date'] = result['transition_date'].isoformat()
+    return jsonify(query=query, page=page, next_page=next_page, results=results)
+
+@api.route('/changes')
+@login_required
+def list_changes():
+    """Changes after a cursor, for incremental sync; long-polls with wait=<seconds>"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers do not have access to the change feed.'), 403
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', CHANGES_LIMIT[0], type=int)
+    wait = request.args.get('wait', 0, type=float)
+    if since < 0 or not 0 < limit <= CHANGES_LIMIT[1] or not 0 <= wait <= CHANGES_MAX_WAIT:
+        return jsonify(error=f'since must be a cursor from this feed, limit 1 to {CHANGES_LIMIT[1]} '
+                             f'and wait 0 to {CHANGES_MAX_WAIT} seconds.'), 400
+
+    # One extra row tells whether the client should come straight back for more
+    changes = wait_for_changes(since, limit + 1, wait)
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return jsonify(changes=[serialize_change(change) for change in changes],
+                   next_cursor=changes[-1].seq if changes else since, has_more=has_more)
+
+@api.route('/cache/stats')
+@login_required
+def cache_stats():
+    """Hit and miss counters of this worker's cache"""
+    if current_user.role == 'farmer':
+        return jsonify(error='Farmers do not have access to cache statistics.'), 403
+    return jsonify(cache.stats())
+
+def serialize_token(api_token):
+    return dict(id=api_token.id, name=api_token.name, role=api_token.role, prefix=api_token.prefix,
+                created_at=api_token.created_at.isoformat(),
+                revoked_at=api_token.revoked_at.isoformat() if api_token.revoked_at else None)
+
+@api.route('/tokens')
+@login_required
+def list_tokens():
+    """The current user's API tokens, without their secrets"""
+    tokens = ApiToken.query.filter_by(user_id=current_user.id).order_by(ApiToken.id).all()
+    return jsonify(tokens=[serialize_token(api_token) for api_token in tokens])
+
+@api.route('/tokens', methods=['POST'])
+@login_required
+def create_token():
+    """Issue an API token acting as the signed-in user; the token is only ever returned here"""
+    if isinstance(current_user, TokenUser):
+        return jsonify(error='Sign in to issue API tokens.'), 403
+    payload = request.get_json(silent=True)
+    name = payload.get('name') if isinstance(payload, dict) else None
+    if not isinstance(name, str) or not 0 < len(name.strip()) <= 100:
+        return jsonify(error='Expected a JSON object with a "name" of 1 to 100 characters.'), 400
+    token, api_token = issue_token(current_user, name.strip())
+    return jsonify(token=token, **serialize_token(api_token)), 201
+
+@api.route('/tokens/<int:token_id>', methods=['DELETE'])
+@login_required
+def delete_token(token_id):
+    """Revoke one of the current user's API tokens"""
+    api_token = ApiToken.query.filter_by(id=token_id, user_id=current_user.id).first()
+    if api_token is None:
+        return jsonify(error='No such token.'), 404
+    revoke_token(api_token)
+    return jsonify(serialize_token(api_token))
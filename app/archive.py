@@ -0,0 +1,69 @@
+"""Cold storage for the tracking history of finished product chains.
+
+Once a product's latest event is shipped or rejected and older than the
+retention period, its tracking rows move from product_tracking to
+archived_tracking with their ids. product_state, the rollups and the stage
+transitions are left as they are, and readers that need the whole history
+go through tracking_history(). A new event for an archived product first
+moves its history back, so the write path only ever sees the hot table.
+"""
+from datetime import datetime, timedelta
+from app import db
+from app.models import ArchivedTracking, ProductState, ProductTracking
+
+FINISHED_STATUSES = ('shipped', 'rejected')
+
+# Products moved per transaction; keeps the SQLite write lock short
+ARCHIVE_BATCH_SIZE = 500
+
+def _move_history(source, target, product_ids):
+    """Move the products' tracking rows between the hot and archive tables; returns the row count"""
+    columns = [column.name for column in ArchivedTracking.__table__.columns]
+    moved = db.session.execute(db.insert(target).from_select(
+        columns, db.select(*[source.__table__.c[name] for name in columns])
+        .where(source.product_id.in_(product_ids)))).rowcount
+    if moved:
+        db.session.execute(db.delete(source).where(source.product_id.in_(product_ids)))
+    return moved
+
+def archive_finished_chains(older_than_days, batch_size=ARCHIVE_BATCH_SIZE, now=None, progress=None):
+    """Archive the history of every product whose chain finished more than `older_than_days` ago.
+
+    Commits after each batch of products. Returns (products, tracking rows) archived.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(days=older_than_days)
+    report = progress or (lambda message: None)
+    # The newest row stays hot: SQLite hands out max(id) + 1, so archiving it would let
+    # a new tracking row reuse an archived id
+    newest = db.session.scalar(db.select(ProductTracking.product_id)
+                               .order_by(ProductTracking.id.desc()).limit(1))
+    has_hot_rows = db.select(ProductTracking.id).where(
+        ProductTracking.product_id == ProductState.product_id).exists()
+
+    products = trackings = 0
+    after = 0
+    while True:
+        batch = list(db.session.scalars(
+            db.select(ProductState.product_id)
+            .where(ProductState.product_id > after, ProductState.status.in_(FINISHED_STATUSES),
+                   ProductState.transition_date < cutoff, has_hot_rows)
+            .order_by(ProductState.product_id).limit(batch_size)))
+        if not batch:
+            break
+        after = batch[-1]
+        batch = [product_id for product_id in batch if product_id != newest]
+        if batch:
+            trackings += _move_history(ProductTracking, ArchivedTracking, batch)
+            products += len(batch)
+        db.session.commit()
+        report(f'{products} products, {trackings} tracking rows archived')
+    return products, trackings
+
+def restore_archived_history(product_ids):
+    """Move archived history back to the hot table before new events for these products"""
+    product_ids = list(product_ids)
+    # Almost never true; an indexed probe is cheaper than a write that moves nothing
+    if not product_ids or not db.session.scalar(
+            db.select(ArchivedTracking.id).where(ArchivedTracking.product_id.in_(product_ids)).limit(1)):
+        return 0
+    return _move_history(ArchivedTracking, ProductTracking, product_ids)
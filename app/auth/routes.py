@@ -1,11 +1,29 @@
 from flask import render_template, url_for, flash, redirect, request, Blueprint
 from flask_login import login_user, current_user, logout_user, login_required
-from app import db, bcrypt
+from app import db
 from app.models import User
 from app.auth.forms import LoginForm, RegistrationForm
+from app.reference import invalidate_reference
+from app.passwords import PasswordBusyError, hash_password, needs_rehash
 
 auth = Blueprint('auth', __name__)
 
+def busy(template, title, form):
+    flash('Too many people are signing in right now, please try again in a moment.', 'warning')
+    return render_template(template, title=title, form=form), 503
+
+def rehash_password(user, password):
+    """Store the password again at the configured cost if its hash used another"""
+    if not needs_rehash(user.password_hash):
+        return
+    try:
+        user.set_password(password)
+    except PasswordBusyError:
+        # Signing in matters more; the next login tries again
+        return
+    db.session.commit()
+    invalidate_reference('users')
+
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
@@ -14,7 +32,12 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and user.check_password(form.password.data):
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+        except PasswordBusyError:
+            return busy('login.html', 'Login', form)
+        if valid:
+            rehash_password(user, form.password.data)
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('dashboard.index'))
@@ -34,12 +57,16 @@ def register():
 
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        try:
+            hashed_password = hash_password(form.password.data)
+        except PasswordBusyError:
+            return busy('register.html', 'Register', form)
         user = User(username=form.username.data, email=form.email.data,
                    password_hash=hashed_password, role=form.role.data,
                    farm_location=form.farm_location.data if form.role.data == 'farmer' else None)
         db.session.add(user)
         db.session.commit()
+        invalidate_reference('users')
         flash('Your account has been created! You are now able to log in', 'success')
         return redirect(url_for('auth.login'))
     return render_template('register.html', title='Register', form=form)
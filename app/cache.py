@@ -0,0 +1,153 @@
+"""Caching of rendered fragments and query results"""
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+
+class MemoryCache:
+    """In-process cache with per-entry expiry, LRU eviction and tag invalidation.
+
+    Each worker process holds its own copy, so entries written elsewhere are
+    only seen once they expire; keep the TTL short when running several.
+    """
+
+    def __init__(self, max_entries=1024, default_ttl=30, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """Return (found, value), refreshing the entry's LRU position on a hit"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value, ttl=None, tags=()):
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock() + ttl, value, frozenset(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of the given tags"""
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(backend='memory', entries=len(self._entries), max_entries=self.max_entries,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        hit_ratio=round(self.hits / lookups, 4) if lookups else None)
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+class NullCache:
+    """Backend that stores nothing, for turning caching off"""
+
+    def __init__(self, **kwargs):
+        self.misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return False, None
+
+    def set(self, key, value, ttl=None, tags=()):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def invalidate(self, *tags):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return dict(backend='null', entries=0, hits=0, misses=self.misses, evictions=0, hit_ratio=None)
+
+CACHE_BACKENDS = {'memory': MemoryCache, 'null': NullCache}
+
+class Cache:
+    """Flask extension giving each app its own cache backend.
+
+    CACHE_BACKEND names an entry of CACHE_BACKENDS or is a backend class taking
+    max_entries and default_ttl keyword arguments.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'memory')
+        app.config.setdefault('CACHE_DEFAULT_TTL', 30)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 1024)
+        backend = app.config['CACHE_BACKEND']
+        if isinstance(backend, str):
+            backend = CACHE_BACKENDS[backend]
+        app.extensions['cache'] = backend(max_entries=app.config['CACHE_MAX_ENTRIES'],
+                                          default_ttl=app.config['CACHE_DEFAULT_TTL'])
+
+    @property
+    def backend(self):
+        return current_app.extensions['cache']
+
+    def cached(self, key, compute, ttl=None, tags=()):
+        """Return the cached value for key, calling compute() to fill it on a miss"""
+        found, value = self.backend.get(key)
+        if not found:
+            value = compute()
+            self.backend.set(key, value, ttl=ttl, tags=tags)
+        return value
+
+    def invalidate(self, *tags):
+        self.backend.invalidate(*tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return self.backend.stats()
+
+def farmer_tag(farmer_id):
+    """Tag for entries built from one farmer's products and their tracking"""
+    return f'farmer:{farmer_id}'
+
+def warehouse_type_tag(warehouse_type):
+    """Tag for entries built from the warehouses of one type and their tracking"""
+    return f'warehouse-type:{warehouse_type}'
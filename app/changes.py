@@ -0,0 +1,116 @@
+"""Change feed for downstream systems.
+
+Writers call the record_* helpers in the transaction that makes the change,
+so a change is visible in the feed exactly when it is committed. Consumers
+read change_log rows after their last seq, optionally long-polling until
+something new arrives.
+"""
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import db
+from app.models import ChangeLog
+
+CHANGE_ENTITIES = ('product', 'tracking', 'warehouse')
+
+# Arbitrary key of the PostgreSQL advisory lock serialising change log writers
+CHANGE_LOG_LOCK = 7_240_318
+
+# How often a long poll rechecks the table for changes committed by other processes
+CHANGES_POLL_INTERVAL = 0.5
+
+_committed = threading.Condition()
+_generation = 0
+
+def _jsonable(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def record_changes(entity, action, rows, fields):
+    """Append one change per row, copying the named attributes into its data"""
+    rows = list(rows)
+    if not rows:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        # Sequence values are handed out at insert but become visible at commit. Holding
+        # the lock to commit makes them visible in order, so no reader skips past one.
+        db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), dict(key=CHANGE_LOG_LOCK))
+    now = datetime.utcnow()
+    db.session.execute(ChangeLog.__table__.insert(), [
+        dict(entity=entity, entity_id=row.id, action=action, changed_at=now,
+             data={name: _jsonable(getattr(row, name)) for name in fields})
+        for row in rows
+    ])
+    db.session.info['changes_recorded'] = True
+
+def record_product_created(product):
+    record_changes('product', 'created', [product], (
+        'id', 'unique_hash', 'farmer_id', 'product_type', 'variety', 'quantity', 'quality_grade', 'created_at'))
+
+def record_warehouse_created(warehouse):
+    record_changes('warehouse', 'created', [warehouse], (
+        'id', 'name', 'type', 'location', 'capacity', 'current_stock'))
+
+def record_trackings_created(trackings):
+    """Changes for new tracking rows; ProductTracking objects or rows with the same attributes"""
+    record_changes('tracking', 'created', trackings, (
+        'id', 'product_id', 'warehouse_id', 'status', 'quantity', 'quality_notes', 'processed_by',
+        'transition_date'))
+
+def record_stock_changes(warehouses):
+    """Changes for new stock levels; rows with id and current_stock"""
+    record_changes('warehouse', 'stock', warehouses, ('id', 'current_stock'))
+
+@event.listens_for(Session, 'after_commit')
+def _wake_waiters(session):
+    global _generation
+    if session.info.pop('changes_recorded', False):
+        with _committed:
+            _generation += 1
+            _committed.notify_all()
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('changes_recorded', None)
+
+def commit_generation():
+    """Counter of commits in this process that recorded changes"""
+    with _committed:
+        return _generation
+
+def wait_for_commit(seen, timeout):
+    """Wait until this process commits changes after commit_generation() returned `seen`"""
+    with _committed:
+        return _committed.wait_for(lambda: _generation != seen, timeout)
+
+def latest_seq():
+    return db.session.scalar(db.select(db.func.max(ChangeLog.seq))) or 0
+
+def read_changes(since, limit):
+    """Up to `limit` changes after seq `since`, oldest first"""
+    return db.session.execute(
+        db.select(ChangeLog).where(ChangeLog.seq > since).order_by(ChangeLog.seq).limit(limit)
+    ).scalars().all()
+
+def wait_for_changes(since, limit, timeout):
+    """read_changes, waiting up to `timeout` seconds for the first change to be committed.
+
+    Commits in this process wake the wait at once; those made by other
+    processes are noticed within CHANGES_POLL_INTERVAL.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        seen = commit_generation()
+        changes = read_changes(since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        # Ends the read transaction, so the next read sees new commits, and frees the
+        # connection for other requests while this one waits
+        db.session.close()
+        wait_for_commit(seen, min(remaining, CHANGES_POLL_INTERVAL))
+
+def serialize_change(change):
+    return dict(seq=change.seq, entity=change.entity, entity_id=change.entity_id, action=change.action,
+                data=change.data, changed_at=change.changed_at.isoformat())
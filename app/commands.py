@@ -0,0 +1,151 @@
+import click
+from flask.cli import with_appcontext
+from app import db
+
+@click.command('rebuild-product-state')
+@with_appcontext
+def rebuild_product_state_command():
+    """Rebuild the product current-state table from tracking history."""
+    from app.tracking import rebuild_product_state
+    count = rebuild_product_state()
+    db.session.commit()
+    click.echo(f'Rebuilt state for {count} products.')
+
+@click.command('check-product-state')
+@with_appcontext
+def check_product_state_command():
+    """Report products whose current-state row disagrees with their history."""
+    from app.tracking import check_product_state
+    problems = check_product_state()
+    for product_id, problem in problems:
+        click.echo(f'product {product_id}: {problem}')
+    if problems:
+        raise SystemExit(1)
+    click.echo('Product state is consistent.')
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """Rebuild the hourly and daily tracking rollups from tracking history."""
+    from app.tracking import rebuild_rollups
+    count = rebuild_rollups()
+    db.session.commit()
+    click.echo(f'Rebuilt {count} rollup buckets.')
+
+@click.command('rebuild-stage-transitions')
+@with_appcontext
+def rebuild_stage_transitions_command():
+    """Rebuild the stage transitions behind the yield report from tracking history."""
+    from app.tracking import rebuild_stage_transitions
+    count = rebuild_stage_transitions()
+    db.session.commit()
+    click.echo(f'Rebuilt {count} stage transitions.')
+
+@click.command('ensure-indexes')
+@with_appcontext
+def ensure_indexes_command():
+    """Create any declared index missing from an existing database."""
+    created = 0
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in db.inspect(db.engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                click.echo(f'Created {index.name}')
+                created += 1
+    click.echo(f'{created} indexes created.')
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Create the full-text search index if missing and reindex all products and notes."""
+    from app.search import rebuild_search_index, search_available
+    if not search_available():
+        raise click.ClickException('Full-text search needs an SQLite database with FTS5.')
+    counts = rebuild_search_index()
+    db.session.commit()
+    archived = counts['archive_search']
+    click.echo(f"Indexed {counts['product_search']} products and {counts['tracking_search'] + archived} "
+               f"tracking events, {archived} of them archived.")
+
+@click.command('archive-trackings')
+@click.option('--older-than-days', default=90, show_default=True,
+              help='Archive chains that were shipped or rejected at least this long ago')
+@click.option('--batch-size', default=500, show_default=True, help='Products moved per transaction')
+@with_appcontext
+def archive_trackings_command(older_than_days, batch_size):
+    """Move the tracking history of old finished product chains to the archive table."""
+    from app.archive import archive_finished_chains
+    products, trackings = archive_finished_chains(older_than_days, batch_size, progress=click.echo)
+    click.echo(f'Archived {trackings} tracking events of {products} products.')
+
+@click.command('issue-token')
+@click.argument('username')
+@click.option('--name', required=True, help='What the token is for, e.g. the scanner it is installed on')
+@with_appcontext
+def issue_token_command(username, name):
+    """Issue an API token acting as USERNAME and print it once."""
+    from app.models import User
+    from app.tokens import issue_token
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'No user named {username}.')
+    token, api_token = issue_token(user, name)
+    click.echo(f'Token {api_token.id} for {username} ({api_token.role}), shown only now:')
+    click.echo(token)
+
+@click.command('revoke-token')
+@click.argument('token_id', type=int)
+@with_appcontext
+def revoke_token_command(token_id):
+    """Revoke the API token with id TOKEN_ID."""
+    from app.models import ApiToken
+    from app.tokens import revoke_token
+    api_token = db.session.get(ApiToken, token_id)
+    if api_token is None:
+        raise click.ClickException(f'No token {token_id}.')
+    revoke_token(api_token)
+    click.echo(f"Revoked token {token_id} ('{api_token.name}').")
+
+@click.command('seed-test-data')
+@with_appcontext
+def seed_test_data_command():
+    """Load the sample users, warehouses and products."""
+    from app import init_test_data
+    if init_test_data():
+        click.echo('Sample data loaded.')
+    else:
+        click.echo('Sample data already present.')
+
+@click.command('generate-data')
+@click.option('--farmers', default=100, show_default=True)
+@click.option('--plants', default=5, show_default=True, help='Processing plants')
+@click.option('--warehouses', 'stores', default=10, show_default=True, help='Storage warehouses')
+@click.option('--products', default=10000, show_default=True)
+@click.option('--transfers', default=1.0, show_default=True,
+              help='Average warehouse-to-warehouse transfers per shipped product')
+@click.option('--days', default=90, show_default=True, help='Length of the generated history')
+@click.option('--seed', default=0, show_default=True)
+@with_appcontext
+def generate_data_command(farmers, plants, stores, products, transfers, days, seed):
+    """Bulk-load deterministic synthetic farmers, warehouses, products and tracking."""
+    import time
+    from app.generator import generate_data
+    started = time.perf_counter()
+    counts = generate_data(farmers=farmers, plants=plants, stores=stores, products=products,
+                           transfers=transfers, days=days, seed=seed, progress=click.echo)
+    click.echo(f"Generated {counts['products']} products and {counts['trackings']} tracking events "
+               f'in {time.perf_counter() - started:.1f}s.')
+
+def register_commands(app):
+    app.cli.add_command(rebuild_product_state_command)
+    app.cli.add_command(check_product_state_command)
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(rebuild_stage_transitions_command)
+    app.cli.add_command(ensure_indexes_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(archive_trackings_command)
+    app.cli.add_command(issue_token_command)
+    app.cli.add_command(revoke_token_command)
+    app.cli.add_command(seed_test_data_command)
+    app.cli.add_command(generate_data_command)
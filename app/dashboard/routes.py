@@ -1,6 +1,27 @@
-from flask import render_template, Blueprint
+from datetime import datetime, timedelta
+from flask import render_template, request, flash, redirect, url_for, Blueprint, Response, abort, current_app, \
+    stream_with_context
 from flask_login import login_required, current_user
+from markupsafe import Markup
+from sqlalchemy.orm import joinedload
+from app import cache, db, live_updates
+from app.cache import farmer_tag, warehouse_type_tag
 from app.models import Product, ProductTracking, Warehouse
+from app.product.forms import TRACKING_STATUSES
+from app.dashboard.trends import trend_series
+from app.dashboard.yields import cached_yield_report, YIELD_DIMENSIONS
+from app.changes import read_changes
+from app.live import LIVE_BATCH_SIZE, format_event, live_messages
+from app.reference import users_by_id
+from app.history import newest_trackings
+
+THROUGHPUT_DAYS = 7
+
+# Look-back periods offered by the yield report; None covers the whole history
+YIELD_PERIODS = [(7, 'Last 7 days'), (30, 'Last 30 days'), (90, 'Last 90 days'), (None, 'All time')]
+
+# Warehouse type whose activity each role's dashboard shows
+LIVE_WAREHOUSE_TYPES = {'plant_manager': 'processing', 'warehouse_manager': 'warehouse'}
 
 dashboard = Blueprint('dashboard', __name__)
 
@@ -17,35 +38,126 @@ def index():
     else:
         return render_template('dashboard/admin.html')
 
+def cached_fragment(template, build, tags):
+    """Render a dashboard's content once per role and user until a write invalidates it.
+
+    build returns the template context; it only runs on a cache miss.
+    """
+    key = f'dashboard:{current_user.role}:{current_user.id}'
+    fragment = cache.cached(key, lambda: render_template(f'dashboard/_{template}.html', **build()), tags=tags)
+    return render_template(f'dashboard/{template}.html', fragment=Markup(fragment))
+
 def farmer_dashboard():
     """Farmer's dashboard - shows their products and tracking"""
-    products = Product.query.filter_by(farmer_id=current_user.id).all()
+    return cached_fragment('farmer', farmer_context, [farmer_tag(current_user.id)])
+
+def plant_manager_dashboard():
+    """Plant manager's dashboard - shows processing operations"""
+    return cached_fragment('plant_manager', plant_manager_context, [warehouse_type_tag('processing')])
+
+def warehouse_manager_dashboard():
+    """Warehouse manager's dashboard - shows warehouse operations"""
+    return cached_fragment('warehouse_manager', warehouse_manager_context, [warehouse_type_tag('warehouse')])
+
+def farmer_context():
+    products = Product.query.options(joinedload(Product.state)).filter_by(farmer_id=current_user.id).all()
     recent_trackings = ProductTracking.query.join(Product).filter(
         Product.farmer_id == current_user.id
     ).order_by(ProductTracking.transition_date.desc()).limit(10).all()
 
-    return render_template('dashboard/farmer.html',
-                         products=products,
-                         recent_trackings=recent_trackings)
+    return dict(products=products, recent_trackings=recent_trackings)
 
-def plant_manager_dashboard():
-    """Plant manager's dashboard - shows processing operations"""
+def plant_manager_context():
     warehouses = Warehouse.query.filter_by(type='processing').all()
-    processing_products = ProductTracking.query.join(Warehouse).filter(
-        Warehouse.type == 'processing'
-    ).order_by(ProductTracking.transition_date.desc()).limit(20).all()
+    processing_products = newest_trackings([w.id for w in warehouses])
+    users_by_id(t.product.farmer_id for t in processing_products)
 
-    return render_template('dashboard/plant_manager.html',
-                         warehouses=warehouses,
-                         processing_products=processing_products)
+    throughput = trend_series('day', THROUGHPUT_DAYS, warehouse_ids=[w.id for w in warehouses])
 
-def warehouse_manager_dashboard():
-    """Warehouse manager's dashboard - shows warehouse operations"""
+    return dict(warehouses=warehouses,
+                processing_products=processing_products,
+                throughput=throughput,
+                statuses=TRACKING_STATUSES)
+
+def warehouse_manager_context():
     warehouses = Warehouse.query.filter_by(type='warehouse').all()
-    stored_products = ProductTracking.query.join(Warehouse).filter(
-        Warehouse.type == 'warehouse'
-    ).order_by(ProductTracking.transition_date.desc()).limit(20).all()
+    stored_products = newest_trackings([w.id for w in warehouses])
+    users_by_id(t.product.farmer_id for t in stored_products)
+
+    throughput = trend_series('day', THROUGHPUT_DAYS, warehouse_ids=[w.id for w in warehouses])
+
+    return dict(warehouses=warehouses,
+                stored_products=stored_products,
+                throughput=throughput,
+                statuses=TRACKING_STATUSES)
+
+@dashboard.route('/reports/yield')
+@login_required
+def yield_report():
+    if current_user.role == 'farmer':
+        flash('Farmers do not have access to yield reports.', 'danger')
+        return redirect(url_for('dashboard.index'))
+    dimension = request.args.get('by', 'product_type')
+    if dimension not in YIELD_DIMENSIONS:
+        dimension = 'product_type'
+    days = request.args.get('days', '30')
+    days = None if days == 'all' else int(days) if days.isdigit() else 30
+    if days not in dict(YIELD_PERIODS):
+        days = 30
+    # Whole days, so the cached report is reused all day
+    start = None
+    if days:
+        start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    return render_template('dashboard/yield.html', title='Yield Report', groups=cached_yield_report(dimension, start),
+                           dimension=dimension, days=days, periods=YIELD_PERIODS, dimensions=YIELD_DIMENSIONS)
+
+@dashboard.route('/dashboard/live')
+@login_required
+def live():
+    """Server-Sent Events of new tracking events and stock levels for the user's dashboard.
+
+    Optionally narrowed to one warehouse with ?warehouse_id=. A reconnecting
+    browser sends Last-Event-ID and first gets the changes it missed.
+    """
+    warehouse_type = LIVE_WAREHOUSE_TYPES.get(current_user.role)
+    if warehouse_type is None:
+        abort(403)
+    warehouse_id = request.args.get('warehouse_id', type=int)
+    last_seq = request.headers.get('Last-Event-ID', type=int)
+    keepalive = current_app.config['LIVE_KEEPALIVE']
+    broker = live_updates.broker
+    # Before reading the backlog, so nothing committed in between is missed
+    subscription = broker.subscribe(warehouse_type, warehouse_id)
+
+    def missed_messages():
+        since = last_seq
+        while since is not None:
+            changes = read_changes(since, LIVE_BATCH_SIZE)
+            yield from (message for message in live_messages(changes) if subscription.accepts(message))
+            since = changes[-1].seq if len(changes) == LIVE_BATCH_SIZE else None
+
+    def events():
+        sent = last_seq or 0
+        try:
+            yield 'retry: 3000\n\n'
+            for message in missed_messages():
+                sent = message['seq']
+                yield format_event(message)
+            # Hand the connection back to the pool for the life of the stream
+            db.session.close()
+            while True:
+                try:
+                    message = subscription.get(keepalive)
+                except LookupError:
+                    # Too far behind; the browser reconnects and catches up from Last-Event-ID
+                    return
+                if message is None:
+                    yield ': keepalive\n\n'
+                elif message['seq'] > sent:
+                    sent = message['seq']
+                    yield format_event(message)
+        finally:
+            broker.unsubscribe(subscription)
 
-    return render_template('dashboard/warehouse_manager.html',
-                         warehouses=warehouses,
-                         stored_products=stored_products)
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,37 @@
+"""Trend series read from the tracking rollups"""
+from datetime import datetime, timedelta
+from app import db
+from app.models import TrackingRollup
+from app.product.forms import TRACKING_STATUSES
+from app.tracking import bucket_start
+
+BUCKET_STEPS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+
+def trend_series(granularity, periods, warehouse_ids=None, product_type=None, now=None):
+    """Kg and event counts per status for the last `periods` buckets, oldest first.
+
+    Reads at most periods x statuses x product types rollup rows, however long
+    the tracking history is. Buckets without activity are filled with zeros.
+    """
+    step = BUCKET_STEPS[granularity]
+    last = bucket_start(now or datetime.utcnow(), granularity)
+    first = last - step * (periods - 1)
+
+    # The row count is bounded by the window, so summing here beats a GROUP BY sort
+    query = (db.select(TrackingRollup.bucket_start, TrackingRollup.status,
+                       TrackingRollup.quantity, TrackingRollup.events)
+             .where(TrackingRollup.granularity == granularity, TrackingRollup.bucket_start >= first))
+    if warehouse_ids is not None:
+        query = query.where(TrackingRollup.warehouse_id.in_(warehouse_ids))
+    if product_type:
+        query = query.where(TrackingRollup.product_type == product_type)
+
+    series = {first + step * i: {'start': first + step * i, 'events': 0,
+                                 'quantity': {status: 0.0 for status, _ in TRACKING_STATUSES}}
+              for i in range(periods)}
+    for start, status, quantity, events in db.session.execute(query):
+        bucket = series.get(start)
+        if bucket is not None:
+            bucket['quantity'][status] = bucket['quantity'].get(status, 0.0) + quantity
+            bucket['events'] += events
+    return list(series.values())
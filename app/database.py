@@ -0,0 +1,66 @@
+"""Database URL, engine pool and SQLite connection settings"""
+import os
+import weakref
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Engines to reset in forked worker processes
+_engines = weakref.WeakSet()
+
+def database_url():
+    """DATABASE_URL from the environment, defaulting to a private in-memory database"""
+    url = os.environ.get('DATABASE_URL', 'sqlite:///:memory:')
+    # Some hosts still hand out the scheme SQLAlchemy dropped in 1.4
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def is_memory_sqlite(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+def engine_options(config):
+    """Engine keyword arguments for the configured database.
+
+    Explicit SQLALCHEMY_ENGINE_OPTIONS entries win over these defaults.
+    In-memory SQLite keeps Flask-SQLAlchemy's single shared connection.
+    """
+    url = config['SQLALCHEMY_DATABASE_URI']
+    options = {}
+    if not is_memory_sqlite(url):
+        options.update(
+            pool_size=config['DB_POOL_SIZE'],
+            max_overflow=config['DB_MAX_OVERFLOW'],
+            pool_timeout=config['DB_POOL_TIMEOUT'],
+            pool_recycle=config['DB_POOL_RECYCLE'],
+            pool_pre_ping=True,
+        )
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    return options
+
+def configure_engine(engine, config):
+    """Apply per-connection settings and register the engine for after-fork disposal"""
+    if is_memory_sqlite(engine.url):
+        # The database lives in its one connection; a fresh one would be empty
+        return
+    _engines.add(engine)
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run alongside the single writer; NORMAL only syncs at checkpoints,
+        # which is safe in WAL mode; busy_timeout makes writers queue instead of failing.
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.close()
+
+def _dispose_engines_in_child():
+    # Pooled connections were opened by the parent; the child must not use or close them
+    for engine in list(_engines):
+        engine.dispose(close=False)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_engines_in_child)
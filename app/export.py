@@ -0,0 +1,90 @@
+"""Streaming export of tracking history"""
+import csv
+import io
+import json
+import zlib
+from app import db
+from app.models import Product, ProductTracking, ArchivedTracking, Warehouse
+
+def _export_columns(model):
+    return [
+        model.id.label('id'),
+        model.product_id,
+        Product.unique_hash.label('product_hash'),
+        Product.product_type,
+        Product.farmer_id,
+        model.warehouse_id,
+        Warehouse.name.label('warehouse'),
+        model.status,
+        model.quantity,
+        model.quality_notes,
+        model.transition_date.label('transition_date'),
+        model.processed_by,
+    ]
+
+EXPORT_FIELDS = [column.key for column in _export_columns(ProductTracking)]
+_DATE_INDEX = EXPORT_FIELDS.index('transition_date')
+
+# Rows fetched from the cursor and encoded per chunk of output
+EXPORT_BATCH_SIZE = 2000
+
+def tracking_export_query(warehouse_id=None, farmer_id=None, start=None, end=None):
+    """Select hot and archived tracking history as plain column tuples, oldest first"""
+    selects = []
+    for model in (ProductTracking, ArchivedTracking):
+        query = (db.select(*_export_columns(model))
+                 .join(Product, Product.id == model.product_id)
+                 .join(Warehouse, Warehouse.id == model.warehouse_id))
+        if warehouse_id is not None:
+            query = query.where(model.warehouse_id == warehouse_id)
+        if farmer_id is not None:
+            query = query.where(Product.farmer_id == farmer_id)
+        if start is not None:
+            query = query.where(model.transition_date >= start)
+        if end is not None:
+            query = query.where(model.transition_date < end)
+        selects.append(query)
+    # SQLite reads both sides from their date indexes and merges them rather than sorting
+    return db.union_all(*selects).order_by(db.literal_column('transition_date'), db.literal_column('id'))
+
+def stream_rows(query):
+    """Yield lists of rows from a server-side cursor, EXPORT_BATCH_SIZE at a time"""
+    # Plain column tuples need no ORM loading, so go straight to the connection
+    result = db.session.connection().execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    try:
+        for partition in result.partitions():
+            yield partition
+    finally:
+        result.close()
+
+def _encodable(row):
+    values = list(row)
+    if values[_DATE_INDEX] is not None:
+        values[_DATE_INDEX] = values[_DATE_INDEX].isoformat()
+    return values
+
+def iter_csv(batches):
+    """Encode row batches as CSV, one chunk per batch"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for rows in batches:
+        writer.writerows(_encodable(row) for row in rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+def iter_ndjson(batches):
+    """Encode row batches as newline-delimited JSON, one chunk per batch"""
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, _encodable(row))), separators=(',', ':')) + '\n'
+                      for row in rows).encode()
+
+def gzip_chunks(chunks):
+    """Compress a stream of byte chunks into a single gzip member"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
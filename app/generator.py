@@ -0,0 +1,138 @@
+"""Deterministic synthetic data for load testing and benchmarks"""
+import hashlib
+import random
+from datetime import datetime, timedelta
+from app import db, TEST_PASSWORD_HASH
+from app.models import User, Warehouse, Product, ProductTracking
+from app.product.forms import PRODUCT_TYPES
+from app.tracking import STOCK_EFFECTS, rebuild_product_state, rebuild_rollups, rebuild_stage_transitions
+from app.search import deferred_search_index
+
+INSERT_BATCH_SIZE = 5000
+
+GRADE_WEIGHTS = (('A', 6), ('B', 3), ('C', 1))
+QUALITY_NOTES = ('Good condition', 'Washed and sorted', 'Minor bruising', 'Packed for distribution', None)
+
+def _chain(rng, plants, stores, quantity, start, end, transfers):
+    """One product's tracking history: (warehouse_id, status, quantity, transition_date) tuples.
+
+    Received at a plant, then rejected or processed and stored at a warehouse;
+    most stored goods are shipped, and shipped goods are received, stored and
+    shipped again at another warehouse `transfers` times on average. Events
+    after `end` are cut off, leaving the product mid-chain.
+    """
+    events = []
+    moment = start
+
+    def step(warehouse_id, status, loss=0.04, hours=(1, 48)):
+        nonlocal quantity, moment
+        moment += timedelta(minutes=rng.randint(hours[0] * 60, hours[1] * 60))
+        quantity = round(quantity * (1 - rng.uniform(0, loss)), 1)
+        events.append((warehouse_id, status, quantity, moment))
+
+    plant = rng.choice(plants)
+    step(plant, 'received', loss=0)
+    if rng.random() < 0.08:
+        step(plant, 'rejected', loss=0)
+    else:
+        step(plant, 'processing')
+        store = rng.choice(stores)
+        step(store, 'stored')
+        if rng.random() < 0.75:
+            step(store, 'shipped', loss=0, hours=(12, 96))
+            # Geometric number of onward transfers with mean `transfers`
+            while rng.random() < transfers / (1 + transfers):
+                store = rng.choice(stores)
+                step(store, 'received', loss=0.01, hours=(2, 24))
+                step(store, 'stored', loss=0.01, hours=(1, 6))
+                step(store, 'shipped', loss=0, hours=(12, 96))
+    return [event for event in events if event[3] <= end]
+
+def _insert(table, rows):
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(table.insert(), rows[i:i + INSERT_BATCH_SIZE])
+
+def generate_data(farmers=100, plants=5, stores=10, products=10000, transfers=1.0, days=90,
+                  seed=0, end=None, progress=None):
+    """Bulk-load farmers, warehouses, products and tracking chains in one transaction.
+
+    The same arguments always produce the same rows, apart from the time window
+    ending at `end` (default: today at midnight UTC). Usernames, warehouse names
+    and product hashes are prefixed with the seed, so differently seeded sets can
+    share a database. Every generated user's password is 'password123'.
+
+    Returns a dict of inserted row counts.
+    """
+    rng = random.Random(seed)
+    end = end or datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    report = progress or (lambda message: None)
+    prefix = f'gen{seed}'
+
+    users = [dict(username=f'{prefix}_farmer{i}', email=f'{prefix}_farmer{i}@example.com', role='farmer',
+                  farm_location=f'Farm {i}', password_hash=TEST_PASSWORD_HASH) for i in range(farmers)]
+    users += [dict(username=f'{prefix}_{role}', email=f'{prefix}_{role}@example.com', role=role,
+                   farm_location=None, password_hash=TEST_PASSWORD_HASH)
+              for role in ('plant_manager', 'warehouse_manager')]
+    _insert(User.__table__, users)
+    user_ids = dict(db.session.execute(db.select(User.username, User.id).where(
+        User.username.like(f'{prefix}\\_%', escape='\\'))).all())
+    farmer_ids = [user_ids[u['username']] for u in users[:farmers]]
+    processors = {'processing': user_ids[f'{prefix}_plant_manager'],
+                  'warehouse': user_ids[f'{prefix}_warehouse_manager']}
+
+    warehouses = [dict(name=f'{prefix} Plant {i}', type='processing', location=f'Plant site {i}',
+                       capacity=1.0, current_stock=0.0) for i in range(plants)]
+    warehouses += [dict(name=f'{prefix} Warehouse {i}', type='warehouse', location=f'Depot {i}',
+                        capacity=1.0, current_stock=0.0) for i in range(stores)]
+    _insert(Warehouse.__table__, warehouses)
+    warehouse_rows = db.session.execute(db.select(Warehouse.id, Warehouse.type).where(
+        Warehouse.name.like(f'{prefix} %'))).all()
+    warehouse_types = dict(warehouse_rows)
+    plant_ids = sorted(w.id for w in warehouse_rows if w.type == 'processing')
+    store_ids = sorted(w.id for w in warehouse_rows if w.type == 'warehouse')
+    report(f'{len(users)} users, {len(warehouses)} warehouses')
+
+    types = [value for value, _ in PRODUCT_TYPES]
+    grades = [grade for grade, weight in GRADE_WEIGHTS for _ in range(weight)]
+    window = timedelta(days=days)
+    stock = dict.fromkeys(warehouse_types, 0.0)
+    tracking_count = 0
+    # Indexed for search in one pass at the end rather than row by row
+    with deferred_search_index():
+        for offset in range(0, products, INSERT_BATCH_SIZE):
+            batch = []
+            for i in range(offset, min(offset + INSERT_BATCH_SIZE, products)):
+                created = end - window * rng.random()
+                batch.append(dict(
+                    unique_hash=hashlib.sha256(f'{prefix}-product-{i}'.encode()).hexdigest(),
+                    farmer_id=rng.choice(farmer_ids), product_type=rng.choice(types),
+                    variety=None, quantity=float(rng.randint(50, 2000)), quality_grade=rng.choice(grades),
+                    created_at=created))
+            table = Product.__table__
+            product_ids = dict(db.session.execute(
+                table.insert().returning(table.c.unique_hash, table.c.id), batch).all())
+
+            trackings = []
+            for product in batch:
+                for warehouse_id, status, quantity, moment in _chain(
+                        rng, plant_ids, store_ids, product['quantity'], product['created_at'], end, transfers):
+                    stock[warehouse_id] += STOCK_EFFECTS.get(status, 0) * quantity
+                    trackings.append(dict(
+                        product_id=product_ids[product['unique_hash']], warehouse_id=warehouse_id,
+                        status=status, quantity=quantity, quality_notes=rng.choice(QUALITY_NOTES),
+                        processed_by=processors[warehouse_types[warehouse_id]], transition_date=moment))
+            _insert(ProductTracking.__table__, trackings)
+            tracking_count += len(trackings)
+            report(f'{offset + len(batch)} products, {tracking_count} tracking events')
+
+    # Stock is what the generated history leaves behind; capacity leaves a third spare
+    db.session.execute(db.update(Warehouse.__table__).where(Warehouse.__table__.c.id == db.bindparam('wid')),
+                       [dict(wid=warehouse_id, current_stock=round(amount, 1),
+                             capacity=round(max(amount * 1.5, 1000.0), 1))
+                        for warehouse_id, amount in stock.items()])
+    rebuild_product_state()
+    rebuild_rollups()
+    rebuild_stage_transitions()
+    db.session.commit()
+    report('Rebuilt product state, rollups and stage transitions')
+    return dict(users=len(users), warehouses=len(warehouses), products=products, trackings=tracking_count)
@@ -0,0 +1,121 @@
+"""Keyset-paginated tracking history of one warehouse or one product.
+
+Pages run newest first. A cursor is the (transition_date, id) of the last row
+shown, and the next page starts strictly below it, so every page is an index
+range read of at most HISTORY_PAGE_SIZE + 1 rows per table however long the
+history is. Archived rows keep their ids, so hot and archived pages merge on
+the same key.
+"""
+from datetime import datetime
+from app import db
+from app.models import ArchivedTracking, ProductTracking
+from app.product.forms import TRACKING_STATUSES
+from app.reference import users_by_id
+
+HISTORY_PAGE_SIZE = 50
+
+TRACKING_STATUS_VALUES = {status for status, _ in TRACKING_STATUSES}
+
+class CursorError(ValueError):
+    """A history cursor that this module did not produce"""
+
+def encode_cursor(tracking):
+    return f'{tracking.transition_date.isoformat()}_{tracking.id}'
+
+def decode_cursor(cursor):
+    """(transition_date, id) of a cursor, or None for the first page"""
+    if not cursor:
+        return None
+    try:
+        moment, tracking_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(moment), int(tracking_id)
+    except ValueError:
+        raise CursorError('Invalid cursor.')
+
+def history_filters(args):
+    """status, start and end (ISO 8601 dates, end exclusive) from request arguments.
+
+    Raises ValueError with a message for the user on an unknown status or a malformed date.
+    """
+    status = args.get('status') or None
+    if status is not None and status not in TRACKING_STATUS_VALUES:
+        raise ValueError('Unknown status.')
+    try:
+        start, end = (datetime.fromisoformat(args[name]) if args.get(name) else None for name in ('start', 'end'))
+    except ValueError:
+        raise ValueError('start and end must be ISO 8601 dates.')
+    return dict(status=status, start=start, end=end)
+
+def history_page(warehouse_id=None, product_id=None, cursor=None, status=None, start=None, end=None,
+                 include_archived=True, per_page=None):
+    """One page of tracking rows, newest first, and the cursor of the next page (None on the last).
+
+    Filters on one warehouse or one product, and optionally on status and on
+    transition dates in [start, end). Rows come with their product (and its
+    farmer) and warehouse loaded and their processor in the session, so a
+    template can follow them without a query per row.
+    """
+    per_page = per_page or HISTORY_PAGE_SIZE
+    after = decode_cursor(cursor)
+    rows = []
+    for model in (ProductTracking, ArchivedTracking) if include_archived else (ProductTracking,):
+        query = model.query.options(db.joinedload(model.product), db.joinedload(model.warehouse))
+        if warehouse_id is not None:
+            query = query.filter(model.warehouse_id == warehouse_id)
+        if product_id is not None:
+            query = query.filter(model.product_id == product_id)
+        if status:
+            query = query.filter(model.status == status)
+        if start:
+            query = query.filter(model.transition_date >= start)
+        if end:
+            query = query.filter(model.transition_date < end)
+        if after:
+            query = query.filter(db.tuple_(model.transition_date, model.id) < after)
+        rows += query.order_by(model.transition_date.desc(), model.id.desc()).limit(per_page + 1).all()
+    rows.sort(key=lambda t: (t.transition_date, t.id), reverse=True)
+    next_cursor = encode_cursor(rows[per_page - 1]) if len(rows) > per_page else None
+    rows = rows[:per_page]
+    users_by_id([t.processed_by for t in rows] + [t.product.farmer_id for t in rows])
+    return rows, next_cursor
+
+def newest_trackings(warehouse_ids, limit=20):
+    """The newest `limit` hot tracking rows across some warehouses, newest first, with products loaded.
+
+    Each warehouse gives at most its newest `limit` rows from its (warehouse,
+    date) index range, so rarely used warehouses cost no walk through the rest
+    of the history. One statement finds the rows and a second loads them.
+    """
+    newest = [db.select(ProductTracking.id, ProductTracking.transition_date)
+              .where(ProductTracking.warehouse_id == warehouse_id)
+              .order_by(ProductTracking.transition_date.desc(), ProductTracking.id.desc())
+              .limit(limit).subquery().select() for warehouse_id in warehouse_ids]
+    if not newest:
+        return []
+    keys = db.session.execute(db.union_all(*newest) if len(newest) > 1 else newest[0]).all()
+    ids = [tracking_id for tracking_id, _ in sorted(keys, key=lambda key: (key[1], key[0]), reverse=True)[:limit]]
+    rows = ProductTracking.query.options(db.selectinload(ProductTracking.product)).filter(
+        ProductTracking.id.in_(ids)).all()
+    return sorted(rows, key=lambda t: (t.transition_date, t.id), reverse=True)
+
+def serialize_history(tracking):
+    return dict(
+        id=tracking.id,
+        product_id=tracking.product_id,
+        product_type=tracking.product.product_type,
+        farmer=tracking.product.farmer.username,
+        warehouse_id=tracking.warehouse_id,
+        warehouse=tracking.warehouse.name,
+        status=tracking.status,
+        quantity=tracking.quantity,
+        quality_notes=tracking.quality_notes,
+        processed_by=tracking.processor.username if tracking.processor else None,
+        transition_date=tracking.transition_date.isoformat(),
+        archived=isinstance(tracking, ArchivedTracking),
+    )
+
+def product_history_summary(product_id):
+    """Number of tracking rows of a product and whether any are archived"""
+    counts = [db.session.scalar(db.select(db.func.count()).where(model.product_id == product_id))
+              for model in (ProductTracking, ArchivedTracking)]
+    return sum(counts), counts[1] > 0
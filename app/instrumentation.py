@@ -0,0 +1,197 @@
+"""Opt-in per-request SQL and timing instrumentation"""
+import threading
+import time
+from flask import Response, current_app, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+# Upper bounds (ms) of the request duration histogram buckets
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+class RequestStats:
+    """What one request spent on SQL and template rendering"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_depth = 0
+        self.render_started = None
+        self.statements = []
+
+    def add_query(self, statement, duration, keep):
+        self.queries += 1
+        self.db_time += duration
+        self.statements.append((duration, statement))
+        if len(self.statements) > keep:
+            self.statements.sort(key=lambda item: item[0], reverse=True)
+            del self.statements[keep:]
+
+    def slowest(self):
+        return sorted(self.statements, key=lambda item: item[0], reverse=True)
+
+class EndpointMetrics:
+    """Thread-safe per-endpoint counters and latency histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def observe(self, endpoint, duration_ms, queries, db_ms, render_ms):
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = dict(
+                    count=0, duration_ms=0.0, queries=0, db_ms=0.0, render_ms=0.0,
+                    buckets=[0] * len(LATENCY_BUCKETS))
+            entry['count'] += 1
+            entry['duration_ms'] += duration_ms
+            entry['queries'] += queries
+            entry['db_ms'] += db_ms
+            entry['render_ms'] += render_ms
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if duration_ms <= bound:
+                    entry['buckets'][i] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(entry, buckets=list(entry['buckets']))
+                    for endpoint, entry in self._endpoints.items()}
+
+    def exposition(self):
+        """Render the metrics in the Prometheus text format"""
+        lines = [
+            '# HELP http_request_duration_ms Request duration in milliseconds.',
+            '# TYPE http_request_duration_ms histogram',
+        ]
+        snapshot = self.snapshot()
+        for endpoint, entry in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, entry['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'http_request_duration_ms_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}')
+            lines.append(f'http_request_duration_ms_sum{{endpoint="{endpoint}"}} {entry["duration_ms"]:.3f}')
+            lines.append(f'http_request_duration_ms_count{{endpoint="{endpoint}"}} {entry["count"]}')
+        for name, key, kind, help_text in (
+            ('http_request_queries_total', 'queries', 'counter', 'SQL statements issued by requests.'),
+            ('http_request_db_ms_total', 'db_ms', 'counter', 'Milliseconds spent executing SQL.'),
+            ('http_request_render_ms_total', 'render_ms', 'counter', 'Milliseconds spent rendering templates.'),
+        ):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for endpoint, entry in sorted(snapshot.items()):
+                lines.append(f'{name}{{endpoint="{endpoint}"}} {entry[key]:g}')
+        return '\n'.join(lines) + '\n'
+
+def _header_text(value):
+    """Make a statement safe for a quoted Server-Timing description"""
+    text = ' '.join(value.split())
+    text = text.replace('\\', '').replace('"', "'")
+    return text[:80]
+
+class Instrumentation:
+    """Flask extension that times SQL and rendering for every request.
+
+    Enabled by INSTRUMENTATION_ENABLED. Adds a Server-Timing header to each
+    response, logs requests slower than SLOW_REQUEST_MS, and serves per-endpoint
+    histograms at /metrics.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION_ENABLED', False)
+        app.config.setdefault('SLOW_REQUEST_MS', 500)
+        app.config.setdefault('INSTRUMENTATION_TOP_QUERIES', 3)
+        if not app.config['INSTRUMENTATION_ENABLED']:
+            return
+
+        app.extensions['instrumentation'] = EndpointMetrics()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+
+        from app import db
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    @property
+    def metrics(self):
+        return current_app.extensions['instrumentation']
+
+    @staticmethod
+    def _stats():
+        if has_request_context():
+            return g.get('_request_stats')
+        return None
+
+    def _start_request(self):
+        g._request_stats = RequestStats()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['_query_started'].pop()
+        stats = self._stats()
+        if stats is not None:
+            stats.add_query(statement, time.perf_counter() - started,
+                            current_app.config['INSTRUMENTATION_TOP_QUERIES'])
+
+    def _handle_error(self, context):
+        # A failed statement never reaches after_cursor_execute
+        started = context.connection.info.get('_query_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    def _start_render(self, sender, template, context, **extra):
+        stats = self._stats()
+        if stats is not None:
+            # A render_template call made while another template renders is counted once
+            if stats.render_depth == 0:
+                stats.render_started = time.perf_counter()
+            stats.render_depth += 1
+
+    def _finish_render(self, sender, template, context, **extra):
+        stats = self._stats()
+        if stats is not None and stats.render_depth:
+            stats.render_depth -= 1
+            if stats.render_depth == 0:
+                stats.render_time += time.perf_counter() - stats.render_started
+
+    def _finish_request(self, response):
+        stats = self._stats()
+        if stats is None:
+            return response
+        total_ms = (time.perf_counter() - stats.started) * 1000
+        db_ms, render_ms = stats.db_time * 1000, stats.render_time * 1000
+        slowest = stats.slowest()
+
+        timings = [f'db;dur={db_ms:.1f};desc="{stats.queries} queries"',
+                   f'render;dur={render_ms:.1f}',
+                   f'total;dur={total_ms:.1f}']
+        timings.extend(f'sql{i};dur={duration * 1000:.1f};desc="{_header_text(statement)}"'
+                       for i, (duration, statement) in enumerate(slowest, 1))
+        response.headers.add('Server-Timing', ', '.join(timings))
+
+        endpoint = request.endpoint or 'unmatched'
+        self.metrics.observe(endpoint, total_ms, stats.queries, db_ms, render_ms)
+        if total_ms >= current_app.config['SLOW_REQUEST_MS']:
+            current_app.logger.warning(
+                'Slow request %s %s (%s): %.1f ms, %d queries in %.1f ms, render %.1f ms; slowest: %s',
+                request.method, request.path, endpoint, total_ms, stats.queries, db_ms, render_ms,
+                ' | '.join(f'{duration * 1000:.1f} ms {_header_text(statement)}' for duration, statement in slowest))
+        return response
+
+    def _metrics_view(self):
+        from app import cache
+        body = self.metrics.exposition()
+        stats = cache.stats()
+        for name in ('hits', 'misses', 'evictions'):
+            body += f'# TYPE cache_{name}_total counter\ncache_{name}_total {stats[name]}\n'
+        return Response(body, mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,181 @@
+"""Live dashboard updates over Server-Sent Events.
+
+Each process runs one relay thread once somebody subscribes. It wakes when a
+commit in the process records changes (or every CHANGES_POLL_INTERVAL, to
+catch other workers' commits), reads the new change_log rows once, and fans
+them out to the subscribers whose warehouse type and warehouse they match.
+The database sees one small read per real change however many screens are
+open. A subscriber that stops reading is dropped once LIVE_QUEUE_SIZE
+messages are waiting for it; its browser reconnects with Last-Event-ID and
+catches up from the change log.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# Changes read per relay pass and replayed to a reconnecting subscriber
+LIVE_BATCH_SIZE = 500
+
+class Subscription:
+    """One stream's queue of messages, filtered by warehouse type and optionally warehouse"""
+
+    def __init__(self, warehouse_type, warehouse_id, max_pending):
+        self.warehouse_type = warehouse_type
+        self.warehouse_id = warehouse_id
+        self.messages = queue.Queue(max_pending)
+        self.lagged = False
+
+    def accepts(self, message):
+        return (message['warehouse_type'] == self.warehouse_type and
+                (self.warehouse_id is None or message['warehouse_id'] == self.warehouse_id))
+
+    def get(self, timeout):
+        """Next message, or None after `timeout` seconds; raises LookupError once dropped for lagging"""
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            if self.lagged:
+                raise LookupError('Subscriber fell too far behind.')
+            return None
+
+class Broker:
+    """In-process pub/sub of live messages, with the relay that feeds it"""
+
+    def __init__(self, app, max_pending):
+        self.app = app
+        self.max_pending = max_pending
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._relay = None
+        self._relay_pid = None
+        self.last_seq = None
+        self.published = 0
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def subscribe(self, warehouse_type, warehouse_id=None):
+        """Start receiving messages committed from now on; needs an app context"""
+        from app.changes import latest_seq
+        subscription = Subscription(warehouse_type, warehouse_id, self.max_pending)
+        with self._lock:
+            if self.last_seq is None:
+                self.last_seq = latest_seq()
+            self._subscribers.add(subscription)
+            self._ensure_relay()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, messages):
+        """Hand each message to every matching subscriber without blocking"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        dropped = []
+        for subscription in subscribers:
+            for message in messages:
+                if not subscription.accepts(message):
+                    continue
+                try:
+                    subscription.messages.put_nowait(message)
+                except queue.Full:
+                    subscription.lagged = True
+                    dropped.append(subscription)
+                    break
+        with self._lock:
+            self._subscribers.difference_update(dropped)
+            self.published += len(messages)
+
+    def _ensure_relay(self):
+        # Threads do not survive a fork; each worker runs its own relay
+        if self._relay is not None and self._relay_pid == os.getpid():
+            return
+        self._relay_pid = os.getpid()
+        self._relay = threading.Thread(target=self._run_relay, name='live-relay', daemon=True)
+        self._relay.start()
+
+    def _run_relay(self):
+        from app.changes import CHANGES_POLL_INTERVAL, commit_generation, wait_for_commit
+        while True:
+            seen = commit_generation()
+            try:
+                with self.app.app_context():
+                    more = self.relay_changes()
+            except Exception:
+                logger.exception('Relaying live dashboard updates failed')
+                more = False
+            if not more:
+                wait_for_commit(seen, CHANGES_POLL_INTERVAL)
+
+    def relay_changes(self):
+        """Publish changes committed since the last pass; True if there may be more waiting"""
+        from app.changes import read_changes
+        with self._lock:
+            if not self._subscribers:
+                # The next subscriber starts from the changes committed after it arrives
+                self.last_seq = None
+                return False
+        changes = read_changes(self.last_seq, LIVE_BATCH_SIZE)
+        if changes:
+            self.publish(live_messages(changes))
+            self.last_seq = changes[-1].seq
+        return len(changes) == LIVE_BATCH_SIZE
+
+def live_messages(changes):
+    """Dashboard messages for tracking events and stock changes, labelled for display"""
+    from app import db
+    from app.models import Product, User, Warehouse
+    relevant = [change for change in changes if (change.entity, change.action) in
+                (('tracking', 'created'), ('warehouse', 'stock'))]
+    warehouse_ids = {change.data['warehouse_id'] if change.entity == 'tracking' else change.entity_id
+                     for change in relevant}
+    product_ids = {change.data['product_id'] for change in relevant if change.entity == 'tracking'}
+    warehouses = {row.id: row for row in db.session.execute(
+        db.select(Warehouse.id, Warehouse.name, Warehouse.type, Warehouse.capacity)
+        .where(Warehouse.id.in_(warehouse_ids)))} if warehouse_ids else {}
+    products = {row.id: row for row in db.session.execute(
+        db.select(Product.id, Product.product_type, User.username)
+        .join(User, User.id == Product.farmer_id).where(Product.id.in_(product_ids)))} if product_ids else {}
+
+    messages = []
+    for change in relevant:
+        if change.entity == 'tracking':
+            warehouse, product = warehouses[change.data['warehouse_id']], products[change.data['product_id']]
+            data = dict(tracking_id=change.entity_id, product_id=product.id, product_type=product.product_type,
+                        farmer=product.username, warehouse_id=warehouse.id, warehouse=warehouse.name,
+                        status=change.data['status'], quantity=change.data['quantity'],
+                        transition_date=change.data['transition_date'])
+            event = 'tracking'
+        else:
+            warehouse = warehouses[change.entity_id]
+            data = dict(warehouse_id=warehouse.id, current_stock=change.data['current_stock'],
+                        capacity=warehouse.capacity)
+            event = 'stock'
+        messages.append(dict(seq=change.seq, event=event, warehouse_id=warehouse.id,
+                             warehouse_type=warehouse.type, data=data))
+    return messages
+
+def format_event(message):
+    """One message in the text/event-stream format"""
+    return f"id: {message['seq']}\nevent: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+
+class LiveUpdates:
+    """Flask extension giving each app its live update broker"""
+
+    def init_app(self, app):
+        app.config.setdefault('LIVE_QUEUE_SIZE', 100)
+        app.config.setdefault('LIVE_KEEPALIVE', 15)
+        app.extensions['live'] = Broker(app, app.config['LIVE_QUEUE_SIZE'])
+
+    @property
+    def broker(self):
+        return current_app.extensions['live']
@@ -1,11 +1,20 @@
 import hashlib
+import hmac
+import secrets
 from datetime import datetime
+from flask import current_app
 from flask_login import UserMixin
 from app import db, login_manager
 
+def trace_hash(product_id):
+    """The public trace hash of a product: HMAC-SHA256 of its id, keyed with TRACE_HASH_KEY"""
+    key = current_app.config['TRACE_HASH_KEY'] or current_app.config['SECRET_KEY']
+    return hmac.new(key.encode(), f'product-{product_id}'.encode(), hashlib.sha256).hexdigest()
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    from app.reference import cached_user
+    return cached_user(int(user_id))
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -20,12 +29,12 @@ class User(UserMixin, db.Model):
     products = db.relationship('Product', backref='farmer', lazy=True)
 
     def set_password(self, password):
-        from app import bcrypt
-        self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        from app.passwords import hash_password
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        from app import bcrypt
-        return bcrypt.check_password_hash(self.password_hash, password)
+        from app.passwords import check_password
+        return check_password(self.password_hash, password)
 
     def __repr__(self):
         return f"User('{self.username}', '{self.email}', '{self.role}')"
@@ -33,9 +42,9 @@ class User(UserMixin, db.Model):
 class Warehouse(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    type = db.Column(db.String(20), nullable=False)  # processing or warehouse
+    type = db.Column(db.String(20), nullable=False, index=True)  # processing or warehouse
     location = db.Column(db.String(200), nullable=False)
-    capacity = db.Column(db.Float, nullable=False)  # in tons
+    capacity = db.Column(db.Float, nullable=False)  # in kg, the unit of current_stock and tracking quantities
     current_stock = db.Column(db.Float, default=0.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -48,7 +57,7 @@ class Warehouse(db.Model):
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     unique_hash = db.Column(db.String(64), unique=True, nullable=False)
-    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     product_type = db.Column(db.String(50), nullable=False)  # tomato, potato, etc.
     variety = db.Column(db.String(50))
     quantity = db.Column(db.Float, nullable=False)  # in kg
@@ -59,14 +68,35 @@ class Product(db.Model):
     trackings = db.relationship('ProductTracking', backref='product', lazy=True, cascade='all, delete-orphan')
 
     def generate_hash(self):
-        """Generate unique hash based on farmer, type, quantity, and timestamp"""
-        hash_input = f"{self.farmer_id}-{self.product_type}-{self.quantity}-{self.created_at}"
-        self.unique_hash = hashlib.sha256(hash_input.encode()).hexdigest()
+        """Set the traceability hash, trace_hash of the product's id.
+
+        Ids are unique, so hashes are too, and the same id and key always give
+        the same hash; without the key they cannot be guessed for the public
+        trace page. A product without an id yet is added and flushed under a
+        random placeholder, as unique_hash may not be null.
+        """
+        if self.created_at is None:
+            self.created_at = datetime.utcnow()
+        if self.id is None:
+            self.unique_hash = secrets.token_hex(32)
+            db.session.add(self)
+            db.session.flush()
+        self.unique_hash = trace_hash(self.id)
 
     def __repr__(self):
         return f"Product('{self.unique_hash}', '{self.product_type}', {self.quantity}kg)"
 
 class ProductTracking(db.Model):
+    __table_args__ = (
+        # History of one product or one warehouse, newest first
+        db.Index('ix_product_tracking_product_date', 'product_id', 'transition_date'),
+        db.Index('ix_product_tracking_warehouse_date', 'warehouse_id', 'transition_date'),
+        # One warehouse's history filtered by status (warehouse page)
+        db.Index('ix_product_tracking_warehouse_status_date', 'warehouse_id', 'status', 'transition_date'),
+        # Recent activity across many products/warehouses (dashboards)
+        db.Index('ix_product_tracking_transition_date', 'transition_date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
@@ -75,9 +105,169 @@ class ProductTracking(db.Model):
     quality_notes = db.Column(db.Text)
     transition_date = db.Column(db.DateTime, default=datetime.utcnow)
     processed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    idempotency_key = db.Column(db.String(64), unique=True)  # Client-supplied, lets scanners retry safely
 
     # Relationships
     processor = db.relationship('User', backref='processed_trackings', lazy=True)
 
+    @classmethod
+    def latest_per_product(cls, product_ids=None):
+        """Subquery of each product's most recent tracking row, archived history included"""
+        history = tracking_history(
+            (lambda model: model.product_id.in_(product_ids)) if product_ids is not None else None)
+        rank = db.func.row_number().over(
+            partition_by=history.c.product_id,
+            order_by=(history.c.transition_date.desc(), history.c.id.desc())
+        ).label('rank')
+        ranked = db.select(history.c.id, history.c.product_id, history.c.warehouse_id, history.c.status,
+                           history.c.quantity, history.c.transition_date, rank).subquery()
+        return db.select(*[c for c in ranked.c if c.name != 'rank']).where(ranked.c.rank == 1).subquery()
+
     def __repr__(self):
         return f"ProductTracking('{self.status}', {self.quantity}kg, '{self.transition_date}')"
+
+class ArchivedTracking(db.Model):
+    """Tracking rows of finished product chains, moved out of product_tracking by the archive job.
+
+    Rows keep their ProductTracking ids and idempotency keys, so an event
+    replayed after its chain was archived is still recognised.
+    """
+    __table_args__ = (
+        db.Index('ix_archived_tracking_product_date', 'product_id', 'transition_date'),
+        db.Index('ix_archived_tracking_warehouse_date', 'warehouse_id', 'transition_date'),
+        db.Index('ix_archived_tracking_warehouse_status_date', 'warehouse_id', 'status', 'transition_date'),
+        db.Index('ix_archived_tracking_transition_date', 'transition_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
+    status = db.Column(db.String(50), nullable=False)
+    quantity = db.Column(db.Float, nullable=False)
+    quality_notes = db.Column(db.Text)
+    transition_date = db.Column(db.DateTime, nullable=False)
+    processed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    idempotency_key = db.Column(db.String(64), unique=True)
+
+    # Relationships, named as on ProductTracking so templates can show either
+    product = db.relationship('Product', lazy=True)
+    warehouse = db.relationship('Warehouse', lazy=True)
+    processor = db.relationship('User', lazy=True)
+
+    def __repr__(self):
+        return f"ArchivedTracking('{self.status}', {self.quantity}kg, '{self.transition_date}')"
+
+# Columns shared by the hot and archived tracking tables
+TRACKING_HISTORY_COLUMNS = ('id', 'product_id', 'warehouse_id', 'status', 'quantity', 'quality_notes',
+                            'transition_date', 'processed_by')
+
+def tracking_history(where=None):
+    """Hot and archived tracking rows as one UNION ALL subquery.
+
+    where(model) returns the filter for one side; filtering each side lets
+    both use their own indexes, which a filter on the union would not.
+    """
+    selects = []
+    for model in (ProductTracking, ArchivedTracking):
+        select = db.select(*[getattr(model, name) for name in TRACKING_HISTORY_COLUMNS])
+        if where is not None:
+            select = select.where(where(model))
+        selects.append(select)
+    return db.union_all(*selects).subquery('tracking_history')
+
+class ProductState(db.Model):
+    """Latest tracking state per product, maintained alongside every tracking write"""
+    __table_args__ = (
+        # Products on hand per warehouse and status (warehouse list)
+        db.Index('ix_product_state_warehouse_status', 'warehouse_id', 'status'),
+    )
+
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    tracking_id = db.Column(db.Integer, nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
+    status = db.Column(db.String(50), nullable=False, index=True)
+    quantity = db.Column(db.Float, nullable=False)
+    transition_date = db.Column(db.DateTime, nullable=False)
+
+    # Relationships
+    product = db.relationship('Product', backref=db.backref('state', uselist=False, lazy=True))
+    warehouse = db.relationship('Warehouse', lazy=True)
+
+    def __repr__(self):
+        return f"ProductState({self.product_id}, '{self.status}', {self.quantity}kg)"
+
+class TrackingRollup(db.Model):
+    """Tracked kg and event counts per time bucket, warehouse, status and product type"""
+    granularity = db.Column(db.String(4), primary_key=True)  # hour or day
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    status = db.Column(db.String(50), primary_key=True)
+    product_type = db.Column(db.String(50), primary_key=True)
+    quantity = db.Column(db.Float, nullable=False, default=0.0)
+    events = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"TrackingRollup('{self.granularity}', '{self.bucket_start}', '{self.status}', {self.quantity}kg)"
+
+class StageTransition(db.Model):
+    """One tracking event paired with the product's previous event, for yield and dwell analysis.
+
+    The stage is attributed to the warehouse the product was in before the event.
+    A product's first event has no previous one and only counts the product.
+    """
+    __table_args__ = (
+        db.Index('ix_stage_transition_ended_at', 'ended_at'),
+    )
+
+    tracking_id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    product_type = db.Column(db.String(50), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
+    from_status = db.Column(db.String(50))
+    to_status = db.Column(db.String(50), nullable=False)
+    input_quantity = db.Column(db.Float)
+    output_quantity = db.Column(db.Float, nullable=False)
+    dwell_seconds = db.Column(db.Float)
+    ended_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"StageTransition({self.product_id}, '{self.from_status}' -> '{self.to_status}')"
+
+class ChangeLog(db.Model):
+    """Append-only feed of product, tracking and warehouse stock changes for downstream sync.
+
+    Rows are written in the transaction that makes the change; seq is the
+    consumers' cursor. AUTOINCREMENT keeps SQLite from ever reusing a seq.
+    """
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)  # product, tracking, warehouse
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)  # created, stock
+    data = db.Column(db.JSON, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"ChangeLog({self.seq}, '{self.entity}' {self.entity_id} {self.action})"
+
+class ApiToken(db.Model):
+    """Bearer token of a machine client, acting as one user with that user's role.
+
+    Only a keyed hash of the token is stored; the token itself is shown once,
+    when it is issued.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+    role = db.Column(db.String(20), nullable=False)
+    prefix = db.Column(db.String(12), nullable=False)  # shown to tell tokens apart
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    revoked_at = db.Column(db.DateTime, index=True)  # counted by every worker's revocation check
+
+    user = db.relationship('User', lazy=True)
+
+    def __repr__(self):
+        return f"ApiToken({self.id}, '{self.name}', '{self.prefix}...')"
@@ -0,0 +1,95 @@
+"""Password hashing on a bounded pool of threads.
+
+bcrypt is meant to be slow: at the default cost of 12 one hash takes a few
+hundred milliseconds of CPU. The hashing runs on PASSWORD_HASH_WORKERS pool
+threads (bcrypt releases the GIL), so a burst of sign-ins can only take that
+many cores and leaves the rest for other routes. At most PASSWORD_HASH_BACKLOG
+more hashes wait for a thread; beyond that a caller waits up to
+PASSWORD_HASH_WAIT seconds for room and then gets PasswordBusyError.
+
+BCRYPT_LOG_ROUNDS sets the cost of new hashes. Stored hashes of another cost
+still verify, and the login route rehashes them at the configured cost.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+class PasswordBusyError(Exception):
+    """No password hashing slot came free within PASSWORD_HASH_WAIT"""
+
+class HashingPool:
+    """Threads running bcrypt for one app, with a bounded queue in front of them"""
+
+    def __init__(self, workers, backlog, wait):
+        self.workers = workers
+        self.backlog = backlog
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(workers + backlog)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self.stats = dict(completed=0, busy=0)
+
+    def _pool(self):
+        # Threads do not survive a fork; each worker process starts its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hash')
+            return self._executor
+
+    def run(self, function, *args):
+        """Call function(*args) on a pool thread and return its result"""
+        if not self._slots.acquire(timeout=self.wait):
+            with self._lock:
+                self.stats['busy'] += 1
+            raise PasswordBusyError('Too many passwords are being checked at once.')
+        try:
+            future = self._pool().submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+        return future.result()
+
+    def _done(self, future):
+        with self._lock:
+            self.stats['completed'] += 1
+        self._slots.release()
+
+    def status(self):
+        with self._lock:
+            return dict(self.stats, workers=self.workers, backlog=self.backlog)
+
+def _pool():
+    return current_app.extensions['password_hashing']
+
+def hash_password(password):
+    """bcrypt hash of password at the configured cost"""
+    from app import bcrypt
+    rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+    return _pool().run(bcrypt.generate_password_hash, password, rounds).decode('utf-8')
+
+def check_password(password_hash, password):
+    from app import bcrypt
+    return _pool().run(bcrypt.check_password_hash, password_hash, password)
+
+def hash_rounds(password_hash):
+    """The cost a bcrypt hash was made with, or None if it is not one"""
+    parts = password_hash.split('$')
+    return int(parts[2]) if len(parts) == 4 and parts[2].isdigit() else None
+
+def needs_rehash(password_hash):
+    return hash_rounds(password_hash) != current_app.config['BCRYPT_LOG_ROUNDS']
+
+class PasswordHashing:
+    """Flask extension giving each app its password hashing pool"""
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2))
+        app.config.setdefault('PASSWORD_HASH_BACKLOG', 32)
+        app.config.setdefault('PASSWORD_HASH_WAIT', 5.0)
+        app.extensions['password_hashing'] = HashingPool(app.config['PASSWORD_HASH_WORKERS'],
+                                                         app.config['PASSWORD_HASH_BACKLOG'],
+                                                         app.config['PASSWORD_HASH_WAIT'])
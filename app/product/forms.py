@@ -1,36 +1,48 @@
+import math
 from flask_wtf import FlaskForm
 from wtforms import StringField, FloatField, SelectField, TextAreaField, SubmitField
-from wtforms.validators import DataRequired, NumberRange
+from wtforms.validators import DataRequired, NumberRange, StopValidation
+
+PRODUCT_TYPES = [
+    ('tomato', 'Tomato'),
+    ('potato', 'Potato'),
+    ('carrot', 'Carrot'),
+    ('lettuce', 'Lettuce'),
+    ('spinach', 'Spinach'),
+    ('cucumber', 'Cucumber'),
+    ('pepper', 'Pepper'),
+    ('onion', 'Onion')
+]
+
+QUALITY_GRADES = [
+    ('A', 'Grade A - Premium'),
+    ('B', 'Grade B - Standard'),
+    ('C', 'Grade C - Below Standard')
+]
+
+TRACKING_STATUSES = [
+    ('received', 'Received'),
+    ('processing', 'Processing'),
+    ('stored', 'Stored'),
+    ('shipped', 'Shipped'),
+    ('rejected', 'Rejected')
+]
+
+def finite(form, field):
+    """NumberRange lets "inf" through"""
+    if field.data is not None and not math.isfinite(field.data):
+        raise StopValidation('Must be a finite number.')
 
 class ProductForm(FlaskForm):
-    product_type = SelectField('Product Type', choices=[
-        ('tomato', 'Tomato'),
-        ('potato', 'Potato'),
-        ('carrot', 'Carrot'),
-        ('lettuce', 'Lettuce'),
-        ('spinach', 'Spinach'),
-        ('cucumber', 'Cucumber'),
-        ('pepper', 'Pepper'),
-        ('onion', 'Onion')
-    ], validators=[DataRequired()])
+    product_type = SelectField('Product Type', choices=PRODUCT_TYPES, validators=[DataRequired()])
     variety = StringField('Variety')
-    quantity = FloatField('Quantity (kg)', validators=[DataRequired(), NumberRange(min=0.1)])
-    quality_grade = SelectField('Quality Grade', choices=[
-        ('A', 'Grade A - Premium'),
-        ('B', 'Grade B - Standard'),
-        ('C', 'Grade C - Below Standard')
-    ], default='A', validators=[DataRequired()])
+    quantity = FloatField('Quantity (kg)', validators=[DataRequired(), finite, NumberRange(min=0.1)])
+    quality_grade = SelectField('Quality Grade', choices=QUALITY_GRADES, default='A', validators=[DataRequired()])
     submit = SubmitField('Add Product')
 
 class ProductTrackingForm(FlaskForm):
     warehouse_id = SelectField('Warehouse/Processing Plant', coerce=int, validators=[DataRequired()])
-    status = SelectField('Status', choices=[
-        ('received', 'Received'),
-        ('processing', 'Processing'),
-        ('stored', 'Stored'),
-        ('shipped', 'Shipped'),
-        ('rejected', 'Rejected')
-    ], validators=[DataRequired()])
-    quantity = FloatField('Quantity (kg)', validators=[DataRequired(), NumberRange(min=0.1)])
+    status = SelectField('Status', choices=TRACKING_STATUSES, validators=[DataRequired()])
+    quantity = FloatField('Quantity (kg)', validators=[DataRequired(), finite, NumberRange(min=0.1)])
     quality_notes = TextAreaField('Quality Notes/Comments')
     submit = SubmitField('Update Tracking')
@@ -1,21 +1,74 @@
-from flask import render_template, request, flash, redirect, url_for, Blueprint
+from flask import render_template, request, flash, redirect, url_for, Blueprint, abort
 from flask_login import login_required, current_user
-from app import db
-from app.models import Product, ProductTracking, Warehouse, User
-from app.product.forms import ProductForm, ProductTrackingForm
+from sqlalchemy.orm import joinedload, contains_eager
+from app import db, cache, write_behind
+from app.cache import farmer_tag, warehouse_type_tag
+from app.models import Product, ProductState, User
+from app.tracking import record_tracking, StockError
+from app.writebehind import QueueFullError
+from app.changes import record_product_created
+from app.reference import users_by_id, warehouse_choices, warehouse_refs
+from app.history import CursorError, history_filters, history_page, product_history_summary
+from app.search import search, search_available, SEARCH_PER_PAGE, SEARCH_MAX_PAGE
+from app.product.forms import (ProductForm, ProductTrackingForm, PRODUCT_TYPES,
+                               QUALITY_GRADES, TRACKING_STATUSES)
 from datetime import datetime
 
 product = Blueprint('product', __name__)
 
+PRODUCTS_PER_PAGE = 50
+
 @product.route('/products')
 @login_required
 def list_products():
-    if current_user.role == 'farmer':
-        products = Product.query.filter_by(farmer_id=current_user.id).all()
+    filters = {name: request.args.get(name, '') for name in ('status', 'product_type', 'quality_grade')}
+    after = request.args.get('after', type=int)
+
+    # Page on whichever key the filter's index is ordered by
+    key = Product.id
+    if filters['status'] and filters['status'] != 'pending':
+        query = Product.query.join(ProductState).filter(ProductState.status == filters['status'])
+        key = ProductState.product_id
     else:
-        products = Product.query.all()
-
-    return render_template('product/list.html', products=products)
+        query = Product.query.outerjoin(ProductState)
+        if filters['status'] == 'pending':
+            query = query.filter(ProductState.product_id.is_(None))
+    query = query.options(joinedload(Product.farmer), contains_eager(Product.state))
+    if current_user.role == 'farmer':
+        query = query.filter(Product.farmer_id == current_user.id)
+    if filters['product_type']:
+        query = query.filter(Product.product_type == filters['product_type'])
+    if filters['quality_grade']:
+        query = query.filter(Product.quality_grade == filters['quality_grade'])
+
+    # Keyset pagination: newest first, resuming below the last id of the previous page
+    if after:
+        query = query.filter(key < after)
+    products = query.order_by(key.desc()).limit(PRODUCTS_PER_PAGE + 1).all()
+    next_cursor = products[PRODUCTS_PER_PAGE - 1].id if len(products) > PRODUCTS_PER_PAGE else None
+    products = products[:PRODUCTS_PER_PAGE]
+
+    return render_template('product/list.html', products=products,
+                           filters=filters,
+                           active_filters={k: v for k, v in filters.items() if v},
+                           next_cursor=next_cursor, after=after,
+                           product_types=PRODUCT_TYPES, quality_grades=QUALITY_GRADES,
+                           statuses=TRACKING_STATUSES)
+
+@product.route('/products/search')
+@login_required
+def search_products():
+    query = request.args.get('q', '').strip()
+    page = min(max(request.args.get('page', 1, type=int), 1), SEARCH_MAX_PAGE)
+    results, next_page = [], None
+    if query and search_available():
+        farmer_id = current_user.id if current_user.role == 'farmer' else None
+        results = search(query, SEARCH_PER_PAGE + 1, (page - 1) * SEARCH_PER_PAGE, farmer_id=farmer_id)
+        if len(results) > SEARCH_PER_PAGE and page < SEARCH_MAX_PAGE:
+            next_page = page + 1
+        results = results[:SEARCH_PER_PAGE]
+    return render_template('product/search.html', title='Search', query=query, page=page,
+                           results=results, next_page=next_page, available=search_available())
 
 @product.route('/product/new', methods=['GET', 'POST'])
 @login_required
@@ -35,7 +88,10 @@ def new_product():
         )
         product.generate_hash()
         db.session.add(product)
+        db.session.flush()
+        record_product_created(product)
         db.session.commit()
+        cache.invalidate(farmer_tag(current_user.id))
         flash('Product has been added successfully!', 'success')
         return redirect(url_for('product.list_products'))
     return render_template('product/new.html', title='New Product', form=form)
@@ -48,10 +104,38 @@ def view_product(product_id):
         flash('You can only view your own products.', 'danger')
         return redirect(url_for('dashboard.index'))
 
-    trackings = ProductTracking.query.filter_by(product_id=product_id).order_by(
-        ProductTracking.transition_date.desc()).all()
-
-    return render_template('product/view.html', product=product, trackings=trackings)
+    try:
+        filters = history_filters(request.args)
+    except ValueError as e:
+        flash(str(e), 'warning')
+        filters = dict(status=None, start=None, end=None)
+    try:
+        trackings, next_cursor = history_page(product_id=product_id, cursor=request.args.get('after'), **filters)
+    except CursorError:
+        abort(400)
+    total, archived = product_history_summary(product_id)
+    users_by_id([product.farmer_id])
+
+    return render_template('product/view.html', product=product, trackings=trackings, next_cursor=next_cursor,
+                           after=request.args.get('after'), filters=filters, total=total, archived=archived,
+                           statuses=TRACKING_STATUSES)
+
+def queue_tracking(product, form):
+    """Hand a validated tracking form to the write-behind queue"""
+    try:
+        write_behind.submit(dict(
+            product_id=product.id,
+            warehouse_id=form.warehouse_id.data,
+            status=form.status.data,
+            quantity=form.quantity.data,
+            quality_notes=form.quality_notes.data,
+            processed_by=current_user.id
+        ))
+    except QueueFullError:
+        flash('Tracking updates are backed up, please try again in a moment.', 'warning')
+        return render_template('product/track.html', title='Track Product', form=form, product=product), 503
+    flash('Product tracking update queued; it will show here within moments.', 'success')
+    return redirect(url_for('product.view_product', product_id=product.id))
 
 @product.route('/product/<int:product_id>/track', methods=['GET', 'POST'])
 @login_required
@@ -64,30 +148,31 @@ def track_product(product_id):
         return redirect(url_for('product.view_product', product_id=product_id))
 
     form = ProductTrackingForm()
-    form.warehouse_id.choices = [(w.id, f"{w.name} ({w.type})") for w in Warehouse.query.all()]
+    form.warehouse_id.choices = warehouse_choices()
+    users_by_id([product.farmer_id])
 
     if form.validate_on_submit():
-        tracking = ProductTracking(
-            product_id=product_id,
-            warehouse_id=form.warehouse_id.data,
-            status=form.status.data,
-            quantity=form.quantity.data,
-            quality_notes=form.quality_notes.data,
-            processed_by=current_user.id
-        )
-        db.session.add(tracking)
-        db.session.commit()
-
-        # Update warehouse stock
-        warehouse = Warehouse.query.get(form.warehouse_id.data)
-        if form.status.data in ['stored', 'processing']:
-            warehouse.current_stock += form.quantity.data
-        elif form.status.data == 'shipped':
-            warehouse.current_stock -= form.quantity.data
-
-        db.session.commit()
-
-        flash('Product tracking updated successfully!', 'success')
-        return redirect(url_for('product.view_product', product_id=product_id))
+        if write_behind.enabled:
+            return queue_tracking(product, form)
+        # Dashboards showing this product or warehouse; read now, before the commit expires them
+        tags = [farmer_tag(product.farmer_id),
+                warehouse_type_tag(warehouse_refs()[form.warehouse_id.data].type)]
+        try:
+            record_tracking(
+                product_id=product_id,
+                warehouse_id=form.warehouse_id.data,
+                status=form.status.data,
+                quantity=form.quantity.data,
+                quality_notes=form.quality_notes.data,
+                processed_by=current_user.id
+            )
+            db.session.commit()
+        except StockError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+        else:
+            cache.invalidate(*tags)
+            flash('Product tracking updated successfully!', 'success')
+            return redirect(url_for('product.view_product', product_id=product_id))
 
     return render_template('product/track.html', title='Track Product', form=form, product=product)
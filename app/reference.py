@@ -0,0 +1,117 @@
+"""In-process cache of the small, rarely changing reference tables.
+
+Warehouses and users are read on nearly every request: the tracking form lists
+every warehouse, flask-login loads the current user, and templates show who
+grew or processed a product. Entries are keyed by a per-table version, so
+invalidating a table is one increment and stale entries simply age out of the
+LRU. Each worker keeps its own copy; one that did not make a change sees it
+after REFERENCE_CACHE_TTL seconds at the latest.
+
+Cached warehouses leave out current_stock, which changes with every tracking
+event, so stock updates never invalidate them.
+"""
+import threading
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+from app.cache import MemoryCache
+
+REFERENCE_TABLES = ('users', 'warehouses')
+
+class ReferenceCache:
+    """Versioned entries of the reference tables of one app"""
+
+    def __init__(self, max_entries, ttl):
+        self.entries = MemoryCache(max_entries=max_entries, default_ttl=ttl)
+        self._versions = dict.fromkeys(REFERENCE_TABLES, 0)
+        self._lock = threading.Lock()
+
+    def _key(self, table, key):
+        with self._lock:
+            return f'{table}:{self._versions[table]}:{key}'
+
+    def get(self, table, key):
+        return self.entries.get(self._key(table, key))
+
+    def set(self, table, key, value):
+        self.entries.set(self._key(table, key), value)
+
+    def invalidate(self, *tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.entries.stats(), versions=dict(self._versions))
+
+def _reference():
+    return current_app.extensions['reference']
+
+def invalidate_reference(*tables):
+    """Drop this worker's cached rows of the given tables; call after committing a change"""
+    _reference().invalidate(*tables)
+
+def warehouse_refs():
+    """Every warehouse's id, name, type, location and capacity, by id"""
+    from app import db
+    from app.models import Warehouse
+    reference = _reference()
+    found, warehouses = reference.get('warehouses', 'all')
+    if not found:
+        rows = db.session.execute(db.select(
+            Warehouse.id, Warehouse.name, Warehouse.type, Warehouse.location, Warehouse.capacity
+        ).order_by(Warehouse.id)).all()
+        warehouses = {row.id: row for row in rows}
+        reference.set('warehouses', 'all', warehouses)
+    return warehouses
+
+def warehouse_choices():
+    """Select field choices listing every warehouse"""
+    return [(w.id, f'{w.name} ({w.type})') for w in warehouse_refs().values()]
+
+def users_by_id(user_ids):
+    """Users attached to the current session, by id, querying only for ones not cached.
+
+    Lazy loads of Product.farmer and ProductTracking.processor find these in
+    the session's identity map, so templates can follow them without a query.
+    The identity map only holds objects weakly, so the session keeps the
+    merged users in its info for as long as it lives.
+    """
+    from app import db
+    from app.models import User
+    reference = _reference()
+    session = db.session()
+    held = session.info.setdefault('reference_users', {})
+    users, missing = {}, []
+    for user_id in set(user_ids) - {None}:
+        # One already in the session may have unflushed changes; it is the one to use
+        user = session.identity_map.get(session.identity_key(User, user_id))
+        if user is None:
+            found, user = reference.get('users', user_id)
+            if not found:
+                missing.append(user_id)
+                continue
+            user = session.merge(user, load=False)
+        users[user_id] = user
+    if missing:
+        rows = session.execute(db.select(*User.__table__.columns).where(User.id.in_(missing)))
+        for row in rows:
+            # Built detached rather than loaded, so the cached copy never belongs to a session
+            user = User(**row._mapping)
+            make_transient_to_detached(user)
+            reference.set('users', user.id, user)
+            users[user.id] = session.merge(user, load=False)
+    held.update(users)
+    return users
+
+def cached_user(user_id):
+    return users_by_id([user_id]).get(user_id)
+
+class ReferenceData:
+    """Flask extension giving each app its reference cache"""
+
+    def init_app(self, app):
+        app.config.setdefault('REFERENCE_CACHE_TTL', 60)
+        app.config.setdefault('REFERENCE_CACHE_MAX_ENTRIES', 4096)
+        app.extensions['reference'] = ReferenceCache(app.config['REFERENCE_CACHE_MAX_ENTRIES'],
+                                                     app.config['REFERENCE_CACHE_TTL'])
@@ -0,0 +1,175 @@
+"""Full-text search over product types and varieties and tracking quality notes.
+
+On SQLite the text is indexed by FTS5 tables that point back at the product,
+product_tracking and archived_tracking rows (external content) and are kept in step by triggers, so
+ORM writes, Core bulk inserts and cascading deletes all update the index.
+"""
+import re
+from contextlib import contextmanager
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, event, text
+from app import db
+from app.models import Product, ProductTracking, ArchivedTracking, ProductState, User, Warehouse, tracking_history
+
+# FTS table -> (content table, indexed columns)
+SEARCH_TABLES = {
+    'product_search': ('product', ('product_type', 'variety')),
+    'tracking_search': ('product_tracking', ('quality_notes',)),
+    'archive_search': ('archived_tracking', ('quality_notes',)),
+}
+
+SEARCH_PER_PAGE = 20
+# Ranked results have no cursor to resume from, and deep pages rescore every match
+SEARCH_MAX_PAGE = 50
+
+# Snippet match markers; control characters cannot come from form input
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+def search_ddl(name):
+    """CREATE statements for one FTS table and the triggers that keep it current"""
+    source, columns = SEARCH_TABLES[name]
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    old_values = ', '.join(f'old.{column}' for column in columns)
+    delete = (f"INSERT INTO {name}({name}, rowid, {column_list}) "
+              f"VALUES ('delete', old.id, {old_values});")
+    insert = f'INSERT INTO {name}(rowid, {column_list}) VALUES (new.id, {new_values});'
+    # porter stemming lets 'bruised' find 'bruising'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({column_list}, content='{source}', "
+        f"content_rowid='id', tokenize='porter unicode61')",
+        f'CREATE TRIGGER IF NOT EXISTS {name}_ai AFTER INSERT ON {source} BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {name}_ad AFTER DELETE ON {source} BEGIN {delete} END',
+        f'CREATE TRIGGER IF NOT EXISTS {name}_au AFTER UPDATE OF {column_list} ON {source} '
+        f'BEGIN {delete} {insert} END',
+    ]
+
+def _attach_search_ddl(table, name):
+    for statement in search_ddl(name):
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    # The triggers go with their table, the FTS table has to be dropped explicitly
+    event.listen(table, 'before_drop', DDL(f'DROP TABLE IF EXISTS {name}').execute_if(dialect='sqlite'))
+
+_attach_search_ddl(Product.__table__, 'product_search')
+_attach_search_ddl(ProductTracking.__table__, 'tracking_search')
+_attach_search_ddl(ArchivedTracking.__table__, 'archive_search')
+
+def search_available():
+    return db.engine.dialect.name == 'sqlite'
+
+def rebuild_search_index():
+    """Create missing FTS tables and triggers, then reindex everything from the content tables.
+
+    Returns {fts table: indexed rows}.
+    """
+    counts = {}
+    for name, (source, _) in SEARCH_TABLES.items():
+        for statement in search_ddl(name):
+            db.session.execute(text(statement))
+        db.session.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+        db.session.execute(text(f"INSERT INTO {name}({name}) VALUES ('optimize')"))
+        counts[name] = db.session.scalar(text(f'SELECT count(*) FROM {source}'))
+    return counts
+
+@contextmanager
+def deferred_search_index():
+    """Drop the sync triggers for a bulk load and rebuild the index in one pass afterwards.
+
+    Reindexing at the end is an order of magnitude cheaper than the per-row triggers.
+    """
+    if not search_available():
+        yield
+        return
+    for name in SEARCH_TABLES:
+        for suffix in ('ai', 'ad', 'au'):
+            db.session.execute(text(f'DROP TRIGGER IF EXISTS {name}_{suffix}'))
+    try:
+        yield
+    finally:
+        # On error too, or every later write would silently miss the index
+        rebuild_search_index()
+
+def match_expression(query):
+    """FTS5 query requiring every word of free text, the last one as a prefix; None if no words"""
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return None
+    # Quoted, so words like AND, OR and NEAR are not operators
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+def highlight(snippet):
+    """Escape a snippet and turn its match markers into <mark> tags"""
+    return Markup(str(escape(snippet)).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>'))
+
+def search(query, limit, offset=0, farmer_id=None):
+    """Best matching products and tracking notes, most relevant first.
+
+    Returns a list of dicts with a 'kind' of 'product' or 'tracking', at most
+    `limit` long. `farmer_id` restricts matches to that farmer's products.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    product_join = farmer_filter = ''
+    tracking_joins = {'tracking_search': '', 'archive_search': ''}
+    if farmer_id is not None:
+        product_join = 'JOIN product ON product.id = product_search.rowid'
+        tracking_joins = {name: (f'JOIN {SEARCH_TABLES[name][0]} AS tracking ON tracking.id = {name}.rowid '
+                                 'JOIN product ON product.id = tracking.product_id')
+                          for name in tracking_joins}
+        farmer_filter = 'AND product.farmer_id = :farmer_id'
+    # Archived notes rank alongside hot ones; tracking ids are unique across both tables
+    tracking_branches = ''.join(f"""
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'tracking' AS kind, {name}.rowid AS id, bm25({name}) AS score,
+                       snippet({name}, 0, :start, :end, '…', 12) AS snippet
+                FROM {name} {join}
+                WHERE {name} MATCH :expression {farmer_filter}
+                ORDER BY score LIMIT :window)""" for name, join in tracking_joins.items())
+    # Each index contributes its best `limit + offset` matches. Nothing is joined to the
+    # ranked rows here: a join would materialise them and compute every match's snippet.
+    # bm25() is negative, best first.
+    hits = db.session.execute(text(f"""
+        SELECT kind, id, snippet FROM (
+            SELECT * FROM (
+                SELECT 'product' AS kind, product_search.rowid AS id, bm25(product_search) AS score,
+                       snippet(product_search, -1, :start, :end, '…', 12) AS snippet
+                FROM product_search {product_join}
+                WHERE product_search MATCH :expression {farmer_filter}
+                ORDER BY score LIMIT :window){tracking_branches}
+        )
+        ORDER BY score, kind, id
+        LIMIT :limit OFFSET :offset
+    """), dict(expression=expression, start=MATCH_START, end=MATCH_END, farmer_id=farmer_id,
+               window=limit + offset, limit=limit, offset=offset)).all()
+    if not hits:
+        return []
+
+    tracking_ids = [hit.id for hit in hits if hit.kind == 'tracking']
+    history = tracking_history(lambda model: model.id.in_(tracking_ids))
+    trackings = {row.id: row for row in db.session.execute(
+        db.select(history.c.id, history.c.product_id, history.c.status,
+                  history.c.transition_date, Warehouse.name.label('warehouse'))
+        .join(Warehouse, Warehouse.id == history.c.warehouse_id))} if tracking_ids else {}
+    product_ids = {trackings[hit.id].product_id if hit.kind == 'tracking' else hit.id for hit in hits}
+    products = {row.id: row for row in db.session.execute(
+        db.select(Product.id, Product.unique_hash, Product.product_type, Product.variety,
+                  Product.quality_grade, User.username.label('farmer'), ProductState.status)
+        .join(User, User.id == Product.farmer_id)
+        .outerjoin(ProductState, ProductState.product_id == Product.id)
+        .where(Product.id.in_(product_ids)))}
+
+    results = []
+    for hit in hits:
+        product = products[trackings[hit.id].product_id if hit.kind == 'tracking' else hit.id]
+        result = dict(kind=hit.kind, product_id=product.id, unique_hash=product.unique_hash,
+                      product_type=product.product_type, variety=product.variety,
+                      quality_grade=product.quality_grade, farmer=product.farmer,
+                      current_status=product.status or 'pending', snippet=highlight(hit.snippet))
+        if hit.kind == 'tracking':
+            tracking = trackings[hit.id]
+            result.update(tracking_id=tracking.id, status=tracking.status, warehouse=tracking.warehouse,
+                          transition_date=tracking.transition_date)
+        results.append(result)
+    return results
@@ -0,0 +1,134 @@
+"""API tokens for scanners and other machine clients.
+
+A client sends `Authorization: Bearer <token>` to the /api routes instead of
+signing in with the login form. Tokens are random, so they are stored as an
+HMAC-SHA256 digest keyed with API_TOKEN_KEY rather than a bcrypt hash, and
+looked up by that digest. Verified tokens are kept in an in-process LRU cache,
+so a client calling at high frequency costs no query, no session cookie and no
+user load per request. Revocations can come from another worker or from the
+revoke-token command, so at most every API_TOKEN_REVOCATION_CHECK seconds a
+worker counts revoked tokens, one index lookup, and drops its cache if the
+count has moved.
+"""
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from flask_login import UserMixin
+from app.cache import MemoryCache
+
+TOKEN_PREFIX = 'fpp_'
+
+class TokenUser(UserMixin):
+    """The user a request's API token acts for; carries no database state"""
+
+    def __init__(self, id, username, role, token_id):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.token_id = token_id
+
+    def __repr__(self):
+        return f"TokenUser('{self.username}', '{self.role}', token {self.token_id})"
+
+def _cache():
+    return current_app.extensions['api_tokens']
+
+class RevocationWatch:
+    """The number of revoked tokens this worker last saw, and when it last looked"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.revoked = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def due(self, interval):
+        """True for one caller once `interval` seconds have passed since the last check"""
+        with self._lock:
+            now = self.clock()
+            if self.checked_at is not None and now - self.checked_at < interval:
+                return False
+            self.checked_at = now
+            return True
+
+def _check_revocations():
+    """Forget every verified token if any token was revoked since this worker last looked"""
+    from app import db
+    from app.models import ApiToken
+    watch = current_app.extensions['api_token_revocations']
+    if not watch.due(current_app.config['API_TOKEN_REVOCATION_CHECK']):
+        return
+    revoked = db.session.scalar(db.select(db.func.count()).where(ApiToken.revoked_at.is_not(None)))
+    if watch.revoked is not None and revoked != watch.revoked:
+        _cache().clear()
+    watch.revoked = revoked
+
+def token_digest(token):
+    key = current_app.config['API_TOKEN_KEY'] or current_app.config['SECRET_KEY']
+    return hmac.new(key.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+def issue_token(user, name):
+    """Create a token for user; returns (token, ApiToken). The token is not stored anywhere."""
+    from app import db
+    from app.models import ApiToken
+    token = TOKEN_PREFIX + secrets.token_urlsafe(32)
+    api_token = ApiToken(user_id=user.id, name=name, role=user.role, prefix=token[:12],
+                         token_hash=token_digest(token))
+    db.session.add(api_token)
+    db.session.commit()
+    return token, api_token
+
+def revoke_token(api_token):
+    from app import db
+    if api_token.revoked_at is None:
+        api_token.revoked_at = datetime.utcnow()
+        db.session.commit()
+    _cache().delete(api_token.token_hash)
+
+def verify_token(token):
+    """The TokenUser of a valid, unrevoked token, or None"""
+    from app import db
+    from app.models import ApiToken, User
+    if not token.startswith(TOKEN_PREFIX):
+        return None
+    digest = token_digest(token)
+    _check_revocations()
+    cache = _cache()
+    found, user = cache.get(digest)
+    if found:
+        return user
+    row = db.session.execute(
+        db.select(ApiToken.id, ApiToken.user_id, ApiToken.role, User.username)
+        .join(User, User.id == ApiToken.user_id)
+        .where(ApiToken.token_hash == digest, ApiToken.revoked_at.is_(None))
+    ).first()
+    if row is None:
+        # Not cached, so a token issued by another worker a moment later still works
+        return None
+    user = TokenUser(row.user_id, row.username, row.role, row.id)
+    cache.set(digest, user)
+    return user
+
+def load_user_from_request(request):
+    """flask-login request loader: bearer tokens, on the JSON API only"""
+    header = request.headers.get('Authorization', '')
+    if request.blueprint != 'api' or not header.startswith('Bearer '):
+        return None
+    return verify_token(header[len('Bearer '):].strip())
+
+class ApiTokens:
+    """Flask extension verifying API tokens through a per-app cache"""
+
+    def init_app(self, app, login_manager):
+        app.config.setdefault('API_TOKEN_KEY', None)
+        app.config.setdefault('API_TOKEN_CACHE_TTL', 60)
+        app.config.setdefault('API_TOKEN_CACHE_SIZE', 10000)
+        app.config.setdefault('API_TOKEN_REVOCATION_CHECK', 1)
+        app.extensions['api_tokens'] = MemoryCache(max_entries=app.config['API_TOKEN_CACHE_SIZE'],
+                                                   default_ttl=app.config['API_TOKEN_CACHE_TTL'])
+        app.extensions['api_token_revocations'] = RevocationWatch()
+        login_manager.request_loader(load_user_from_request)
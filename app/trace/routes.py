@@ -0,0 +1,91 @@
+import hashlib
+import json
+import re
+from flask import Blueprint, abort, jsonify, make_response, render_template, request
+from app import db, cache
+from app.cache import farmer_tag
+from app.models import Product, User, Warehouse, tracking_history
+
+# Browsers and CDNs may reuse a trace for this long before revalidating with the ETag
+TRACE_MAX_AGE = 60
+
+# sha256 hex digests, plus shorter hex hashes on older rows; anything else skips the lookup
+HASH_PATTERN = re.compile(r'[0-9a-f]{16,64}')
+
+trace = Blueprint('trace', __name__)
+
+def load_trace(unique_hash):
+    """The product, its farmer and every tracking step, archived ones included, in one query, or None.
+
+    Returns a JSON-serialisable dict plus the farmer id used to tag the cache entry.
+    """
+    product_id = db.select(Product.id).where(Product.unique_hash == unique_hash).scalar_subquery()
+    history = tracking_history(lambda model: model.product_id == product_id)
+    rows = db.session.execute(
+        db.select(Product.unique_hash, Product.product_type, Product.variety, Product.quantity,
+                  Product.quality_grade, Product.created_at, Product.farmer_id,
+                  User.username, User.farm_location,
+                  history.c.status, history.c.quantity.label('tracked_quantity'),
+                  history.c.quality_notes, history.c.transition_date,
+                  Warehouse.name.label('warehouse'), Warehouse.type.label('warehouse_type'),
+                  Warehouse.location)
+        .join(User, User.id == Product.farmer_id)
+        .outerjoin(history, history.c.product_id == Product.id)
+        .outerjoin(Warehouse, Warehouse.id == history.c.warehouse_id)
+        .where(Product.unique_hash == unique_hash)
+        .order_by(history.c.transition_date, history.c.id)
+    ).all()
+    if not rows:
+        return None, None
+
+    first = rows[0]
+    chain = [dict(status=row.status, quantity=row.tracked_quantity, quality_notes=row.quality_notes,
+                  date=row.transition_date.isoformat(), warehouse=row.warehouse,
+                  warehouse_type=row.warehouse_type, location=row.location)
+             for row in rows if row.status is not None]
+    payload = dict(
+        hash=first.unique_hash,
+        product=dict(type=first.product_type, variety=first.variety, quantity=first.quantity,
+                     quality_grade=first.quality_grade, created_at=first.created_at.isoformat()),
+        farmer=dict(name=first.username, farm_location=first.farm_location),
+        current_status=chain[-1]['status'] if chain else 'pending',
+        chain=chain,
+    )
+    return payload, first.farmer_id
+
+def cached_trace(unique_hash):
+    """(payload, etag) for a hash, cached until a tracking write for the farmer's products"""
+    key = f'trace:{unique_hash}'
+    found, value = cache.backend.get(key)
+    if found:
+        return value
+    payload, farmer_id = load_trace(unique_hash)
+    if payload is None:
+        return None, None
+    etag = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:32]
+    cache.backend.set(key, (payload, etag), tags=[farmer_tag(farmer_id)])
+    return payload, etag
+
+@trace.route('/trace/<unique_hash>')
+def trace_product(unique_hash):
+    """Public supply chain trace for a crate's QR code, as HTML or JSON"""
+    wants_json = (request.args.get('format') == 'json' or
+                  request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json')
+    unique_hash = unique_hash.lower()
+    payload, etag = cached_trace(unique_hash) if HASH_PATTERN.fullmatch(unique_hash) else (None, None)
+    if payload is None:
+        if wants_json:
+            return jsonify(error='Unknown product hash.'), 404
+        abort(404)
+
+    if wants_json:
+        response = jsonify(payload)
+        etag += '-json'
+    else:
+        # A standalone page with no session-dependent parts, so shared caches may keep it
+        response = make_response(render_template('trace/view.html', trace=payload))
+        etag += '-html'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={TRACE_MAX_AGE}'
+    response.vary.add('Accept')
+    return response.make_conditional(request)
@@ -0,0 +1,346 @@
+"""Tracking write path and the derived data kept in step with it"""
+from datetime import datetime
+from app import db
+from app.models import (ArchivedTracking, Product, ProductTracking, ProductState, StageTransition, TrackingRollup,
+                        Warehouse, tracking_history)
+from app.archive import restore_archived_history
+from app.changes import record_stock_changes, record_trackings_created
+
+# Signed effect of each status on the stock of the warehouse recording it
+STOCK_EFFECTS = {'processing': 1, 'stored': 1, 'shipped': -1}
+
+ROLLUP_GRANULARITIES = ('hour', 'day')
+
+STAGE_TRANSITION_COLUMNS = ['tracking_id', 'product_id', 'farmer_id', 'product_type', 'warehouse_id',
+                            'from_status', 'to_status', 'input_quantity', 'output_quantity',
+                            'dwell_seconds', 'ended_at']
+
+class StockError(ValueError):
+    """A stock change would overfill or overdraw a warehouse"""
+
+def upsert(model):
+    """Dialect-specific INSERT supporting ON CONFLICT clauses"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model.__table__)
+
+def record_tracking(product_id, warehouse_id, status, quantity, quality_notes=None,
+                    processed_by=None, transition_date=None, idempotency_key=None):
+    """Add a tracking event and update derived state in the current transaction.
+
+    The caller owns the transaction and is expected to commit, or to roll back
+    if StockError is raised.
+    """
+    apply_stock_delta(warehouse_id, STOCK_EFFECTS.get(status, 0) * quantity)
+    tracking = ProductTracking(
+        product_id=product_id,
+        warehouse_id=warehouse_id,
+        status=status,
+        quantity=quantity,
+        quality_notes=quality_notes,
+        processed_by=processed_by,
+        transition_date=transition_date or datetime.utcnow(),
+        idempotency_key=idempotency_key
+    )
+    db.session.add(tracking)
+    db.session.flush()
+    _update_derived([tracking])
+    return tracking
+
+def record_trackings(events):
+    """Bulk-insert validated tracking events in the current transaction.
+
+    Each event is a dict of ProductTracking columns, optionally carrying an
+    idempotency_key. Events whose key was already recorded are skipped. Net
+    stock changes are applied per warehouse in one UPDATE, and every event
+    for a warehouse whose net change is out of bounds is rejected.
+
+    Returns one (outcome, detail) pair per event: ('created', tracking_id),
+    ('duplicate', tracking_id) or ('rejected', message).
+    """
+    results = [None] * len(events)
+    keys = [e['idempotency_key'] for e in events if e.get('idempotency_key')]
+    known = {}
+    if keys:
+        # Archived rows keep their keys, so a late replay is still a duplicate
+        known = dict(db.session.execute(db.union_all(*[
+            db.select(model.idempotency_key, model.id).where(model.idempotency_key.in_(keys))
+            for model in (ProductTracking, ArchivedTracking)
+        ])).all())
+
+    pending, first_with_key, deltas = [], {}, {}
+    for index, event in enumerate(events):
+        key = event.get('idempotency_key')
+        if key in known:
+            results[index] = ('duplicate', known[key])
+            continue
+        if key in first_with_key:
+            # Resolved once the first event carrying this key is written
+            continue
+        if key:
+            first_with_key[key] = index
+        pending.append(index)
+        warehouse_id = event['warehouse_id']
+        deltas[warehouse_id] = deltas.get(warehouse_id, 0) + STOCK_EFFECTS.get(event['status'], 0) * event['quantity']
+
+    rejected = apply_stock_deltas(deltas)
+    rows = []
+    for index in pending:
+        event = events[index]
+        if event['warehouse_id'] in rejected:
+            results[index] = ('rejected', f"Net stock change of {deltas[event['warehouse_id']]:+.1f} "
+                                          f"does not fit warehouse {event['warehouse_id']}.")
+            continue
+        rows.append(dict(
+            product_id=event['product_id'],
+            warehouse_id=event['warehouse_id'],
+            status=event['status'],
+            quantity=event['quantity'],
+            quality_notes=event.get('quality_notes'),
+            processed_by=event.get('processed_by'),
+            transition_date=event.get('transition_date') or datetime.utcnow(),
+            idempotency_key=event.get('idempotency_key')
+        ))
+
+    written = []
+    if rows:
+        # A Core insert keeps this to one multi-row INSERT; the ORM splits batches on which
+        # values are None. Asking for RETURNING in parameter order would also fall back to
+        # one INSERT per row, but ids are handed out in VALUES order so sorting restores it.
+        table = ProductTracking.__table__
+        written = sorted(db.session.execute(
+            table.insert().returning(table.c.id, table.c.product_id, table.c.warehouse_id,
+                                     table.c.status, table.c.quantity, table.c.quality_notes,
+                                     table.c.processed_by, table.c.transition_date),
+            rows
+        ).all(), key=lambda row: row.id)
+        _update_derived(written)
+
+    created = iter(written)
+    for index in pending:
+        if results[index] is None:
+            results[index] = ('created', next(created).id)
+    for index, event in enumerate(events):
+        if results[index] is None:
+            results[index] = results[first_with_key[event['idempotency_key']]]
+            if results[index][0] == 'created':
+                results[index] = ('duplicate', results[index][1])
+    return results
+
+def _update_derived(trackings):
+    """Bring every table derived from tracking history up to date with new rows"""
+    # A finished chain that moves again becomes hot again, history and all
+    restore_archived_history({t.product_id for t in trackings})
+    record_trackings_created(trackings)
+    update_product_state(trackings)
+    update_rollups(trackings)
+    update_stage_transitions({t.product_id for t in trackings})
+
+def apply_stock_deltas(deltas):
+    """Move several warehouses' stock in one conditional UPDATE.
+
+    deltas maps warehouse id to a signed quantity. The arithmetic happens in
+    SQL, so concurrent writers cannot lose each other's changes. A warehouse
+    is left untouched if an increase would exceed its capacity or a decrease
+    would take it below zero; the ids of those warehouses are returned. The
+    new stock levels go to the change feed.
+    """
+    deltas = {warehouse_id: delta for warehouse_id, delta in deltas.items() if delta}
+    if not deltas:
+        return set()
+    delta = db.case(deltas, value=Warehouse.id)
+    new_stock = Warehouse.current_stock + delta
+    result = db.session.execute(
+        db.update(Warehouse)
+        .where(Warehouse.id.in_(deltas),
+               db.or_(delta <= 0, new_stock <= Warehouse.capacity),
+               db.or_(delta >= 0, new_stock >= 0))
+        .values(current_stock=new_stock)
+        .returning(Warehouse.id, Warehouse.current_stock)
+        .execution_options(synchronize_session='fetch')
+    ).all()
+    record_stock_changes(result)
+    return set(deltas) - {row.id for row in result}
+
+def apply_stock_delta(warehouse_id, delta):
+    """Move one warehouse's stock, raising StockError if it is out of bounds"""
+    if not apply_stock_deltas({warehouse_id: delta}):
+        return
+
+    warehouse = db.session.get(Warehouse, warehouse_id)
+    if warehouse is None:
+        raise StockError(f'Warehouse {warehouse_id} does not exist.')
+    if delta > 0:
+        raise StockError(f'{warehouse.name} cannot take {delta:.1f} more: '
+                         f'{warehouse.current_stock:.1f} of {warehouse.capacity:.1f} in use.')
+    raise StockError(f'{warehouse.name} only holds {warehouse.current_stock:.1f}, '
+                     f'cannot remove {-delta:.1f}.')
+
+def update_product_state(trackings):
+    """Upsert the current state rows for newly written trackings.
+
+    Accepts ProductTracking objects or rows with the same attribute names.
+    State only moves forward: an event older than the stored state is ignored.
+    """
+    latest = {}
+    for tracking in trackings:
+        current = latest.get(tracking.product_id)
+        if current is None or (tracking.transition_date, tracking.id) >= (current.transition_date, current.id):
+            latest[tracking.product_id] = tracking
+    if not latest:
+        return
+
+    stmt = upsert(ProductState)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ProductState.product_id],
+        set_={name: stmt.excluded[name] for name in
+              ('tracking_id', 'warehouse_id', 'status', 'quantity', 'transition_date')},
+        where=db.tuple_(stmt.excluded.transition_date, stmt.excluded.tracking_id) >=
+              db.tuple_(ProductState.transition_date, ProductState.tracking_id)
+    )
+    db.session.execute(stmt, [
+        dict(product_id=t.product_id, tracking_id=t.id, warehouse_id=t.warehouse_id,
+             status=t.status, quantity=t.quantity, transition_date=t.transition_date)
+        for t in latest.values()
+    ])
+
+def rebuild_product_state():
+    """Recompute every product's current state from the full tracking history"""
+    latest = ProductTracking.latest_per_product()
+    db.session.execute(db.delete(ProductState))
+    db.session.execute(db.insert(ProductState).from_select(
+        ['product_id', 'tracking_id', 'warehouse_id', 'status', 'quantity', 'transition_date'],
+        db.select(latest.c.product_id, latest.c.id, latest.c.warehouse_id, latest.c.status,
+                  latest.c.quantity, latest.c.transition_date)
+    ))
+    return db.session.query(ProductState).count()
+
+def check_product_state():
+    """Compare the state table with the tracking history.
+
+    Returns a list of (product_id, problem) tuples; empty when consistent.
+    """
+    latest = ProductTracking.latest_per_product()
+    problems = []
+    rows = db.session.execute(
+        db.select(latest.c.product_id, latest.c.id, ProductState.tracking_id)
+        .outerjoin(ProductState, ProductState.product_id == latest.c.product_id)
+        .where(db.or_(ProductState.tracking_id.is_(None), ProductState.tracking_id != latest.c.id))
+    )
+    for product_id, expected, actual in rows:
+        if actual is None:
+            problems.append((product_id, 'missing state row'))
+        else:
+            problems.append((product_id, f'stale state: tracking {actual}, expected {expected}'))
+
+    orphans = db.session.execute(
+        db.select(ProductState.product_id)
+        .outerjoin(latest, latest.c.product_id == ProductState.product_id)
+        .where(latest.c.id.is_(None))
+    )
+    problems.extend((product_id, 'state row without tracking history') for product_id, in orphans)
+    return problems
+
+def bucket_start(moment, granularity):
+    """Truncate a timestamp to the start of its hour or day bucket"""
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _bucket_expression(column, granularity):
+    """SQL equivalent of bucket_start for rebuilding rollups in the database"""
+    if db.engine.dialect.name == 'postgresql':
+        return db.func.date_trunc(granularity, column)
+    # Matches the storage format SQLAlchemy uses for SQLite DateTime columns
+    pattern = '%Y-%m-%d %H:00:00.000000' if granularity == 'hour' else '%Y-%m-%d 00:00:00.000000'
+    return db.func.strftime(pattern, column)
+
+def update_rollups(trackings):
+    """Add new trackings to their hourly and daily rollup buckets"""
+    if not trackings:
+        return
+    product_types = dict(db.session.execute(
+        db.select(Product.id, Product.product_type)
+        .where(Product.id.in_({t.product_id for t in trackings}))
+    ).all())
+
+    increments = {}
+    for tracking in trackings:
+        for granularity in ROLLUP_GRANULARITIES:
+            key = (granularity, tracking.warehouse_id, bucket_start(tracking.transition_date, granularity),
+                   tracking.status, product_types[tracking.product_id])
+            quantity, events = increments.get(key, (0.0, 0))
+            increments[key] = (quantity + tracking.quantity, events + 1)
+
+    stmt = upsert(TrackingRollup)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[c.name for c in TrackingRollup.__table__.primary_key],
+        set_={'quantity': TrackingRollup.quantity + stmt.excluded.quantity,
+              'events': TrackingRollup.events + stmt.excluded.events}
+    )
+    db.session.execute(stmt, [
+        dict(granularity=granularity, warehouse_id=warehouse_id, bucket_start=start, status=status,
+             product_type=product_type, quantity=quantity, events=events)
+        for (granularity, warehouse_id, start, status, product_type), (quantity, events) in increments.items()
+    ])
+
+def rebuild_rollups():
+    """Recompute every rollup bucket from the full tracking history, archive included"""
+    db.session.execute(db.delete(TrackingRollup))
+    history = tracking_history()
+    for granularity in ROLLUP_GRANULARITIES:
+        start = _bucket_expression(history.c.transition_date, granularity)
+        db.session.execute(db.insert(TrackingRollup).from_select(
+            ['granularity', 'warehouse_id', 'bucket_start', 'status', 'product_type', 'quantity', 'events'],
+            db.select(db.literal(granularity), history.c.warehouse_id, start, history.c.status,
+                      Product.product_type, db.func.sum(history.c.quantity), db.func.count())
+            .join(Product, Product.id == history.c.product_id)
+            .group_by(history.c.warehouse_id, start, history.c.status, Product.product_type)
+        ))
+    return db.session.query(TrackingRollup).count()
+
+def _seconds_between(start, end):
+    if db.engine.dialect.name == 'postgresql':
+        return db.func.extract('epoch', end - start)
+    return (db.func.julianday(end) - db.func.julianday(start)) * 86400
+
+def _stage_transitions_select(product_ids=None):
+    """Each tracking event next to its product's previous event, via LAG over the ordered history"""
+    history = tracking_history(
+        (lambda model: model.product_id.in_(product_ids)) if product_ids is not None else None)
+    window = dict(partition_by=history.c.product_id, order_by=(history.c.transition_date, history.c.id))
+    steps = db.select(
+        history.c.id, history.c.product_id, Product.farmer_id, Product.product_type,
+        history.c.warehouse_id, history.c.status, history.c.quantity, history.c.transition_date,
+        db.func.lag(history.c.warehouse_id).over(**window).label('previous_warehouse_id'),
+        db.func.lag(history.c.status).over(**window).label('previous_status'),
+        db.func.lag(history.c.quantity).over(**window).label('previous_quantity'),
+        db.func.lag(history.c.transition_date).over(**window).label('previous_date'),
+    ).join(Product, Product.id == history.c.product_id).subquery()
+    return db.select(
+        steps.c.id, steps.c.product_id, steps.c.farmer_id, steps.c.product_type,
+        db.func.coalesce(steps.c.previous_warehouse_id, steps.c.warehouse_id), steps.c.previous_status,
+        steps.c.status, steps.c.previous_quantity, steps.c.quantity,
+        _seconds_between(steps.c.previous_date, steps.c.transition_date), steps.c.transition_date)
+
+def update_stage_transitions(product_ids):
+    """Re-derive the stage transitions of products that have new tracking events.
+
+    The whole (short) history of each product is redone, so events recorded
+    out of order also fix up the transition that follows them.
+    """
+    if not product_ids:
+        return
+    product_ids = list(product_ids)
+    db.session.execute(db.delete(StageTransition).where(StageTransition.product_id.in_(product_ids)))
+    db.session.execute(db.insert(StageTransition).from_select(
+        STAGE_TRANSITION_COLUMNS, _stage_transitions_select(product_ids)))
+
+def rebuild_stage_transitions():
+    """Recompute every stage transition from the full tracking history"""
+    db.session.execute(db.delete(StageTransition))
+    db.session.execute(db.insert(StageTransition).from_select(
+        STAGE_TRANSITION_COLUMNS, _stage_transitions_select()))
+    return db.session.query(StageTransition).count()
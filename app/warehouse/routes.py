@@ -1,8 +1,14 @@
-from flask import render_template, request, flash, redirect, url_for, Blueprint
+from flask import render_template, request, flash, redirect, url_for, Blueprint, abort
 from flask_login import login_required, current_user
-from app import db
-from app.models import Warehouse, ProductTracking
+from app import db, cache
+from app.cache import warehouse_type_tag
+from app.models import Warehouse
 from app.warehouse.forms import WarehouseForm
+from app.warehouse.stats import cached_warehouse_stats, warehouse_totals, OCCUPANCY_STATUSES
+from app.changes import record_warehouse_created
+from app.reference import invalidate_reference
+from app.history import CursorError, history_filters, history_page
+from app.product.forms import TRACKING_STATUSES
 
 warehouse = Blueprint('warehouse', __name__)
 
@@ -13,8 +19,8 @@ def list_warehouses():
         flash('Farmers do not have access to warehouse management.', 'danger')
         return redirect(url_for('dashboard.index'))
 
-    warehouses = Warehouse.query.all()
-    return render_template('warehouse/list.html', warehouses=warehouses)
+    return render_template('warehouse/list.html', warehouses=cached_warehouse_stats(),
+                           occupancy_statuses=OCCUPANCY_STATUSES)
 
 @warehouse.route('/warehouse/new', methods=['GET', 'POST'])
 @login_required
@@ -32,7 +38,11 @@ def new_warehouse():
             capacity=form.capacity.data
         )
         db.session.add(warehouse)
+        db.session.flush()
+        record_warehouse_created(warehouse)
         db.session.commit()
+        cache.invalidate(warehouse_type_tag(warehouse.type))
+        invalidate_reference('warehouses')
         flash('Warehouse/Processing plant has been created successfully!', 'success')
         return redirect(url_for('warehouse.list_warehouses'))
     return render_template('warehouse/new.html', title='New Warehouse', form=form)
@@ -45,7 +55,20 @@ def view_warehouse(warehouse_id):
         return redirect(url_for('dashboard.index'))
 
     warehouse = Warehouse.query.get_or_404(warehouse_id)
-    trackings = ProductTracking.query.filter_by(warehouse_id=warehouse_id).order_by(
-        ProductTracking.transition_date.desc()).all()
+    try:
+        filters = history_filters(request.args)
+    except ValueError as e:
+        flash(str(e), 'warning')
+        filters = dict(status=None, start=None, end=None)
+    # Finished chains are archived; reading them is opt-in so the page stays fast
+    include_archived = request.args.get('archived') == '1'
+    try:
+        trackings, next_cursor = history_page(warehouse_id=warehouse_id, cursor=request.args.get('after'),
+                                              include_archived=include_archived, **filters)
+    except CursorError:
+        abort(400)
 
-    return render_template('warehouse/view.html', warehouse=warehouse, trackings=trackings)
+    return render_template('warehouse/view.html', warehouse=warehouse, trackings=trackings,
+                           next_cursor=next_cursor, after=request.args.get('after'), filters=filters,
+                           include_archived=include_archived, totals=warehouse_totals(warehouse_id),
+                           statuses=TRACKING_STATUSES)
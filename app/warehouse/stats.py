@@ -0,0 +1,87 @@
+"""Occupancy, recent movement and history totals of warehouses, for the warehouse pages"""
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db, cache
+from app.cache import warehouse_type_tag
+from app.models import ArchivedTracking, ProductState, ProductTracking, TrackingRollup, Warehouse
+from app.product.forms import TRACKING_STATUSES
+from app.tracking import STOCK_EFFECTS
+from app.warehouse.forms import WAREHOUSE_TYPES
+
+# Statuses of products still in a warehouse; shipped and rejected ones only accumulate
+OCCUPANCY_STATUSES = ('received', 'processing', 'stored')
+
+INBOUND_STATUSES = tuple(status for status, effect in STOCK_EFFECTS.items() if effect > 0)
+OUTBOUND_STATUSES = tuple(status for status, effect in STOCK_EFFECTS.items() if effect < 0)
+
+MOVEMENT_WINDOW = timedelta(hours=24)
+
+def _latest(*columns):
+    """The greatest non-null value of the columns"""
+    if db.engine.dialect.name == 'postgresql':
+        return db.func.greatest(*columns, type_=db.DateTime)
+    # SQLite's multi-argument max() is null if any argument is
+    return db.func.max(*[db.func.coalesce(column, *[c for c in columns if c is not column]) for column in columns],
+                       type_=db.DateTime)
+
+def _moved(model, statuses, since):
+    """kg a warehouse recorded with these statuses since `since`, read from the (warehouse, date) index"""
+    return (db.select(db.func.coalesce(db.func.sum(model.quantity), 0.0))
+            .where(model.warehouse_id == Warehouse.id, model.transition_date >= since, model.status.in_(statuses))
+            .scalar_subquery())
+
+def warehouse_stats(now=None):
+    """One dict per warehouse, by id, with utilization, products on hand per status, inbound and
+    outbound kg over the last 24 hours and the time of its latest tracking event.
+
+    A single statement: each figure is an aggregate over one warehouse's index
+    range, so the cost follows the number of warehouses, the products they hold
+    and the last day's events rather than the size of the history.
+    """
+    since = (now or datetime.utcnow()) - MOVEMENT_WINDOW
+    on_hand = {
+        status: db.select(db.func.count()).where(ProductState.warehouse_id == Warehouse.id,
+                                                 ProductState.status == status).scalar_subquery()
+        for status in OCCUPANCY_STATUSES
+    }
+    inbound = _moved(ProductTracking, INBOUND_STATUSES, since) + _moved(ArchivedTracking, INBOUND_STATUSES, since)
+    outbound = _moved(ProductTracking, OUTBOUND_STATUSES, since) + _moved(ArchivedTracking, OUTBOUND_STATUSES, since)
+    last_activity = _latest(*[
+        db.select(db.func.max(model.transition_date)).where(model.warehouse_id == Warehouse.id).scalar_subquery()
+        for model in (ProductTracking, ArchivedTracking)
+    ])
+    rows = db.session.execute(
+        db.select(Warehouse.id, Warehouse.name, Warehouse.type, Warehouse.location, Warehouse.capacity,
+                  Warehouse.current_stock, *[count.label(status) for status, count in on_hand.items()],
+                  inbound.label('inbound'), outbound.label('outbound'), last_activity.label('last_activity'))
+        .order_by(Warehouse.id)
+    ).all()
+    return [dict(
+        id=row.id, name=row.name, type=row.type, location=row.location, capacity=row.capacity,
+        current_stock=row.current_stock or 0.0,
+        utilization=round((row.current_stock or 0.0) / row.capacity * 100, 1) if row.capacity > 0 else 0.0,
+        products={status: getattr(row, status) for status in OCCUPANCY_STATUSES},
+        inbound_24h=row.inbound, outbound_24h=row.outbound, last_activity=row.last_activity,
+    ) for row in rows]
+
+def warehouse_totals(warehouse_id):
+    """{status: (events, kg)} over one warehouse's whole history, archive included, from the daily rollups.
+
+    One row of conditional sums over the warehouse's rollup range, so the cost
+    follows the days and product types it has seen rather than its events.
+    """
+    statuses = [status for status, _ in TRACKING_STATUSES]
+    columns = []
+    for status in statuses:
+        matches = TrackingRollup.status == status
+        columns += [db.func.sum(db.case((matches, TrackingRollup.events), else_=0)),
+                    db.func.sum(db.case((matches, TrackingRollup.quantity), else_=0.0))]
+    row = db.session.execute(db.select(*columns).where(TrackingRollup.granularity == 'day',
+                                                       TrackingRollup.warehouse_id == warehouse_id)).one()
+    totals = {status: (row[2 * index] or 0, row[2 * index + 1] or 0.0) for index, status in enumerate(statuses)}
+    return {status: total for status, total in totals.items() if total[0]}
+
+def cached_warehouse_stats():
+    """warehouse_stats, kept for WAREHOUSE_STATS_TTL seconds or until a tracking write"""
+    return cache.cached('warehouse-stats', warehouse_stats, ttl=current_app.config['WAREHOUSE_STATS_TTL'],
+                        tags=[warehouse_type_tag(value) for value, _ in WAREHOUSE_TYPES])
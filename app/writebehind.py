@@ -0,0 +1,400 @@
+"""Optional write-behind queue for tracking events.
+
+With TRACKING_WRITE_BEHIND on, the tracking form hands events to an in-process
+queue instead of writing them in the request. A writer thread drains the queue
+and group-commits up to WRITE_BEHIND_BATCH_SIZE events at a time through
+record_trackings, so stock changes are aggregated per warehouse and the
+database sees one short write transaction per batch.
+
+Every accepted event is first appended to a journal and carries an
+idempotency key. Each process journals into a run of files of up to
+WRITE_BEHIND_JOURNAL_SEGMENT events, and a file is removed as soon as all its
+events are committed, so the journal stays about as long as the queue however
+busy the writer is. Journals left behind by a process that died are replayed,
+with the same retries, when the next app starts; events that had already been
+committed, archived or not, are skipped by their key. The queue is bounded: once
+WRITE_BEHIND_QUEUE_SIZE events are waiting, submit() blocks for up to
+WRITE_BEHIND_ENQUEUE_TIMEOUT seconds and then raises QueueFullError.
+
+A batch that still fails after WRITE_BEHIND_MAX_ATTEMPTS attempts is appended
+to a dead-letter file next to the journals and the writer moves on.
+"""
+import atexit
+import collections
+import fcntl
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PATTERN = 'tracking-*.ndjson'
+
+# Backoff between attempts when a batch cannot be committed at all
+RETRY_DELAYS = (0.1, 0.5, 1, 2, 5)
+
+_STOP = object()
+
+class QueueFullError(Exception):
+    """The write-behind queue stayed full for the whole enqueue timeout"""
+
+def _encode(event):
+    return json.dumps(dict(event, transition_date=event['transition_date'].isoformat())) + '\n'
+
+def _decode(line):
+    event = json.loads(line)
+    event['transition_date'] = datetime.fromisoformat(event['transition_date'])
+    return event
+
+class JournalSegment:
+    """One journal file and how many of its events are still waiting to be committed"""
+
+    def __init__(self, path):
+        self.path = path
+        # Held until the file is removed, so recovery can tell live journals from orphans. The
+        # file only gets a name recovery looks for once it is locked
+        partial = path + '.new'
+        self.file = open(partial, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        os.rename(partial, path)
+        self.events = 0
+        self.unwritten = 0
+
+    def remove(self):
+        os.remove(self.path)
+        self.file.close()
+
+class TrackingWriter:
+    """Queue, journal and writer thread of one app in one process"""
+
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.capacity = config['WRITE_BEHIND_QUEUE_SIZE']
+        self.batch_size = config['WRITE_BEHIND_BATCH_SIZE']
+        self.max_delay = config['WRITE_BEHIND_MAX_DELAY_MS'] / 1000
+        self.enqueue_timeout = config['WRITE_BEHIND_ENQUEUE_TIMEOUT']
+        self.fsync = config['WRITE_BEHIND_FSYNC']
+        self.journal_dir = config['WRITE_BEHIND_JOURNAL_DIR']
+        self.segment_size = config['WRITE_BEHIND_JOURNAL_SEGMENT']
+        self.max_attempts = config['WRITE_BEHIND_MAX_ATTEMPTS']
+        self._slots = threading.Semaphore(self.capacity)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        # Oldest first; new events go to the last one
+        self._segments = collections.deque()
+        self._sequence = 0
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self.stats = dict(submitted=0, written=0, duplicates=0, rejected=0, dead_lettered=0, batches=0,
+                          last_batch_size=0, last_commit_at=None, last_error=None)
+
+    @property
+    def journal_path(self):
+        """The journal file new events are appended to"""
+        return self._segments[-1].path if self._segments else None
+
+    @property
+    def dead_letter_path(self):
+        return os.path.join(self.journal_dir, f'dead-letter-{os.getpid()}.ndjson')
+
+    def submit(self, event):
+        """Journal and enqueue one tracking event; returns its idempotency key.
+
+        The event is a dict of ProductTracking columns. transition_date defaults
+        to now, so events keep the time they were scanned, not written.
+        """
+        if self._closed:
+            raise RuntimeError('The tracking writer has been shut down.')
+        event = dict(event)
+        event.setdefault('transition_date', None)
+        event['transition_date'] = event['transition_date'] or datetime.utcnow()
+        event['idempotency_key'] = event.get('idempotency_key') or f'wb-{uuid.uuid4().hex}'
+        if not self._slots.acquire(timeout=self.enqueue_timeout):
+            raise QueueFullError(f'{self.capacity} tracking events are already waiting to be written.')
+        with self._lock:
+            self._ensure_started()
+            segment = self._segments[-1]
+            if segment.events >= self.segment_size:
+                segment = self._open_segment()
+            segment.file.write(_encode(event))
+            segment.file.flush()
+            if self.fsync:
+                os.fsync(segment.file.fileno())
+            segment.events += 1
+            segment.unwritten += 1
+            self._pending += 1
+            self.stats['submitted'] += 1
+            # Under the lock, so the queue order is the journal order
+            self._queue.put(event)
+        return event['idempotency_key']
+
+    def flush(self, timeout=None):
+        """Wait until every submitted event has been written; returns False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, timeout=None):
+        """Write everything still queued, then stop the writer thread"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            running = self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+        if running:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+        with self._lock:
+            if self._pending == 0:
+                while self._segments:
+                    self._segments.popleft().remove()
+
+    def status(self):
+        with self._lock:
+            return dict(self.stats, enabled=True, depth=self._pending, capacity=self.capacity,
+                        batch_size=self.batch_size, writer_alive=self._thread is not None and self._thread.is_alive(),
+                        journal=self.journal_path, journal_files=len(self._segments))
+
+    def _ensure_started(self):
+        # Threads do not survive a fork; a forked worker starts its own writer and journal
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._segments = collections.deque()
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run, name='tracking-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _open_segment(self):
+        self._sequence += 1
+        segment = JournalSegment(os.path.join(self.journal_dir, f'tracking-{self._pid}-{self._sequence:06d}.ndjson'))
+        self._segments.append(segment)
+        return segment
+
+    def _drop_journaled(self, count):
+        """Drop the oldest `count` journaled events once they are committed; called with the lock held"""
+        self._pending -= count
+        while count:
+            segment = self._segments[0]
+            done = min(count, segment.unwritten)
+            segment.unwritten -= done
+            count -= done
+            if segment.unwritten:
+                return
+            if segment is self._segments[-1]:
+                # Everything journaled is committed
+                segment.file.truncate(0)
+                segment.events = 0
+                return
+            self._segments.popleft().remove()
+
+    def _run(self):
+        while True:
+            batch, stop = self._take_batch()
+            if batch:
+                self._write_with_retries(batch)
+            if stop:
+                return
+
+    def _take_batch(self):
+        """Block for one event, then gather more for up to max_delay; returns (batch, stop)"""
+        batch = []
+        event = self._queue.get()
+        deadline = time.monotonic() + self.max_delay
+        while event is not _STOP:
+            batch.append(event)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            try:
+                event = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _write_with_retries(self, batch):
+        if not self._write_or_set_aside(batch):
+            return
+        with self._lock:
+            self._drop_journaled(len(batch))
+            if self._pending == 0:
+                self._idle.notify_all()
+        for _ in batch:
+            self._slots.release()
+
+    def _write_or_set_aside(self, batch):
+        """Commit a batch, retrying with backoff, or dead-letter it after max_attempts.
+
+        Returns False if the writer is shutting down and left the batch in the journal.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.app.app_context():
+                    self.write_batch(batch)
+                return True
+            except Exception as e:
+                attempt += 1
+                logger.exception('Writing %d queued tracking events failed (attempt %d)', len(batch), attempt)
+                with self._lock:
+                    self.stats['last_error'] = f'{type(e).__name__}: {e}'
+                if attempt >= self.max_attempts:
+                    self._dead_letter(batch)
+                    return True
+                if self._closed and attempt > len(RETRY_DELAYS):
+                    # Shutting down; left in the journal for the next start to replay
+                    logger.error('Leaving %d tracking events in %s', len(batch), self.journal_path)
+                    return False
+                # While the database is unavailable the queue fills up and pushes back on requests
+                time.sleep(RETRY_DELAYS[min(attempt, len(RETRY_DELAYS)) - 1])
+
+    def _dead_letter(self, batch):
+        """Set aside a batch that keeps failing, so the events queued behind it still get written"""
+        path = self.dead_letter_path
+        with open(path, 'a') as dead_letters:
+            dead_letters.writelines(map(_encode, batch))
+            dead_letters.flush()
+            if self.fsync:
+                os.fsync(dead_letters.fileno())
+        logger.error('Moved %d tracking events that could not be written to %s', len(batch), path)
+        with self._lock:
+            self.stats['dead_lettered'] += len(batch)
+
+    def recover_journals(self):
+        """Replay the journals of processes that died with events still queued.
+
+        Batches are retried and dead-lettered like queued ones, and a journal is
+        only removed once all its events are committed or set aside. Journals
+        still locked by a live process are left alone. Returns the number of
+        events found.
+        """
+        found = 0
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, JOURNAL_PATTERN))):
+            with open(path) as journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if not _still_at(journal, path):
+                    # Its writer committed everything and removed it after the glob
+                    continue
+                events = []
+                for line in journal:
+                    try:
+                        events.append(_decode(line))
+                    except ValueError:
+                        # The process died part way through appending this event
+                        logger.warning('Skipping a torn line in %s', path)
+                for start in range(0, len(events), self.batch_size):
+                    self._write_or_set_aside(events[start:start + self.batch_size])
+                found += len(events)
+                os.remove(path)
+        if found:
+            logger.info('Replayed %d tracking events from write-behind journals', found)
+        return found
+
+    def write_batch(self, batch):
+        """Commit one batch; runs in an app context on the writer thread"""
+        outcomes = write_events(batch)
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['last_batch_size'] = len(batch)
+            self.stats['last_commit_at'] = datetime.utcnow().isoformat(timespec='seconds')
+            for outcome in outcomes:
+                key = {'created': 'written', 'duplicate': 'duplicates', 'rejected': 'rejected'}[outcome]
+                self.stats[key] += 1
+
+def write_events(events):
+    """record_trackings for a batch of queued events, committing and invalidating cached pages.
+
+    A warehouse whose net change does not fit rejects all its events in the
+    batch, so those are retried one by one and only the events that overfill
+    or overdraw it on their own are dropped. Returns one outcome per event.
+    """
+    outcomes = [outcome for outcome, _ in _commit(events)]
+    rejected = [index for index, outcome in enumerate(outcomes) if outcome == 'rejected']
+    if len(events) > 1:
+        for index in rejected:
+            (outcomes[index], detail), = _commit([events[index]])
+            if outcomes[index] == 'rejected':
+                logger.warning('Dropped queued tracking event %s: %s', events[index], detail)
+    return outcomes
+
+def _commit(events):
+    from app import db, cache
+    from app.cache import farmer_tag, warehouse_type_tag
+    from app.models import Product, Warehouse
+    from app.tracking import record_trackings
+    results = record_trackings(events)
+    db.session.commit()
+    written = [event for event, (outcome, _) in zip(events, results) if outcome == 'created']
+    if written:
+        farmers = db.session.scalars(db.select(Product.farmer_id).distinct().where(
+            Product.id.in_({event['product_id'] for event in written})))
+        types = db.session.scalars(db.select(Warehouse.type).distinct().where(
+            Warehouse.id.in_({event['warehouse_id'] for event in written})))
+        cache.invalidate(*map(farmer_tag, farmers), *map(warehouse_type_tag, types))
+    return results
+
+def _still_at(journal, path):
+    """Whether path still names the open journal file"""
+    try:
+        return os.stat(path).st_ino == os.fstat(journal.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+class WriteBehind:
+    """Flask extension giving each app an optional tracking writer.
+
+    Enabled by TRACKING_WRITE_BEHIND. Needs a database that other threads can
+    open connections to, so not in-memory SQLite.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('TRACKING_WRITE_BEHIND', False)
+        app.config.setdefault('WRITE_BEHIND_QUEUE_SIZE', 10000)
+        app.config.setdefault('WRITE_BEHIND_BATCH_SIZE', 200)
+        app.config.setdefault('WRITE_BEHIND_MAX_DELAY_MS', 20)
+        app.config.setdefault('WRITE_BEHIND_ENQUEUE_TIMEOUT', 2.0)
+        app.config.setdefault('WRITE_BEHIND_FSYNC', True)
+        app.config.setdefault('WRITE_BEHIND_JOURNAL_DIR', os.path.join(app.instance_path, 'journal'))
+        app.config.setdefault('WRITE_BEHIND_JOURNAL_SEGMENT', 1000)
+        app.config.setdefault('WRITE_BEHIND_MAX_ATTEMPTS', 10)
+        if not app.config['TRACKING_WRITE_BEHIND']:
+            app.extensions['write_behind'] = None
+            return
+
+        from app.database import is_memory_sqlite
+        if is_memory_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+            raise RuntimeError('TRACKING_WRITE_BEHIND needs a file or server database.')
+        writer = TrackingWriter(app)
+        with app.app_context():
+            writer.recover_journals()
+        app.extensions['write_behind'] = writer
+
+    @property
+    def writer(self):
+        return current_app.extensions['write_behind']
+
+    @property
+    def enabled(self):
+        return self.writer is not None
+
+    def submit(self, event):
+        return self.writer.submit(event)
+
+    def status(self):
+        if self.writer is None:
+            return dict(enabled=False)
+        return self.writer.status()
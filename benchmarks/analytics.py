@@ -0,0 +1,186 @@
+"""Analytics over the full tracking history: NumPy snapshot against SQL and the ORM.
+
+A history of about a million tracking events is generated into a fresh SQLite
+file. The snapshot is loaded once and timed, then each question is answered by
+the snapshot, by a SQL GROUP BY over the history, and by iterating ORM objects
+in Python, and the answers are checked against each other:
+
+- kg shipped per product type per week
+- kg moved through each warehouse in the last 30 days
+- the ten farmers with the most kg received
+
+    python -m benchmarks.analytics [--products 120000] [--transfers 3] [--days 365]
+                                   [--repeat 5] [--no-orm] [--json]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.routes import BenchmarkConfig
+
+def snapshot_weekly(snapshot, since):
+    weekly = snapshot.aggregate('product_type', status='shipped', granularity='week')
+    return {(snapshot.label('product_type', g['key']), g['bucket']): g['kg'] for g in weekly}
+
+def snapshot_warehouses(snapshot, since):
+    return {g['key']: g['kg'] for g in snapshot.aggregate('warehouse', start=since)}
+
+def snapshot_top_farmers(snapshot, since):
+    from app.analytics import label_groups
+    top = label_groups(snapshot, 'farmer', snapshot.top('farmer', 10, status='received'))
+    return [(g['label'], g['kg']) for g in top]
+
+def sql_weekly(snapshot, since):
+    from app import db
+    from app.analytics import BUCKET_WIDTHS, WEEK_ORIGIN, epoch_expression
+    from app.models import Product, tracking_history
+    history = tracking_history(lambda model: model.status == 'shipped')
+    week = (epoch_expression(history.c.transition_date) - WEEK_ORIGIN) // BUCKET_WIDTHS['week']
+    rows = db.session.execute(
+        db.select(Product.product_type, week, db.func.sum(history.c.quantity))
+        .join(Product, Product.id == history.c.product_id).group_by(Product.product_type, week)).all()
+    return {(product_type, int(bucket) * BUCKET_WIDTHS['week'] + WEEK_ORIGIN): kg for product_type, bucket, kg in rows}
+
+def sql_warehouses(snapshot, since):
+    from app import db
+    from app.models import tracking_history
+    recent = tracking_history(lambda model: model.transition_date >= since)
+    return dict(db.session.execute(
+        db.select(recent.c.warehouse_id, db.func.sum(recent.c.quantity)).group_by(recent.c.warehouse_id)).all())
+
+def sql_top_farmers(snapshot, since):
+    from app import db
+    from app.models import Product, User, tracking_history
+    received = tracking_history(lambda model: model.status == 'received')
+    total = db.func.sum(received.c.quantity)
+    return [(username, kg) for username, kg in db.session.execute(
+        db.select(User.username, total).join(Product, Product.id == received.c.product_id)
+        .join(User, User.id == Product.farmer_id).group_by(User.id, User.username)
+        .order_by(total.desc(), User.id).limit(10))]
+
+QUESTIONS = {
+    'shipped_per_type_per_week': dict(snapshot=snapshot_weekly, sql=sql_weekly),
+    'per_warehouse_last_30_days': dict(snapshot=snapshot_warehouses, sql=sql_warehouses),
+    'top_farmers_received': dict(snapshot=snapshot_top_farmers, sql=sql_top_farmers),
+}
+
+def orm_answers(since):
+    """The same answers from ProductTracking and ArchivedTracking objects, summed in Python"""
+    from app import db
+    from app.analytics import BUCKET_WIDTHS, WEEK_ORIGIN, epoch
+    from app.models import ArchivedTracking, ProductTracking, User
+    weekly, warehouses, received = defaultdict(float), defaultdict(float), defaultdict(float)
+    for model in (ProductTracking, ArchivedTracking):
+        query = db.session.query(model).options(db.joinedload(model.product)).yield_per(10000)
+        for tracking in query:
+            if tracking.status == 'shipped':
+                week = (epoch(tracking.transition_date) - WEEK_ORIGIN) // BUCKET_WIDTHS['week']
+                weekly[tracking.product.product_type, week * BUCKET_WIDTHS['week'] + WEEK_ORIGIN] += tracking.quantity
+            if tracking.transition_date >= since:
+                warehouses[tracking.warehouse_id] += tracking.quantity
+            if tracking.status == 'received':
+                received[tracking.product.farmer_id] += tracking.quantity
+        db.session.expunge_all()
+    top = sorted(received.items(), key=lambda item: (-item[1], item[0]))[:10]
+    names = dict(db.session.execute(db.select(User.id, User.username)
+                                    .where(User.id.in_([farmer_id for farmer_id, _ in top]))).all())
+    return dict(shipped_per_type_per_week=dict(weekly), per_warehouse_last_30_days=dict(warehouses),
+                top_farmers_received=[(names[farmer_id], kg) for farmer_id, kg in top])
+
+def same(left, right):
+    """Answers agree, allowing for float summation order"""
+    if isinstance(left, dict):
+        return left.keys() == right.keys() and all(abs(left[k] - right[k]) < 1e-6 * max(1, abs(left[k]))
+                                                   for k in left)
+    return [name for name, _ in left] == [name for name, _ in right] and same(dict(left), dict(right))
+
+def timed(function, repeat):
+    """(median ms, last result) of `repeat` calls"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 1), result
+
+def run(products, transfers, days, repeat, orm, seed):
+    directory = tempfile.mkdtemp()
+    try:
+        config = type('Config', (BenchmarkConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'bench.db')})
+        from app import create_app, db
+        from app.analytics import TrackingSnapshot
+        from app.generator import generate_data
+        app = create_app(config)
+        with app.app_context():
+            started = time.perf_counter()
+            counts = generate_data(farmers=max(10, products // 100), products=products, transfers=transfers,
+                                   days=days, seed=seed)
+            generated = round(time.perf_counter() - started, 1)
+            since = datetime.utcnow() - timedelta(days=30)
+
+            snapshot = TrackingSnapshot()
+            started = time.perf_counter()
+            snapshot.refresh()
+            load = round(time.perf_counter() - started, 2)
+            refresh_ms, _ = timed(snapshot.refresh, repeat)
+            columns = snapshot.columns()
+            memory = sum(column.nbytes for column in columns.values())
+
+            results = dict(trackings=snapshot.length, generate_seconds=generated, load_seconds=load,
+                           refresh_ms=refresh_ms, memory_mb=round(memory / 2 ** 20, 1), questions={})
+            scanned = None
+            if orm:
+                # One scan of every row answers all three questions
+                started = time.perf_counter()
+                scanned = orm_answers(since)
+                results['orm_seconds'] = round(time.perf_counter() - started, 1)
+            for question, methods in QUESTIONS.items():
+                timings, answers = {}, {}
+                for method, function in methods.items():
+                    timings[f'{method}_ms'], answers[method] = timed(lambda: function(snapshot, since), repeat)
+                if scanned:
+                    answers['orm'] = scanned[question]
+                results['questions'][question] = dict(
+                    timings, agree=all(same(answers['snapshot'], answer) for answer in answers.values()))
+            db.session.remove()
+            results['generated'] = counts
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=120000)
+    parser.add_argument('--transfers', type=float, default=3.0, help='average warehouse moves per product')
+    parser.add_argument('--days', type=int, default=365, help='length of the generated history')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per method')
+    parser.add_argument('--no-orm', dest='orm', action='store_false', help='skip the ORM scan')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    result = run(args.products, args.transfers, args.days, args.repeat, args.orm, args.seed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{result['trackings']} tracking events; snapshot loaded in {result['load_seconds']}s, "
+          f"{result['memory_mb']} MB, no-op refresh {result['refresh_ms']} ms")
+    if 'orm_seconds' in result:
+        print(f"ORM scan answering all three: {result['orm_seconds']}s")
+    print(f"{'ms':<30}{'snapshot':>10}{'sql':>10}{'agree':>10}")
+    for question, timing in result['questions'].items():
+        print(f"{question:<30}{timing['snapshot_ms']:>10}{timing['sql_ms']:>10}{str(timing['agree']):>10}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Hot-path latency before and after archiving finished tracking chains.
+
+A year of history is generated into a fresh SQLite file and the hot routes are
+timed, along with single tracking writes. Then every chain shipped or rejected
+more than --older-than-days ago is moved to the archive table and the same
+routes and writes are timed again.
+
+    python -m benchmarks.archive [--products 20000] [--days 365]
+                                 [--older-than-days 30] [--requests 20] [--json]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.routes import BenchmarkConfig, percentile, route_params, time_routes
+
+# Routes whose queries touch product_tracking on every request
+HOT_ROUTES = [
+    ('plant_manager', '/dashboard'),
+    ('warehouse_manager', '/dashboard'),
+    ('farmer', '/dashboard'),
+    ('plant_manager', '/products?status=stored'),
+    ('plant_manager', '/product/{product}'),
+    ('plant_manager', '/warehouse/{plant}'),
+    ('plant_manager', '/trace/{product_hash}'),
+    ('plant_manager', '/api/search?q=minor+bruising'),
+]
+
+def time_writes(writes):
+    """Record `writes` tracking events for products still in progress; returns latency in ms"""
+    from app import db
+    from app.models import ProductState
+    from app.tracking import record_tracking
+    in_progress = db.session.execute(
+        db.select(ProductState.product_id, ProductState.warehouse_id, ProductState.quantity)
+        .where(ProductState.status == 'stored').limit(writes)).all()
+    timings = []
+    for product_id, warehouse_id, quantity in in_progress:
+        started = time.perf_counter()
+        record_tracking(product_id, warehouse_id, 'stored', quantity, quality_notes='Benchmark recount')
+        db.session.commit()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return dict(p50_ms=round(statistics.median(timings), 2), p95_ms=round(percentile(timings, 0.95), 2))
+
+def table_sizes():
+    from app import db
+    from app.models import ArchivedTracking, ProductTracking
+    return dict(hot=db.session.query(ProductTracking).count(), archived=db.session.query(ArchivedTracking).count())
+
+def run(products, days, older_than_days, requests, seed):
+    directory = tempfile.mkdtemp()
+    try:
+        config = type('Config', (BenchmarkConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'bench.db')})
+        from app import create_app, db
+        from app.archive import archive_finished_chains
+        from app.generator import generate_data
+        app = create_app(config)
+        phases = {}
+        with app.app_context():
+            generate_data(farmers=max(10, products // 100), products=products, days=days, seed=seed)
+            params, users = route_params(seed)
+            engine = db.engine
+        for phase in ('before', 'after'):
+            with app.app_context():
+                if phase == 'after':
+                    started = time.perf_counter()
+                    archived = archive_finished_chains(older_than_days)
+                    archive_seconds = round(time.perf_counter() - started, 1)
+                sizes = table_sizes()
+                writes = time_writes(requests)
+                db.session.remove()
+            phases[phase] = dict(tables=sizes, writes=writes,
+                                 routes=time_routes(app, engine, HOT_ROUTES, params, users, requests))
+        engine.dispose()
+        return dict(archived=dict(products=archived[0], trackings=archived[1], seconds=archive_seconds), **phases)
+    finally:
+        shutil.rmtree(directory)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=365, help='length of the generated history')
+    parser.add_argument('--older-than-days', type=int, default=30)
+    parser.add_argument('--requests', type=int, default=20, help='timed requests per route and timed writes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    result = run(args.products, args.days, args.older_than_days, args.requests, args.seed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    archived, before, after = result['archived'], result['before'], result['after']
+    print(f"Archived {archived['trackings']} tracking events of {archived['products']} products "
+          f"in {archived['seconds']}s; hot table {before['tables']['hot']} -> {after['tables']['hot']} rows")
+    print(f"{'p50 ms':<58}{'before':>9}{'after':>9}")
+    for route, timing in before['routes'].items():
+        print(f"{route:<58}{timing['p50_ms']:>9}{after['routes'][route]['p50_ms']:>9}")
+    print(f"{'tracking write':<58}{before['writes']['p50_ms']:>9}{after['writes']['p50_ms']:>9}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Login throughput, and the latency of other routes, during a login storm.
+
+One process serves the seeded app from a threaded server, the way a threaded
+worker runs it. Storm clients sign in over and over while reader clients,
+signed in beforehand, browse product listings. Each password hash pool size is
+run once without the storm, for a baseline, and once with it.
+
+    python -m benchmarks.logins [--pool 1,8] [--rounds 12] [--storm 8] [--readers 2] [--duration 10] [--json]
+"""
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.throughput import login
+
+READ_PATH = '/products'
+
+def build_app(directory, rounds, pool):
+    """Create a seeded app on a database file in directory, hashing on `pool` threads"""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    os.environ['SEED_TEST_DATA'] = '1'
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(rounds)
+    from app import create_app
+    config = type('Config', (), dict(PASSWORD_HASH_WORKERS=pool, PASSWORD_HASH_BACKLOG=64))
+    return create_app(config)
+
+def start_server(app, sock):
+    from werkzeug.serving import ThreadedWSGIServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, lambda *args: os._exit(0))
+        server = ThreadedWSGIServer('127.0.0.1', sock.getsockname()[1], app, fd=sock.fileno())
+        server.serve_forever()
+        os._exit(0)
+    return pid
+
+def sign_in(connection):
+    """One full login, form and post, as the sample farmer; returns the response status"""
+    connection.request('GET', '/login')
+    response = connection.getresponse()
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', response.read().decode()).group(1)
+    cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+    body = urlencode({'csrf_token': token, 'username': 'farmer1', 'password': 'password123'})
+    connection.request('POST', '/login', body=body, headers={
+        'Content-Type': 'application/x-www-form-urlencoded', 'Cookie': cookie})
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+def storm(port, start, duration, results):
+    """Sign in repeatedly; put ('storm', latencies, busy, errors) on results"""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    time.sleep(max(0, start - time.time()))
+    latencies, busy, errors = [], 0, 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        status = sign_in(connection)
+        if status == 302:
+            latencies.append(time.perf_counter() - started)
+        elif status == 503:
+            busy += 1
+        else:
+            errors += 1
+    results.put(('storm', latencies, busy, errors))
+
+def reader(port, start, duration, results):
+    """Sign in before the start, then browse; put ('reader', latencies, 0, errors) on results"""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    cookie = login(connection)
+    time.sleep(max(0, start - time.time()))
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        connection.request('GET', READ_PATH, headers={'Cookie': cookie})
+        response = connection.getresponse()
+        response.read()
+        if response.status == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors += 1
+    results.put(('reader', latencies, 0, errors))
+
+def percentile(values, fraction):
+    return round(values[max(0, int(len(values) * fraction) - 1)] * 1000, 1) if values else None
+
+def measure(app, storm_clients, readers, duration):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+    pid = start_server(app, sock)
+    try:
+        # Everyone starts together, once the readers have signed in
+        start = time.time() + 2 + readers * 0.5
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=storm, args=(port, start, duration, results))
+                     for _ in range(storm_clients)]
+        processes += [multiprocessing.Process(target=reader, args=(port, start, duration, results))
+                      for _ in range(readers)]
+        for process in processes:
+            process.start()
+        samples = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        sock.close()
+
+    logins = sorted(l for kind, sample, _, _ in samples if kind == 'storm' for l in sample)
+    reads = sorted(l for kind, sample, _, _ in samples if kind == 'reader' for l in sample)
+    return dict(logins=len(logins), logins_per_s=round(len(logins) / duration, 1),
+                login_p50_ms=percentile(logins, 0.5), busy=sum(b for _, _, b, _ in samples),
+                errors=sum(e for _, _, _, e in samples), reads=len(reads),
+                read_p50_ms=percentile(reads, 0.5), read_p99_ms=percentile(reads, 0.99))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pool', default='1,8', help='comma-separated password hash pool sizes to compare')
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt cost')
+    parser.add_argument('--storm', type=int, default=8, help='clients signing in concurrently')
+    parser.add_argument('--readers', type=int, default=2, help='clients browsing during the storm')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    multiprocessing.set_start_method('fork')
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for pool in map(int, args.pool.split(',')):
+            app = build_app(directory, args.rounds, pool)
+            for storm_clients in (0, args.storm):
+                results.append(dict(pool=pool, storm=storm_clients,
+                                    **measure(app, storm_clients, args.readers, args.duration)))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'pool':>5}{'storm':>7}{'logins/s':>10}{'login p50':>11}{'busy':>6}"
+          f"{'reads':>7}{'read p50':>10}{'read p99':>10}{'errors':>8}")
+    for r in results:
+        print(f"{r['pool']:>5}{r['storm']:>7}{r['logins_per_s']:>10}{str(r['login_p50_ms']):>11}{r['busy']:>6}"
+              f"{r['reads']:>7}{str(r['read_p50_ms']):>10}{str(r['read_p99_ms']):>10}{r['errors']:>8}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Route latency and query-count benchmark at several data sizes.
+
+For each size a fresh SQLite file is filled by the data generator, then every
+route in ROUTES is requested through the test client with caching off. Results
+can be saved as a baseline and later runs compared against it.
+
+    python -m benchmarks.routes [--sizes 1000,10000] [--requests 20]
+                                [--save] [--compare] [--baseline PATH] [--json]
+
+Exits with status 1 when --compare finds a regression.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baselines', 'routes.json')
+
+# (role, url); placeholders are filled from the generated data
+ROUTES = [
+    ('plant_manager', '/dashboard'),
+    ('warehouse_manager', '/dashboard'),
+    ('farmer', '/dashboard'),
+    ('plant_manager', '/products'),
+    ('plant_manager', '/products?status=stored'),
+    ('plant_manager', '/products?after={middle_product}'),
+    ('farmer', '/products'),
+    ('plant_manager', '/product/{product}'),
+    ('plant_manager', '/warehouse/{plant}'),
+    ('warehouse_manager', '/warehouse/{store}'),
+    ('plant_manager', '/warehouses'),
+    ('plant_manager', '/api/trends?type=processing'),
+    ('plant_manager', '/trace/{product_hash}'),
+    ('plant_manager', '/api/search?q=minor+bruising'),
+]
+
+# A route regresses when its median is this much slower than the baseline (both limits),
+# or when it issues more queries than it used to
+LATENCY_TOLERANCE = 0.25
+LATENCY_FLOOR_MS = 2.0
+
+class BenchmarkConfig:
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    CACHE_BACKEND = 'null'
+    SEED_TEST_DATA = False
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def route_params(seed):
+    """(URL placeholders, {role: username}) for data generated with this seed"""
+    from app import db
+    from app.models import Product, User, Warehouse
+    farmer = db.session.scalar(db.select(User.username).where(User.role == 'farmer').order_by(User.id))
+    product_ids = list(db.session.scalars(db.select(Product.id).order_by(Product.id)))
+    params = dict(
+        product=product_ids[len(product_ids) // 3],
+        product_hash=db.session.scalar(db.select(Product.unique_hash).where(
+            Product.id == product_ids[len(product_ids) // 3])),
+        middle_product=product_ids[len(product_ids) // 2],
+        plant=db.session.scalar(db.select(Warehouse.id).where(Warehouse.type == 'processing')),
+        store=db.session.scalar(db.select(Warehouse.id).where(Warehouse.type == 'warehouse')),
+    )
+    prefix = f'gen{seed}'
+    users = {'farmer': farmer, 'plant_manager': f'{prefix}_plant_manager',
+             'warehouse_manager': f'{prefix}_warehouse_manager'}
+    return params, users
+
+def time_routes(app, engine, routes, params, users, requests):
+    """Request each (role, url) route `requests` times; returns {route: latency and query counts}"""
+    from app import db
+    # Requests run outside the setup app context; sharing it would share flask.g,
+    # where the logged-in user is cached, between the clients
+    queries = []
+    listener = lambda *args: queries.append(1)
+    db.event.listen(engine, 'before_cursor_execute', listener)
+    clients = {}
+    results = {}
+    try:
+        for role, template in routes:
+            if role not in clients:
+                clients[role] = app.test_client()
+                clients[role].post('/login', data={'username': users[role], 'password': 'password123'})
+            client, url = clients[role], template.format(**params)
+            client.get(url)  # warm-up
+            timings, counts_per_request = [], []
+            for _ in range(requests):
+                queries.clear()
+                started = time.perf_counter()
+                response = client.get(url)
+                response.get_data()
+                timings.append((time.perf_counter() - started) * 1000)
+                counts_per_request.append(len(queries))
+                if response.status_code != 200:
+                    raise RuntimeError(f'{role} {url} returned {response.status_code}')
+            timings.sort()
+            results[f'{role} {template}'] = dict(
+                p50_ms=round(statistics.median(timings), 2),
+                p95_ms=round(percentile(timings, 0.95), 2),
+                max_ms=round(timings[-1], 2),
+                queries=max(counts_per_request))
+    finally:
+        db.event.remove(engine, 'before_cursor_execute', listener)
+    return results
+
+def bench_size(products, requests, seed):
+    """Generate `products` products and time every route; returns {route: result}"""
+    directory = tempfile.mkdtemp()
+    try:
+        config = type('Config', (BenchmarkConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'bench.db')})
+        from app import create_app, db
+        from app.generator import generate_data
+        app = create_app(config)
+        with app.app_context():
+            started = time.perf_counter()
+            counts = generate_data(farmers=max(10, products // 100), products=products, seed=seed,
+                                   transfers=3.0)
+            load_seconds = time.perf_counter() - started
+            params, users = route_params(seed)
+            db.session.remove()
+            engine = db.engine
+
+        results = time_routes(app, engine, ROUTES, params, users, requests)
+        engine.dispose()
+        return dict(rows=counts, load_seconds=round(load_seconds, 1), routes=results)
+    finally:
+        shutil.rmtree(directory)
+
+def compare(results, baseline):
+    """List human-readable regressions of results against a baseline"""
+    regressions = []
+    for size, current in results.items():
+        previous = baseline.get('sizes', {}).get(size)
+        if previous is None:
+            continue
+        for route, now in current['routes'].items():
+            before = previous['routes'].get(route)
+            if before is None:
+                continue
+            slower = now['p50_ms'] - before['p50_ms']
+            if slower > LATENCY_FLOOR_MS and now['p50_ms'] > before['p50_ms'] * (1 + LATENCY_TOLERANCE):
+                regressions.append(f"{size} products, {route}: p50 {before['p50_ms']} -> {now['p50_ms']} ms")
+            if now['queries'] > before['queries']:
+                regressions.append(f"{size} products, {route}: {before['queries']} -> {now['queries']} queries")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000', help='comma-separated product counts')
+    parser.add_argument('--requests', type=int, default=20, help='timed requests per route')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='fail on regressions against the baseline')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes.split(','):
+        results[size] = bench_size(int(size), args.requests, args.seed)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for size, result in results.items():
+            rows = result['rows']
+            print(f"\n{size} products, {rows['trackings']} tracking events (loaded in {result['load_seconds']}s)")
+            print(f"{'route':<58}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'queries':>9}")
+            for route, r in result['routes'].items():
+                print(f"{route:<58}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['max_ms']:>9}{r['queries']:>9}")
+
+    status = 0
+    if args.compare:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        status = 1 if regressions else 0
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(recorded=datetime.utcnow().isoformat(timespec='seconds'), sizes=results), f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
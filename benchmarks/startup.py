@@ -0,0 +1,69 @@
+"""Startup time benchmark: package import time and create_app() wall time.
+
+Each sample runs in a fresh interpreter so module caches do not hide import cost.
+
+    python -m benchmarks.startup [--repeat N] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in the child interpreter; prints one JSON sample
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import app
+from app import create_app
+imported = time.perf_counter()
+
+class Config:
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SEED_TEST_DATA = {seed}
+
+create_app(Config)
+created = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'create_app': created - imported}}))
+'''
+
+def sample(seed):
+    """Time one cold import and create_app() in a new interpreter"""
+    env = dict(os.environ)
+    env.pop('SEED_TEST_DATA', None)
+    output = subprocess.run([sys.executable, '-c', PROBE.format(seed=seed)], cwd=ROOT, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def run(repeat):
+    """Median and spread of each phase, with and without sample data"""
+    results = {}
+    for label, seed in (('empty', False), ('seeded', True)):
+        samples = [sample(seed) for _ in range(repeat)]
+        for phase in ('import', 'create_app'):
+            times = [s[phase] for s in samples]
+            results[f'{label}.{phase}'] = dict(median_ms=round(statistics.median(times) * 1000, 2),
+                                               min_ms=round(min(times) * 1000, 2),
+                                               max_ms=round(max(times) * 1000, 2))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per configuration')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'measurement':<20}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for name, timing in results.items():
+        print(f"{name:<20}{timing['median_ms']:>12.2f}{timing['min_ms']:>10.2f}{timing['max_ms']:>10.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""Request throughput against a file-backed database, single- vs multi-process.
+
+The app is created (and seeded) once in the parent and the listening socket is
+shared by forked single-threaded workers, the way a preloading prefork WSGI
+server runs it. Client processes log in and replay a read-heavy mix of product
+listings, trend queries and small tracking batches.
+
+    python -m benchmarks.throughput [--workers 1,4] [--clients 8] [--duration 10] [--json]
+"""
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+EXTRA_PRODUCTS = 2000
+# (weight, method, path); batches are built per request
+WORKLOAD = [
+    (4, 'GET', '/products'),
+    (2, 'GET', '/products?status=received'),
+    (2, 'GET', '/api/trends?type=processing'),
+    (1, 'POST', '/api/trackings/batch'),
+]
+
+def build_app(directory):
+    """Create a seeded app on a database file in directory"""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    os.environ['SEED_TEST_DATA'] = '1'
+    from app import create_app, db
+    from app.models import Product, User
+    from app.tracking import rebuild_product_state
+
+    app = create_app()
+    with app.app_context():
+        farmer_id = db.session.scalar(db.select(User.id).where(User.username == 'farmer1'))
+        db.session.execute(Product.__table__.insert(), [
+            dict(unique_hash=f'bench-{i:064d}'[-64:], farmer_id=farmer_id, product_type='tomato',
+                 quantity=100.0, quality_grade='A') for i in range(EXTRA_PRODUCTS)])
+        rebuild_product_state()
+        db.session.commit()
+        product_ids = list(db.session.scalars(db.select(Product.id)))
+        db.session.remove()
+    return app, product_ids
+
+def start_workers(app, sock, count):
+    """Fork count workers serving app from the shared listening socket"""
+    from werkzeug.serving import BaseWSGIServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    pids = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, lambda *args: os._exit(0))
+            server = BaseWSGIServer('127.0.0.1', sock.getsockname()[1], app, fd=sock.fileno())
+            server.serve_forever()
+            os._exit(0)
+        pids.append(pid)
+    return pids
+
+def login(connection):
+    """Log in as the sample plant manager and return the session cookie"""
+    connection.request('GET', '/login')
+    response = connection.getresponse()
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', response.read().decode()).group(1)
+    cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+    body = urlencode({'csrf_token': token, 'username': 'plant_manager', 'password': 'password123'})
+    connection.request('POST', '/login', body=body, headers={
+        'Content-Type': 'application/x-www-form-urlencoded', 'Cookie': cookie})
+    response = connection.getresponse()
+    response.read()
+    return response.getheader('Set-Cookie').split(';', 1)[0]
+
+def client(port, duration, product_ids, seed, results):
+    """Issue requests for duration seconds; put (latencies, errors) on results"""
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    cookie = login(connection)
+    weighted = [(method, path) for weight, method, path in WORKLOAD for _ in range(weight)]
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        method, path = rng.choice(weighted)
+        headers = {'Cookie': cookie}
+        body = None
+        if method == 'POST':
+            body = json.dumps({'events': [
+                dict(product_id=rng.choice(product_ids), warehouse_id=1, status='received', quantity=10.0)
+                for _ in range(5)]})
+            headers['Content-Type'] = 'application/json'
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            ok = False
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        if ok:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors += 1
+    results.put((latencies, errors))
+
+def measure(app, product_ids, workers, clients, duration):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+    pids = start_workers(app, sock, workers)
+    try:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client, args=(port, duration, product_ids, i, results))
+                     for i in range(clients)]
+        for process in processes:
+            process.start()
+        samples = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        sock.close()
+
+    latencies = sorted(l for sample, _ in samples for l in sample)
+    errors = sum(e for _, e in samples)
+    return dict(workers=workers, clients=clients, requests=len(latencies), errors=errors,
+                requests_per_s=round(len(latencies) / duration, 1),
+                p50_ms=round(statistics.median(latencies) * 1000, 1) if latencies else None,
+                p95_ms=round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1) if latencies else None)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default='1,4', help='comma-separated worker counts to compare')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    multiprocessing.set_start_method('fork')
+    directory = tempfile.mkdtemp()
+    try:
+        app, product_ids = build_app(directory)
+        results = [measure(app, product_ids, int(workers), args.clients, args.duration)
+                   for workers in args.workers.split(',')]
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'workers':>8}{'clients':>9}{'requests':>10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}")
+    for r in results:
+        print(f"{r['workers']:>8}{r['clients']:>9}{r['requests']:>10}{r['requests_per_s']:>9}"
+              f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['errors']:>8}")
+
+if __name__ == '__main__':
+    main()
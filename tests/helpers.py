@@ -0,0 +1,52 @@
+import uuid
+from contextlib import contextmanager
+from sqlalchemy import event
+from app import db
+from app.models import User, Warehouse, Product
+
+class TestConfig:
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    BCRYPT_LOG_ROUNDS = 4
+    SEED_TEST_DATA = False
+
+def create_user(username, role, password='pass', **kwargs):
+    """Create and commit a user with a cheap password hash"""
+    user = User(username=username, email=f'{username}@test.com', role=role, **kwargs)
+    user.set_password(password)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+def create_warehouse(name='Test Plant', type='processing', capacity=1000.0, **kwargs):
+    warehouse = Warehouse(name=name, type=type, location='Test', capacity=capacity, **kwargs)
+    db.session.add(warehouse)
+    db.session.commit()
+    return warehouse
+
+def create_products(farmer, count, **kwargs):
+    """Bulk create products for a farmer, returning them in insertion order"""
+    fields = dict(product_type='tomato', quantity=100.0, quality_grade='A')
+    fields.update(kwargs)
+    products = [Product(farmer_id=farmer.id, unique_hash=uuid.uuid4().hex, **fields) for _ in range(count)]
+    db.session.add_all(products)
+    db.session.commit()
+    return products
+
+def login(client, username, password='pass'):
+    return client.post('/login', data={'username': username, 'password': password})
+
+@contextmanager
+def capture_queries():
+    """Collect (statement, parameters) for every SQL statement executed on the app's engine"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
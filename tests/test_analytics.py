@@ -0,0 +1,182 @@
+import re
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.analytics import TrackingSnapshot, epoch
+from app.archive import archive_finished_chains
+from app.models import Product, ProductTracking, Warehouse, tracking_history
+from app.tracking import record_tracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+# A Wednesday
+START = datetime(2024, 1, 3, 8)
+
+class TestTrackingSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        self.other = create_user('other', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+        self.store = create_warehouse('Test Store', 'warehouse', 1e6)
+        self.tomatoes = create_products(self.farmer, 3)
+        self.carrots = create_products(self.other, 2, product_type='carrot')
+        for day, product in enumerate(self.tomatoes + self.carrots):
+            self.chain(product, day * 2, [(self.plant, 'received', 100.0 + day), (self.plant, 'processing', 90.0),
+                                          (self.store, 'stored', 80.0), (self.store, 'shipped', 70.0 + day)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def chain(self, product, day, steps):
+        for hours, (warehouse, status, quantity) in enumerate(steps):
+            record_tracking(product.id, warehouse.id, status, quantity,
+                            transition_date=START + timedelta(days=day, hours=hours))
+
+    def sql_totals(self, column, status=None, start=None):
+        history = tracking_history()
+        query = (db.select(column, db.func.sum(history.c.quantity))
+                 .join(Product, Product.id == history.c.product_id)
+                 .join(Warehouse, Warehouse.id == history.c.warehouse_id)
+                 .group_by(column))
+        if status:
+            query = query.where(history.c.status == status)
+        if start:
+            query = query.where(history.c.transition_date >= start)
+        return dict(db.session.execute(query).all())
+
+    def test_groups_match_sql(self):
+        snapshot = TrackingSnapshot()
+        self.assertEqual(snapshot.refresh(), 20)
+        totals = {snapshot.label('product_type', g['key']): g['kg']
+                  for g in snapshot.aggregate('product_type', status='shipped')}
+        self.assertEqual(totals, self.sql_totals(Product.product_type, 'shipped'))
+        totals = {g['key']: g['kg'] for g in snapshot.aggregate('farmer', start=START + timedelta(days=3))}
+        self.assertEqual(totals, self.sql_totals(Product.farmer_id, start=START + timedelta(days=3)))
+        totals = {snapshot.label('warehouse_type', g['key']): g['kg'] for g in snapshot.aggregate('warehouse_type')}
+        self.assertEqual(totals, self.sql_totals(Warehouse.type))
+        statuses = {snapshot.label('status', g['key']): g['events'] for g in snapshot.aggregate('status')}
+        self.assertEqual(statuses, dict(received=5, processing=5, stored=5, shipped=5))
+
+    def test_weekly_buckets_start_on_monday(self):
+        snapshot = TrackingSnapshot()
+        snapshot.refresh()
+        groups = snapshot.aggregate('product_type', status='received', granularity='week')
+        monday = datetime(2024, 1, 1)
+        tomato = snapshot.product_types.index('tomato')
+        carrot = snapshot.product_types.index('carrot')
+        # Tomatoes are received on 3, 5 and 7 January, carrots on the following Tuesday and Thursday
+        self.assertEqual([(g['key'], g['bucket'], g['kg'], g['events']) for g in groups], [
+            (tomato, epoch(monday), 303.0, 3), (carrot, epoch(monday + timedelta(days=7)), 207.0, 2)])
+        days = snapshot.aggregate('warehouse', status='received', granularity='day')
+        self.assertEqual([g['bucket'] for g in days],
+                         [epoch(datetime(2024, 1, 3) + timedelta(days=2 * n)) for n in range(5)])
+
+    def test_refresh_appends_only_new_events(self):
+        snapshot = TrackingSnapshot()
+        snapshot.refresh()
+        pepper = create_products(self.farmer, 1, product_type='pepper')[0]
+        record_tracking(pepper.id, self.plant.id, 'received', 40.0, transition_date=START)
+        db.session.commit()
+        self.assertEqual(snapshot.refresh(), 1)
+        self.assertEqual(snapshot.refresh(), 0)
+        totals = {snapshot.label('product_type', g['key']): g['kg']
+                  for g in snapshot.aggregate('product_type', status='received')}
+        self.assertEqual(totals, dict(tomato=303.0, carrot=207.0, pepper=40.0))
+
+    def test_refresh_picks_up_late_commits_below_the_newest_id(self):
+        # On PostgreSQL a lower id can commit after higher ones; a row put back under its old id stands in
+        table = ProductTracking.__table__
+        late = db.session.execute(db.select(table).where(table.c.status == 'received')
+                                  .order_by(table.c.id).limit(1)).one()._asdict()
+        db.session.execute(table.delete().where(table.c.id == late['id']))
+        db.session.commit()
+        snapshot, narrow = TrackingSnapshot(), TrackingSnapshot(window=1)
+        self.assertEqual((snapshot.refresh(), narrow.refresh()), (19, 19))
+        db.session.execute(table.insert(), [late])
+        db.session.commit()
+        self.assertEqual(snapshot.refresh(), 1)
+        self.assertEqual(snapshot.refresh(), 0)
+        fresh = TrackingSnapshot()
+        fresh.refresh()
+        self.assertEqual(snapshot.aggregate('farmer'), fresh.aggregate('farmer'))
+        # Ids further below the newest than the window are not checked again
+        self.assertEqual(narrow.refresh(), 0)
+
+    def test_products_and_warehouses_committed_during_a_refresh(self):
+        snapshot = TrackingSnapshot()
+        snapshot.refresh()
+        load_trackings = TrackingSnapshot._load_trackings
+
+        def interleaved(snapshot):
+            # Committed by another worker while this one is refreshing
+            depot = create_warehouse('Depot', 'depot', 1e6)
+            onion, = create_products(self.other, 1, product_type='onion')
+            record_tracking(onion.id, depot.id, 'received', 40.0, transition_date=START)
+            db.session.commit()
+            return load_trackings(snapshot)
+
+        with mock.patch.object(TrackingSnapshot, '_load_trackings', interleaved):
+            self.assertEqual(snapshot.refresh(), 1)
+        fresh = TrackingSnapshot()
+        fresh.refresh()
+        for by in ('product_type', 'farmer', 'warehouse_type'):
+            self.assertEqual(snapshot.aggregate(by), fresh.aggregate(by))
+        self.assertIn('onion', [snapshot.label('product_type', g['key']) for g in snapshot.aggregate('product_type')])
+
+    def test_archived_history_is_included(self):
+        before = TrackingSnapshot()
+        before.refresh()
+        self.assertEqual(archive_finished_chains(30, now=START + timedelta(days=90)), (4, 16))
+        after = TrackingSnapshot()
+        after.refresh()
+        self.assertEqual(after.length, 20)
+        self.assertEqual(after.aggregate('farmer'), before.aggregate('farmer'))
+        # Rows the running snapshot already holds are not read again from either table
+        self.assertEqual(before.refresh(), 0)
+        # Archived ids in the window do not make every refresh list the window's ids
+        with capture_queries() as statements:
+            self.assertEqual(after.refresh(), 0)
+        self.assertFalse([s for s, _ in statements if re.match(r'SELECT product_tracking.id\s+FROM', s)])
+
+    def test_top_groups(self):
+        snapshot = TrackingSnapshot()
+        snapshot.refresh()
+        top = snapshot.top('farmer', 1, status='shipped')
+        self.assertEqual([(g['key'], g['kg']) for g in top], [(self.farmer.id, 213.0)])
+        top = snapshot.top('warehouse', 5)
+        self.assertEqual([g['key'] for g in top], [self.plant.id, self.store.id])
+
+    def test_json_endpoint(self):
+        login(self.client, 'manager')
+        data = self.client.get('/api/analytics?by=farmer&status=shipped&top=1').get_json()
+        self.assertEqual(data['groups'], [dict(key=self.farmer.id, label='farmer', kg=213.0, events=3)])
+        data = self.client.get('/api/analytics?by=warehouse_type&status=received&granularity=week').get_json()
+        self.assertEqual([(g['label'], g['bucket'], g['kg']) for g in data['groups']],
+                         [('processing', '2024-01-01T00:00:00', 303.0),
+                          ('processing', '2024-01-08T00:00:00', 207.0)])
+        record_tracking(self.carrots[0].id, self.store.id, 'stored', 10.0, transition_date=START)
+        db.session.commit()
+        data = self.client.get(f'/api/analytics?by=status&warehouse_id={self.store.id}').get_json()
+        self.assertEqual({g['label']: g['events'] for g in data['groups']}, dict(stored=6, shipped=5))
+
+    def test_json_endpoint_validation_and_access(self):
+        login(self.client, 'manager')
+        self.assertEqual(self.client.get('/api/analytics?by=colour').status_code, 400)
+        self.assertEqual(self.client.get('/api/analytics?status=lost').status_code, 400)
+        self.assertEqual(self.client.get('/api/analytics?granularity=year').status_code, 400)
+        self.assertEqual(self.client.get('/api/analytics?top=3&granularity=day').status_code, 400)
+        self.assertEqual(self.client.get('/api/analytics?start=yesterday').status_code, 400)
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get('/api/analytics').status_code, 403)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import ProductTracking, ProductState, Warehouse
+from app.tracking import record_trackings
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+class TestBatchIngestion(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        self.manager = create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1000.0)
+        self.store = create_warehouse('Test Store', 'warehouse', 100.0)
+        self.products = create_products(self.farmer, 3)
+        login(self.client, 'manager')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def event(self, product, warehouse, status, quantity, **kwargs):
+        return dict(product_id=product.id, warehouse_id=warehouse.id, status=status, quantity=quantity, **kwargs)
+
+    def post(self, events):
+        return self.client.post('/api/trackings/batch', json={'events': events})
+
+    def stock(self, warehouse):
+        return db.session.get(Warehouse, warehouse.id).current_stock
+
+    def test_batch_is_written_with_aggregated_stock(self):
+        events = [self.event(p, self.plant, 'processing', 100.0) for p in self.products]
+        events.append(self.event(self.products[0], self.plant, 'shipped', 50.0, quality_notes='Out'))
+        with capture_queries() as statements:
+            response = self.post(events)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['created'], 4)
+        self.assertEqual(self.stock(self.plant), 250.0)
+        self.assertEqual(db.session.get(ProductState, self.products[0].id).status, 'shipped')
+        self.assertEqual(sum(1 for s, _ in statements if s.startswith('UPDATE warehouse')), 1)
+        self.assertEqual(sum(1 for s, _ in statements if s.startswith('INSERT INTO product_tracking')), 1)
+
+    def test_idempotency_keys_prevent_double_counting(self):
+        events = [self.event(self.products[0], self.plant, 'stored', 10.0, idempotency_key='scan-1'),
+                  self.event(self.products[1], self.plant, 'stored', 10.0, idempotency_key='scan-2'),
+                  self.event(self.products[1], self.plant, 'stored', 10.0, idempotency_key='scan-2')]
+        first = self.post(events).json
+        self.assertEqual([r['status'] for r in first['results']], ['created', 'created', 'duplicate'])
+        self.assertEqual(first['results'][1]['tracking_id'], first['results'][2]['tracking_id'])
+
+        retry = self.post(events).json
+        self.assertEqual(retry['duplicate'], 3)
+        self.assertEqual(retry['results'][0]['tracking_id'], first['results'][0]['tracking_id'])
+        self.assertEqual(self.stock(self.plant), 20.0)
+        self.assertEqual(ProductTracking.query.filter(ProductTracking.idempotency_key.isnot(None)).count(), 2)
+
+    def test_invalid_and_rejected_items_are_reported(self):
+        events = [self.event(self.products[0], self.plant, 'stored', 10.0),
+                  self.event(self.products[1], self.plant, 'teleported', 10.0),
+                  dict(product_id=99999, warehouse_id=self.plant.id, status='stored', quantity=0),
+                  self.event(self.products[2], self.store, 'stored', 80.0),
+                  self.event(self.products[2], self.store, 'stored', 80.0)]
+        body = self.post(events).json
+        statuses = [r['status'] for r in body['results']]
+        self.assertEqual(statuses, ['created', 'invalid', 'invalid', 'rejected', 'rejected'])
+        self.assertIn('status', body['results'][1]['errors'])
+        self.assertEqual(set(body['results'][2]['errors']), {'product_id', 'quantity'})
+        self.assertEqual(self.stock(self.plant), 10.0)
+        self.assertEqual(self.stock(self.store), 0.0)
+
+    def test_malformed_fields_are_invalid_items(self):
+        stored = self.event(self.products[0], self.plant, 'stored', 10.0)
+        events = [dict(stored, product_id=[1]), dict(stored, product_id={'id': 1}), dict(stored, product_id=True),
+                  self.event(self.products[0], self.plant, 'stored', 'inf'),
+                  self.event(self.products[0], self.plant, 'stored', 'nan'),
+                  self.event(self.products[0], self.plant, 'stored', 10.0)]
+        response = self.post(events)
+        self.assertEqual(response.status_code, 200)
+        errors = [r.get('errors') for r in response.json['results']]
+        self.assertEqual(errors[:3], [{'product_id': ['Unknown product.']}] * 3)
+        self.assertEqual(errors[3:], [{'quantity': ['Must be a finite number.']}] * 2 + [None])
+        self.assertEqual(self.stock(self.plant), 10.0)
+
+    def test_offset_timestamps_are_stored_as_utc(self):
+        events = [self.event(self.products[0], self.plant, 'received', 10.0,
+                             transition_date='2024-01-01T10:00:00+05:00'),
+                  self.event(self.products[1], self.plant, 'received', 10.0, transition_date='2024-01-01T10:00:00')]
+        self.assertEqual(self.post(events).json['created'], 2)
+        dates = [t.transition_date for t in ProductTracking.query.order_by(ProductTracking.id)]
+        self.assertEqual(dates, [datetime(2024, 1, 1, 5), datetime(2024, 1, 1, 10)])
+
+    def test_malformed_payloads(self):
+        self.assertEqual(self.client.post('/api/trackings/batch', json={'events': []}).status_code, 400)
+        self.assertEqual(self.client.post('/api/trackings/batch', data='nope').status_code, 400)
+        self.app.config['TRACKING_BATCH_LIMIT'] = 2
+        events = [self.event(p, self.plant, 'received', 1.0) for p in self.products]
+        self.assertEqual(self.post(events).status_code, 413)
+
+    def test_farmers_cannot_ingest(self):
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        response = self.post([self.event(self.products[0], self.plant, 'received', 1.0)])
+        self.assertEqual(response.status_code, 403)
+
+class TestTrends(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+        self.store = create_warehouse('Test Store', 'warehouse', 1e6)
+        product = create_products(self.farmer, 1)[0]
+        now = datetime.utcnow()
+        record_trackings([
+            dict(product_id=product.id, warehouse_id=self.plant.id, status='received', quantity=100.0,
+                 transition_date=now - timedelta(days=2)),
+            dict(product_id=product.id, warehouse_id=self.plant.id, status='processing', quantity=90.0,
+                 transition_date=now - timedelta(days=1)),
+            dict(product_id=product.id, warehouse_id=self.store.id, status='stored', quantity=85.0,
+                 transition_date=now),
+        ])
+        db.session.commit()
+        login(self.client, 'manager')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_daily_trend_for_one_warehouse(self):
+        body = self.client.get(f'/api/trends?warehouse_id={self.plant.id}&periods=3').json
+        self.assertEqual(body['granularity'], 'day')
+        self.assertEqual([b['quantity']['received'] for b in body['buckets']], [100.0, 0.0, 0.0])
+        self.assertEqual([b['quantity']['processing'] for b in body['buckets']], [0.0, 90.0, 0.0])
+        self.assertEqual(sum(b['quantity']['stored'] for b in body['buckets']), 0.0)
+
+    def test_hourly_trend_by_warehouse_type(self):
+        body = self.client.get('/api/trends?granularity=hour&type=warehouse').json
+        self.assertEqual(len(body['buckets']), 48)
+        self.assertEqual(body['buckets'][-1]['quantity']['stored'], 85.0)
+        self.assertEqual(body['buckets'][-1]['events'], 1)
+
+    def test_invalid_and_forbidden_requests(self):
+        self.assertEqual(self.client.get('/api/trends?granularity=week').status_code, 400)
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get('/api/trends').status_code, 403)
+
+    def test_dashboard_shows_throughput(self):
+        response = self.client.get('/dashboard')
+        self.assertIn(b'Throughput - Last 7 Days', response.data)
+        self.assertIn(b'90.0', response.data)
+
+if __name__ == '__main__':
+    unittest.main()
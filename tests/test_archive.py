@@ -0,0 +1,145 @@
+import csv
+import io
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.archive import archive_finished_chains
+from app.models import ArchivedTracking, ProductTracking, StageTransition, TrackingRollup
+from app.search import search
+from app.tracking import (record_tracking, record_trackings, check_product_state, rebuild_rollups,
+                          rebuild_stage_transitions)
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login
+
+START = datetime(2024, 1, 1, 8)
+NOW = datetime(2024, 6, 1)
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+        self.store = create_warehouse('Test Store', 'warehouse', 1e6)
+        self.shipped, self.rejected, self.stored, self.recent, self.newest = create_products(self.farmer, 5)
+        self.chain(self.shipped, [(self.plant, 'received', 100.0, 0, 'Firm'), (self.plant, 'processing', 95.0, 1, None),
+                                  (self.store, 'stored', 95.0, 2, None), (self.store, 'shipped', 95.0, 3, None)])
+        self.chain(self.rejected, [(self.plant, 'received', 50.0, 0, None),
+                                   (self.plant, 'rejected', 50.0, 1, 'Mouldy crates')])
+        self.chain(self.stored, [(self.plant, 'received', 80.0, 0, None), (self.store, 'stored', 80.0, 1, None)])
+        self.chain(self.recent, [(self.plant, 'received', 60.0, 24 * 140, None),
+                                 (self.plant, 'rejected', 60.0, 24 * 140 + 1, None)])
+        # The newest row in the table belongs to an old finished chain
+        self.chain(self.newest, [(self.plant, 'received', 40.0, 5, None), (self.plant, 'rejected', 40.0, 6, None)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def chain(self, product, steps):
+        for warehouse, status, quantity, hours, notes in steps:
+            record_tracking(product.id, warehouse.id, status, quantity, quality_notes=notes,
+                            transition_date=START + timedelta(hours=hours))
+
+    def archive(self):
+        return archive_finished_chains(30, batch_size=2, now=NOW)
+
+    def history(self, model, product):
+        return [(t.id, t.status) for t in model.query.filter_by(product_id=product.id).order_by(model.id)]
+
+    def test_only_old_finished_chains_move_with_their_ids(self):
+        before = self.history(ProductTracking, self.shipped)
+        self.assertEqual(self.archive(), (2, 6))
+        self.assertEqual(self.history(ArchivedTracking, self.shipped), before)
+        self.assertEqual(self.history(ProductTracking, self.shipped), [])
+        self.assertEqual(len(self.history(ArchivedTracking, self.rejected)), 2)
+        for product in (self.stored, self.recent, self.newest):
+            self.assertEqual(self.history(ArchivedTracking, product), [])
+        # Already archived chains are not picked up again
+        self.assertEqual(self.archive(), (0, 0))
+
+    def test_derived_tables_are_unchanged_and_rebuild_the_same(self):
+        rollups = sorted(db.session.execute(db.select(
+            TrackingRollup.granularity, TrackingRollup.warehouse_id, TrackingRollup.bucket_start,
+            TrackingRollup.status, TrackingRollup.quantity, TrackingRollup.events)).all())
+        transitions = [(t.tracking_id, t.from_status, t.to_status, t.dwell_seconds)
+                       for t in StageTransition.query.order_by(StageTransition.tracking_id)]
+        self.archive()
+        self.assertEqual(check_product_state(), [])
+        rebuild_rollups()
+        rebuild_stage_transitions()
+        self.assertEqual(sorted(db.session.execute(db.select(
+            TrackingRollup.granularity, TrackingRollup.warehouse_id, TrackingRollup.bucket_start,
+            TrackingRollup.status, TrackingRollup.quantity, TrackingRollup.events)).all()), rollups)
+        self.assertEqual([(t.tracking_id, t.from_status, t.to_status, t.dwell_seconds)
+                          for t in StageTransition.query.order_by(StageTransition.tracking_id)], transitions)
+
+    def test_new_event_restores_the_history(self):
+        self.archive()
+        record_tracking(self.rejected.id, self.plant.id, 'received', 50.0, transition_date=NOW)
+        db.session.commit()
+        self.assertEqual(self.history(ArchivedTracking, self.rejected), [])
+        self.assertEqual([status for _, status in self.history(ProductTracking, self.rejected)],
+                         ['received', 'rejected', 'received'])
+        self.assertEqual(check_product_state(), [])
+        transitions = StageTransition.query.filter_by(product_id=self.rejected.id).order_by(StageTransition.ended_at)
+        self.assertEqual([(t.from_status, t.to_status) for t in transitions],
+                         [(None, 'received'), ('received', 'rejected'), ('rejected', 'received')])
+
+    def test_replayed_event_is_still_a_duplicate_once_archived(self):
+        tracking = ProductTracking.query.filter_by(product_id=self.rejected.id, status='rejected').one()
+        tracking.idempotency_key = 'dock3-000123'
+        event = dict(product_id=self.rejected.id, warehouse_id=self.plant.id, status='rejected', quantity=50.0,
+                     transition_date=tracking.transition_date, idempotency_key='dock3-000123')
+        tracking_id = tracking.id
+        db.session.commit()
+        self.archive()
+        self.assertEqual(record_trackings([event]), [('duplicate', tracking_id)])
+        db.session.commit()
+        self.assertEqual(self.history(ProductTracking, self.rejected), [])
+        self.assertEqual(db.session.get(ArchivedTracking, tracking_id).idempotency_key, 'dock3-000123')
+
+    def test_product_and_trace_views_read_archived_history(self):
+        self.archive()
+        login(self.client, 'manager')
+        response = self.client.get(f'/product/{self.shipped.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Archived', response.data)
+        self.assertIn(b'Firm', response.data)
+
+        trace = self.client.get(f'/trace/{self.shipped.unique_hash}?format=json').get_json()
+        self.assertEqual([step['status'] for step in trace['chain']], ['received', 'processing', 'stored', 'shipped'])
+        self.assertEqual(trace['current_status'], 'shipped')
+
+    def test_warehouse_view_includes_archived_history_on_request(self):
+        self.archive()
+        login(self.client, 'manager')
+        hidden = self.client.get(f'/warehouse/{self.plant.id}')
+        self.assertNotIn(b'Mouldy crates', hidden.data)
+        self.assertIn(b'Include archived history', hidden.data)
+        shown = self.client.get(f'/warehouse/{self.plant.id}?archived=1')
+        self.assertIn(b'Mouldy crates', shown.data)
+        self.assertIn(b'Hide archived history', shown.data)
+
+    def test_export_and_search_cover_the_archive(self):
+        self.archive()
+        login(self.client, 'manager')
+        rows = list(csv.DictReader(io.StringIO(self.client.get(
+            f'/api/trackings/export?warehouse_id={self.plant.id}').get_data(as_text=True))))
+        self.assertEqual(len(rows), 9)
+        self.assertEqual([r['transition_date'] for r in rows], sorted(r['transition_date'] for r in rows))
+
+        results = search('mouldy', 10)
+        self.assertEqual([(r['product_id'], r['status']) for r in results], [(self.rejected.id, 'rejected')])
+
+    def test_command(self):
+        result = self.app.test_cli_runner().invoke(args=['archive-trackings', '--older-than-days', '3650'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Archived 0 tracking events of 0 products.', result.output)
+
+if __name__ == '__main__':
+    unittest.main()
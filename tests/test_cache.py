@@ -0,0 +1,155 @@
+import unittest
+from app import create_app, db, cache
+from app.cache import MemoryCache
+from app.models import Warehouse
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestMemoryCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = MemoryCache(max_entries=3, default_ttl=10, clock=self.clock)
+
+    def test_entries_expire_after_their_ttl(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=60)
+        self.clock.now = 10
+        self.assertEqual(self.cache.get('a'), (False, None))
+        self.assertEqual(self.cache.get('b'), (True, 2))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for key in 'abc':
+            self.cache.set(key, key)
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+        self.assertEqual(self.cache.get('b'), (False, None))
+        self.assertEqual([self.cache.get(key)[0] for key in 'acd'], [True, True, True])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidate_drops_only_tagged_entries(self):
+        self.cache.set('farmer', 1, tags=['farmer:1'])
+        self.cache.set('plant', 2, tags=['warehouse-type:processing'])
+        self.cache.set('both', 3, tags=['farmer:1', 'warehouse-type:warehouse'])
+        self.cache.invalidate('farmer:1')
+        self.assertEqual(self.cache.get('farmer'), (False, None))
+        self.assertEqual(self.cache.get('both'), (False, None))
+        self.assertEqual(self.cache.get('plant'), (True, 2))
+
+    def test_stats_count_hits_and_misses(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('a')
+        self.cache.get('missing')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 1, 1))
+        self.assertEqual(stats['hit_ratio'], round(2 / 3, 4))
+
+class TestDashboardCache(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+        self.store = create_warehouse('Test Store', 'warehouse', 1e6)
+        self.product = create_products(self.farmer, 1)[0]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def dashboard(self):
+        with capture_queries() as statements:
+            response = self.client.get('/dashboard')
+        self.assertEqual(response.status_code, 200)
+        return response, [s for s, _ in statements if 'product_tracking' in s]
+
+    def track(self, warehouse):
+        return self.client.post(f'/product/{self.product.id}/track', data={
+            'warehouse_id': warehouse.id, 'status': 'received', 'quantity': 50.0})
+
+    def test_repeat_views_are_served_from_cache(self):
+        login(self.client, 'manager')
+        first, queries = self.dashboard()
+        self.assertTrue(queries)
+        second, queries = self.dashboard()
+        self.assertEqual(queries, [])
+        self.assertEqual(first.data, second.data)
+        self.assertGreaterEqual(cache.stats()['hits'], 1)
+
+    def test_tracking_invalidates_matching_dashboards_only(self):
+        login(self.client, 'manager')
+        self.dashboard()
+        self.track(self.store)
+        _, queries = self.dashboard()
+        self.assertEqual(queries, [])
+
+        self.track(self.plant)
+        response, queries = self.dashboard()
+        self.assertTrue(queries)
+        self.assertIn(b'50.0 kg', response.data)
+
+    def test_farmer_dashboard_refreshes_after_writes(self):
+        login(self.client, 'farmer')
+        self.dashboard()
+        self.client.post('/product/new', data={'product_type': 'carrot', 'quantity': 75.0, 'quality_grade': 'B'})
+        response, _ = self.dashboard()
+        self.assertIn(b'Carrot', response.data)
+
+        self.client.get('/logout')
+        login(self.client, 'manager')
+        self.track(self.store)
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        response, _ = self.dashboard()
+        self.assertIn(b'Test Store', response.data)
+
+    def test_new_warehouse_appears_on_manager_dashboard(self):
+        login(self.client, 'manager')
+        self.dashboard()
+        self.client.post('/warehouse/new', data={'name': 'Second Plant', 'type': 'processing',
+                                                 'location': 'North', 'capacity': 500.0})
+        self.assertIsNotNone(Warehouse.query.filter_by(name='Second Plant').first())
+        response, _ = self.dashboard()
+        self.assertIn(b'Second Plant', response.data)
+
+    def test_batch_ingestion_invalidates_dashboards(self):
+        login(self.client, 'manager')
+        self.dashboard()
+        self.client.post('/api/trackings/batch', json={'events': [
+            {'product_id': self.product.id, 'warehouse_id': self.plant.id, 'status': 'processing', 'quantity': 42.0}]})
+        response, queries = self.dashboard()
+        self.assertTrue(queries)
+        self.assertIn(b'42.0 kg', response.data)
+
+    def test_stats_endpoint(self):
+        login(self.client, 'manager')
+        self.dashboard()
+        self.dashboard()
+        stats = self.client.get('/api/cache/stats').json
+        self.assertEqual(stats['backend'], 'memory')
+        self.assertGreaterEqual(stats['hits'], 1)
+        self.assertGreaterEqual(stats['misses'], 1)
+
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get('/api/cache/stats').status_code, 403)
+
+    def test_null_backend_disables_caching(self):
+        class NoCacheConfig(TestConfig):
+            CACHE_BACKEND = 'null'
+        app = create_app(NoCacheConfig)
+        with app.app_context():
+            self.assertEqual(app.extensions['cache'].stats()['backend'], 'null')
+
+if __name__ == '__main__':
+    unittest.main()
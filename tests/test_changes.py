@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from app import create_app, db
+from app.models import ChangeLog, Product
+from app.tracking import record_tracking, StockError
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+class TestChangeFeed(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=100.0)
+        self.product = create_products(self.farmer, 1)[0]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def feed(self, **params):
+        query = '&'.join(f'{name}={value}' for name, value in params.items())
+        return self.client.get(f'/api/changes?{query}').get_json()
+
+    def test_tracking_write_logs_the_event_and_new_stock_in_its_transaction(self):
+        tracking = record_tracking(self.product.id, self.plant.id, 'processing', 60.0, quality_notes='Washed')
+        db.session.commit()
+        with self.assertRaises(StockError):
+            record_tracking(self.product.id, self.plant.id, 'processing', 60.0)
+        db.session.rollback()
+
+        changes = ChangeLog.query.order_by(ChangeLog.seq).all()
+        self.assertEqual([(c.entity, c.entity_id, c.action) for c in changes],
+                         [('warehouse', self.plant.id, 'stock'), ('tracking', tracking.id, 'created')])
+        self.assertEqual(changes[0].data, {'id': self.plant.id, 'current_stock': 60.0})
+        self.assertEqual(changes[1].data['quality_notes'], 'Washed')
+        self.assertEqual(changes[1].data['transition_date'], tracking.transition_date.isoformat())
+
+    def test_batches_log_with_one_insert_per_entity(self):
+        login(self.client, 'manager')
+        events = [dict(product_id=self.product.id, warehouse_id=self.plant.id, status='received', quantity=10.0)
+                  for _ in range(5)]
+        with capture_queries() as statements:
+            self.client.post('/api/trackings/batch', json={'events': events})
+        self.assertEqual(sum(1 for s, _ in statements if s.startswith('INSERT INTO change_log')), 1)
+        self.assertEqual(ChangeLog.query.filter_by(entity='tracking').count(), 5)
+
+    def test_created_products_and_warehouses(self):
+        login(self.client, 'farmer')
+        self.client.post('/product/new', data={'product_type': 'potato', 'variety': 'Russet',
+                                               'quantity': 250.0, 'quality_grade': 'B'})
+        self.client.get('/logout')
+        login(self.client, 'manager')
+        self.client.post('/warehouse/new', data={'name': 'North Store', 'type': 'warehouse',
+                                                 'location': 'North', 'capacity': 500.0})
+        product = Product.query.filter_by(product_type='potato').one()
+        changes = self.feed()['changes']
+        self.assertEqual([(c['entity'], c['action']) for c in changes],
+                         [('product', 'created'), ('warehouse', 'created')])
+        self.assertEqual(changes[0]['data']['unique_hash'], product.unique_hash)
+        self.assertEqual(changes[1]['data']['current_stock'], 0.0)
+
+    def test_cursor_paging(self):
+        for quantity in (10.0, 20.0, 30.0):
+            record_tracking(self.product.id, self.plant.id, 'stored', quantity)
+        db.session.commit()
+        login(self.client, 'manager')
+        first = self.feed(limit=4)
+        self.assertEqual(len(first['changes']), 4)
+        self.assertTrue(first['has_more'])
+        second = self.feed(since=first['next_cursor'], limit=4)
+        self.assertEqual(len(second['changes']), 2)
+        self.assertFalse(second['has_more'])
+        seqs = [c['seq'] for c in first['changes'] + second['changes']]
+        self.assertEqual(seqs, sorted(set(seqs)))
+        idle = self.feed(since=second['next_cursor'])
+        self.assertEqual((idle['changes'], idle['next_cursor']), ([], second['next_cursor']))
+
+    def test_reading_from_a_cursor_uses_the_primary_key(self):
+        login(self.client, 'manager')
+        with capture_queries() as statements:
+            self.feed(since=5)
+        statement, parameters = next((s, p) for s, p in statements if 'FROM change_log' in s)
+        plan = ' '.join(row[3] for row in db.session.connection().exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + statement, tuple(parameters)))
+        self.assertIn('INTEGER PRIMARY KEY', plan)
+
+    def test_validation_access_and_empty_long_poll(self):
+        login(self.client, 'manager')
+        for query in ('since=-1', 'limit=0', 'limit=5000', 'wait=60'):
+            self.assertEqual(self.client.get(f'/api/changes?{query}').status_code, 400, query)
+        started = time.monotonic()
+        self.assertEqual(self.feed(wait=0.3)['changes'], [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get('/api/changes').status_code, 403)
+
+class TestChangeLongPoll(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = type('Config', (TestConfig,), dict(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.directory, 'test.db')))
+        self.app = create_app(config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=100.0)
+        self.product = create_products(self.farmer, 1)[0]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.directory)
+
+    def test_waiting_request_returns_when_a_change_commits(self):
+        client = self.app.test_client()
+        login(client, 'manager')
+        response = {}
+
+        def poll():
+            started = time.monotonic()
+            response['body'] = client.get('/api/changes?wait=10').get_json()
+            response['seconds'] = time.monotonic() - started
+
+        waiter = threading.Thread(target=poll)
+        waiter.start()
+        time.sleep(0.3)
+        record_tracking(self.product.id, self.plant.id, 'received', 10.0)
+        db.session.commit()
+        waiter.join(10)
+        self.assertEqual([c['entity'] for c in response['body']['changes']], ['tracking'])
+        self.assertLess(response['seconds'], 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from app import create_app, db
+from app.database import database_url, engine_options
+from app.models import Warehouse
+from tests.helpers import TestConfig, create_warehouse
+
+class TestDatabaseConfig(unittest.TestCase):
+    def test_url_from_environment(self):
+        with mock.patch.dict(os.environ, {'DATABASE_URL': 'postgres://farm@db/portal'}):
+            self.assertEqual(database_url(), 'postgresql://farm@db/portal')
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(database_url(), 'sqlite:///:memory:')
+
+    def test_pool_options_skip_in_memory_sqlite(self):
+        config = dict(DB_POOL_SIZE=5, DB_MAX_OVERFLOW=10, DB_POOL_TIMEOUT=30, DB_POOL_RECYCLE=1800)
+        self.assertEqual(engine_options(dict(config, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')), {})
+
+        options = engine_options(dict(config, SQLALCHEMY_DATABASE_URI='postgresql://farm@db/portal',
+                                      SQLALCHEMY_ENGINE_OPTIONS={'pool_size': 20}))
+        self.assertEqual(options['pool_size'], 20)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['pool_recycle'], 1800)
+
+class TestFileDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = type('FileConfig', (TestConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.tmpdir, 'portal.db'),
+            'SQLITE_BUSY_TIMEOUT_MS': 2500,
+        })
+        self.app = create_app(config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pragmas_applied_on_connect(self):
+        with db.engine.connect() as connection:
+            pragma = lambda name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+            self.assertEqual(pragma('journal_mode'), 'wal')
+            self.assertEqual(pragma('synchronous'), 1)  # NORMAL
+            self.assertEqual(pragma('busy_timeout'), 2500)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_forked_child_gets_fresh_connections(self):
+        warehouse_id = create_warehouse().id
+        db.session.remove()
+        self.assertGreater(db.engine.pool.checkedin(), 0)
+
+        pid = os.fork()
+        if pid == 0:
+            # Exit code reports whether the child started with an empty pool and can query
+            try:
+                fresh = db.engine.pool.checkedin() == 0
+                found = db.session.get(Warehouse, warehouse_id) is not None
+                os._exit(0 if fresh and found else 1)
+            except BaseException:
+                os._exit(2)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        # The parent's pooled connections were left alone by the child
+        self.assertIsNotNone(db.session.get(Warehouse, warehouse_id))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from datetime import datetime
+from app import create_app, db
+from app.generator import generate_data
+from app.models import User, Warehouse, Product, ProductTracking, ProductState, TrackingRollup
+from app.tracking import STOCK_EFFECTS, check_product_state
+from tests.helpers import TestConfig
+
+END = datetime(2024, 6, 1)
+
+class TestGenerator(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def snapshot(self):
+        return (db.session.execute(db.select(Product.unique_hash, Product.product_type, Product.quantity,
+                                             Product.created_at).order_by(Product.id)).all(),
+                db.session.execute(db.select(ProductTracking.product_id, ProductTracking.warehouse_id,
+                                             ProductTracking.status, ProductTracking.quantity,
+                                             ProductTracking.transition_date).order_by(ProductTracking.id)).all())
+
+    def test_loads_consistent_history(self):
+        counts = generate_data(farmers=10, plants=2, stores=3, products=300, seed=7, end=END)
+        self.assertEqual(counts['products'], 300)
+        self.assertEqual(User.query.count(), 12)
+        self.assertEqual(Warehouse.query.count(), 5)
+        self.assertEqual(ProductTracking.query.count(), counts['trackings'])
+        self.assertGreater(counts['trackings'], 3 * 300)
+        # Products created just before the cut-off may not have been received yet
+        tracked = db.session.scalar(db.select(db.func.count(ProductTracking.product_id.distinct())))
+        self.assertGreater(tracked, 270)
+        self.assertEqual(ProductState.query.count(), tracked)
+        self.assertGreater(TrackingRollup.query.count(), 0)
+        self.assertEqual(check_product_state(), [])
+
+        # Chains start at a plant, move forward in time and end by the cut-off
+        first = db.session.execute(db.select(ProductTracking.warehouse_id, ProductTracking.status)
+                                   .order_by(ProductTracking.id).limit(1)).one()
+        self.assertEqual(db.session.get(Warehouse, first.warehouse_id).type, 'processing')
+        self.assertEqual(first.status, 'received')
+        self.assertLessEqual(db.session.scalar(db.func.max(ProductTracking.transition_date).select()), END)
+
+        # Stock matches the net effect of each warehouse's history and fits its capacity
+        for warehouse in Warehouse.query:
+            net = sum(STOCK_EFFECTS.get(t.status, 0) * t.quantity for t in warehouse.product_trackings)
+            self.assertAlmostEqual(warehouse.current_stock, net, delta=0.5)
+            self.assertLessEqual(warehouse.current_stock, warehouse.capacity)
+
+    def test_same_seed_same_data(self):
+        generate_data(farmers=5, products=100, seed=3, end=END)
+        first = self.snapshot()
+        db.drop_all()
+        db.create_all()
+        generate_data(farmers=5, products=100, seed=3, end=END)
+        self.assertEqual(self.snapshot(), first)
+
+    def test_different_seeds_can_share_a_database(self):
+        generate_data(farmers=5, products=50, seed=1, end=END)
+        generate_data(farmers=5, products=50, seed=2, end=END)
+        self.assertEqual(Product.query.count(), 100)
+
+    def test_cli_command(self):
+        result = self.app.test_cli_runner().invoke(args=['generate-data', '--products', '20', '--farmers', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Generated 20 products', result.output)
+
+if __name__ == '__main__':
+    unittest.main()
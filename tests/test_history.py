@@ -0,0 +1,155 @@
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.archive import archive_finished_chains
+from app.history import history_page, newest_trackings
+from app.models import ProductTracking
+from app.reference import invalidate_reference
+from app.tracking import record_tracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+START = datetime(2024, 3, 1, 8)
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('other', 'farmer')
+        self.manager = create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+        self.store = create_warehouse('Test Store', 'warehouse', 1e6)
+        self.products = create_products(self.farmer, 6)
+        # Two products share every timestamp, so pages must break ties on id
+        for index, product in enumerate(self.products):
+            day = timedelta(days=index // 2)
+            record_tracking(product.id, self.plant.id, 'received', 100.0, processed_by=self.manager.id,
+                            transition_date=START + day)
+            record_tracking(product.id, self.store.id, 'stored', 90.0, transition_date=START + day + timedelta(hours=2))
+            record_tracking(product.id, self.store.id, 'shipped', 90.0, transition_date=START + day + timedelta(hours=4))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def pages(self, per_page, **kwargs):
+        """Every page of a history, following the cursors"""
+        pages, cursor = [], None
+        while True:
+            rows, cursor = history_page(cursor=cursor, per_page=per_page, **kwargs)
+            pages.append([(t.transition_date, t.id) for t in rows])
+            if cursor is None:
+                return pages
+
+    def test_pages_cover_history_once_in_order(self):
+        pages = self.pages(4, warehouse_id=self.store.id)
+        rows = [row for page in pages for row in page]
+        self.assertEqual([len(page) for page in pages], [4, 4, 4])
+        self.assertEqual(rows, sorted(rows, reverse=True))
+        self.assertEqual(len(set(rows)), 12)
+
+    def test_archived_rows_merge_into_pages(self):
+        expected = [row for page in self.pages(100, warehouse_id=self.store.id) for row in page]
+        # The newest product's rows stay hot, so pages mix both tables
+        self.assertEqual(archive_finished_chains(30, now=START + timedelta(days=90)), (5, 15))
+        self.assertEqual([row for page in self.pages(5, warehouse_id=self.store.id) for row in page], expected)
+        hot = {t.id for t in ProductTracking.query}
+        self.assertEqual(self.pages(5, warehouse_id=self.store.id, include_archived=False),
+                         [[row for row in expected if row[1] in hot]])
+
+    def test_filters(self):
+        rows, _ = history_page(warehouse_id=self.store.id, status='shipped', start=START + timedelta(days=1),
+                               end=START + timedelta(days=2))
+        self.assertEqual([(t.product_id, t.status) for t in rows],
+                         [(self.products[3].id, 'shipped'), (self.products[2].id, 'shipped')])
+        rows, _ = history_page(product_id=self.products[0].id)
+        self.assertEqual([t.status for t in rows], ['shipped', 'stored', 'received'])
+
+    def test_newest_trackings_across_warehouses(self):
+        expected = ProductTracking.query.order_by(ProductTracking.transition_date.desc(),
+                                                  ProductTracking.id.desc()).limit(5).all()
+        self.assertEqual(newest_trackings([self.plant.id, self.store.id], limit=5), expected)
+        self.assertEqual([t.status for t in newest_trackings([self.plant.id], limit=3)], ['received'] * 3)
+        self.assertEqual(newest_trackings([]), [])
+
+    def test_page_queries_do_not_grow_with_rows(self):
+        counts, store_id = [], self.store.id
+        for per_page in (2, 10):
+            # Start cold each time, so neither page finds users or products already loaded
+            invalidate_reference('users')
+            db.session.expunge_all()
+            with capture_queries() as statements:
+                rows, _ = history_page(warehouse_id=store_id, per_page=per_page, include_archived=False)
+                for tracking in rows:
+                    (tracking.product.farmer.username, tracking.warehouse.name,
+                     tracking.processor.username if tracking.processor else None)
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_warehouse_view_pages_and_filters(self):
+        login(self.client, 'manager')
+        with mock.patch('app.history.HISTORY_PAGE_SIZE', 4):
+            response = self.client.get(f'/warehouse/{self.plant.id}?status=received')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data.count(b'<td>Tomato</td>'), 4)
+            self.assertIn(b'Load more', response.data)
+            _, cursor = history_page(warehouse_id=self.plant.id, status='received')
+            response = self.client.get(f'/warehouse/{self.plant.id}?status=received&after={cursor}')
+            self.assertEqual(response.data.count(b'<td>Tomato</td>'), 2)
+            self.assertNotIn(b'Load more', response.data)
+        # Totals cover the whole history, not the page
+        self.assertIn(b'<span class="h4 text-primary">6</span>', response.data)
+        self.assertEqual(self.client.get(f'/warehouse/{self.plant.id}?after=yesterday').status_code, 400)
+        response = self.client.get(f'/warehouse/{self.plant.id}?status=lost')
+        self.assertIn(b'Unknown status.', response.data)
+
+    def test_product_view_filters(self):
+        login(self.client, 'manager')
+        url = f'/product/{self.products[0].id}'
+        response = self.client.get(url + '?status=stored')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<option value="stored" selected>', response.data)
+        self.assertEqual(response.data.count(b'<div class="timeline-item">'), 1)
+        response = self.client.get(url + '?end=2024-03-01T09:00')
+        self.assertEqual(response.data.count(b'<div class="timeline-item">'), 1)
+        response = self.client.get(url + '?start=2024-04-01')
+        self.assertIn(b'No Matching History', response.data)
+        # Totals count the whole history whatever the filter
+        self.assertIn(b'<span class="badge bg-secondary">3</span>', response.data)
+        self.assertIn(b'Unknown status.', self.client.get(url + '?status=lost').data)
+
+    def test_json_history(self):
+        login(self.client, 'manager')
+        url = f'/api/warehouses/{self.store.id}/history?status=stored'
+        with mock.patch('app.history.HISTORY_PAGE_SIZE', 4):
+            first = self.client.get(url).get_json()
+            second = self.client.get(url + '&after=' + first['next_cursor']).get_json()
+        self.assertEqual((len(first['items']), len(second['items'])), (4, 2))
+        self.assertIsNone(second['next_cursor'])
+        self.assertEqual({item['status'] for item in first['items'] + second['items']}, {'stored'})
+        self.assertEqual(len({item['id'] for item in first['items'] + second['items']}), 6)
+        self.assertEqual(first['items'][0]['warehouse'], 'Test Store')
+        self.assertEqual(self.client.get(f'/api/warehouses/{self.store.id}/history?after=x').status_code, 400)
+        self.assertEqual(self.client.get(f'/api/warehouses/{self.store.id}/history?end=soon').status_code, 400)
+        self.assertEqual(self.client.get('/api/warehouses/999/history').status_code, 404)
+
+        data = self.client.get(f'/api/products/{self.products[0].id}/history').get_json()
+        self.assertEqual([item['status'] for item in data['items']], ['shipped', 'stored', 'received'])
+        self.assertEqual(data['items'][2]['processed_by'], 'manager')
+        self.assertEqual(self.client.get('/api/products/999/history').status_code, 404)
+
+    def test_json_history_access(self):
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get(f'/api/warehouses/{self.store.id}/history').status_code, 403)
+        self.assertEqual(self.client.get(f'/api/products/{self.products[0].id}/history').status_code, 200)
+        self.client.get('/logout')
+        login(self.client, 'other')
+        self.assertEqual(self.client.get(f'/api/products/{self.products[0].id}/history').status_code, 403)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import logging
+import re
+import unittest
+from app import create_app, db
+from app.tracking import record_tracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login
+
+class InstrumentedConfig(TestConfig):
+    INSTRUMENTATION_ENABLED = True
+    CACHE_BACKEND = 'null'
+
+def server_timing(response):
+    """Parse a Server-Timing header into {name: (duration, description)}"""
+    return {name: (float(duration), description)
+            for name, duration, description in re.findall(r'(\w+);dur=([\d.]+)(?:;desc="([^"]*)")?',
+                                                          response.headers['Server-Timing'])}
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(InstrumentedConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        plant = create_warehouse(capacity=1e6)
+        for product in create_products(farmer, 3):
+            record_tracking(product.id, plant.id, 'received', 10.0)
+        db.session.commit()
+        login(self.client, 'manager')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_server_timing_reports_queries_and_render(self):
+        metrics = server_timing(self.client.get('/dashboard'))
+        db_ms, description = metrics['db']
+        self.assertRegex(description, r'^\d+ queries$')
+        self.assertGreater(int(description.split()[0]), 0)
+        self.assertGreater(metrics['render'][0], 0)
+        self.assertGreaterEqual(metrics['total'][0], db_ms)
+        self.assertIn('sql1', metrics)
+        self.assertNotIn('sql4', metrics)
+
+    def test_metrics_endpoint_aggregates_per_endpoint(self):
+        for _ in range(3):
+            self.client.get('/products')
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('http_request_duration_ms_count{endpoint="product.list_products"} 3', body)
+        self.assertIn('http_request_duration_ms_bucket{endpoint="product.list_products",le="+Inf"} 3', body)
+        self.assertRegex(body, r'http_request_queries_total\{endpoint="product.list_products"\} \d+')
+        self.assertIn('cache_misses_total', body)
+
+    def test_slow_requests_are_logged(self):
+        self.app.config['SLOW_REQUEST_MS'] = 0
+        with self.assertLogs(self.app.logger, logging.WARNING) as logs:
+            self.client.get('/products')
+        self.assertIn('Slow request GET /products (product.list_products)', logs.output[0])
+
+    def test_disabled_by_default(self):
+        app = create_app(TestConfig)
+        response = app.test_client().get('/login')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
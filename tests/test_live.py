@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from app import create_app, db
+from app.live import Broker
+from app.models import ChangeLog
+from app.tracking import record_tracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login
+
+def message(seq, warehouse_type, warehouse_id):
+    return dict(seq=seq, event='tracking', warehouse_type=warehouse_type, warehouse_id=warehouse_id, data={})
+
+class TestBroker(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        # Messages are published by hand here, not read from the change log
+        patcher = mock.patch.object(Broker, '_ensure_relay')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def drain(self, subscription):
+        messages = []
+        while (received := subscription.get(0)) is not None:
+            messages.append(received['seq'])
+        return messages
+
+    def test_one_publish_fans_out_to_hundreds_of_subscribers(self):
+        broker = Broker(self.app, max_pending=100)
+        filters = [(warehouse_type, warehouse_id) for warehouse_type in ('processing', 'warehouse')
+                   for warehouse_id in (None, 1, 2, 3, 4)]
+        subscriptions = [broker.subscribe(*filters[i % len(filters)]) for i in range(500)]
+        messages = [message(seq, 'processing' if seq % 3 else 'warehouse', seq % 4 + 1) for seq in range(1, 41)]
+        broker.publish(messages)
+
+        self.assertEqual(broker.published, 40)
+        for subscription in subscriptions:
+            expected = [m['seq'] for m in messages if m['warehouse_type'] == subscription.warehouse_type and
+                        subscription.warehouse_id in (None, m['warehouse_id'])]
+            self.assertEqual(self.drain(subscription), expected)
+
+    def test_lagging_subscriber_is_dropped_without_holding_up_others(self):
+        broker = Broker(self.app, max_pending=2)
+        slow, fast = broker.subscribe('processing'), broker.subscribe('processing')
+        broker.publish([message(1, 'processing', 1), message(2, 'processing', 1)])
+        self.assertEqual(self.drain(fast), [1, 2])
+        broker.publish([message(3, 'processing', 1)])
+
+        self.assertEqual(broker.subscriber_count, 1)
+        self.assertEqual([slow.get(0)['seq'], slow.get(0)['seq']], [1, 2])
+        with self.assertRaises(LookupError):
+            slow.get(0)
+        self.assertEqual(self.drain(fast), [3])
+
+class TestLiveDashboard(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = type('Config', (TestConfig,), dict(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.directory, 'test.db'), LIVE_KEEPALIVE=0.2))
+        self.app = create_app(config)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('plant', 'plant_manager')
+        create_user('keeper', 'warehouse_manager')
+        # Ids, since an open stream closes the session these objects belong to
+        self.plant = create_warehouse(capacity=1000.0).id
+        self.north = create_warehouse('North Store', type='warehouse', capacity=1000.0).id
+        self.south = create_warehouse('South Store', type='warehouse', capacity=1000.0).id
+        self.product = create_products(self.farmer, 1, product_type='carrot')[0].id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.directory)
+
+    def track(self, warehouse_id, status, quantity):
+        record_tracking(self.product, warehouse_id, status, quantity)
+        db.session.commit()
+
+    def events(self, response, keepalives=3):
+        """Events read from the stream until `keepalives` idle periods pass in a row"""
+        events, idle = [], 0
+        for chunk in response.iter_encoded():
+            chunk = chunk.decode()
+            if chunk.startswith(': keepalive'):
+                idle += 1
+                if idle == keepalives:
+                    break
+                continue
+            idle = 0
+            fields = dict(line.split(': ', 1) for line in chunk.strip().splitlines())
+            if 'event' in fields:
+                events.append((int(fields['id']), fields['event'], json.loads(fields['data'])))
+        response.close()
+        return events
+
+    def test_commits_are_pushed_to_an_open_stream(self):
+        login(self.client, 'plant')
+        response = self.client.get('/dashboard/live', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.track(self.plant, 'processing', 40.0)
+
+        events = self.events(response)
+        self.assertEqual([event for _, event, _ in events], ['stock', 'tracking'])
+        self.assertEqual(events[0][2], {'warehouse_id': self.plant, 'current_stock': 40.0, 'capacity': 1000.0})
+        tracking = events[1][2]
+        self.assertEqual((tracking['product_type'], tracking['farmer'], tracking['status'], tracking['quantity']),
+                         ('carrot', 'farmer', 'processing', 40.0))
+        self.assertEqual(self.app.extensions['live'].subscriber_count, 0)
+
+    def test_stream_only_carries_the_roles_warehouses(self):
+        login(self.client, 'keeper')
+        response = self.client.get(f'/dashboard/live?warehouse_id={self.north}', buffered=False)
+        self.track(self.plant, 'received', 40.0)
+        self.track(self.south, 'stored', 30.0)
+        self.track(self.north, 'stored', 20.0)
+        events = self.events(response)
+        self.assertEqual({data['warehouse_id'] for _, _, data in events}, {self.north})
+        self.assertEqual(len(events), 2)
+
+    def test_reconnect_replays_missed_changes(self):
+        self.track(self.plant, 'received', 40.0)
+        seen = db.session.scalar(db.select(db.func.max(ChangeLog.seq)))
+        self.track(self.plant, 'processing', 35.0)
+        login(self.client, 'plant')
+        response = self.client.get('/dashboard/live', headers={'Last-Event-ID': str(seen)}, buffered=False)
+        events = self.events(response, keepalives=1)
+        self.assertEqual([(event, data.get('status')) for _, event, data in events],
+                         [('stock', None), ('tracking', 'processing')])
+        self.assertTrue(all(seq > seen for seq, _, _ in events))
+
+    def test_roles_without_a_live_dashboard_are_refused(self):
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get('/dashboard/live').status_code, 403)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+from app import create_app, db
+from app.models import User
+from app.passwords import HashingPool, PasswordBusyError, hash_rounds
+from tests.helpers import TestConfig, create_user, login
+
+class TestHashingPool(unittest.TestCase):
+    def test_concurrency_is_capped_at_the_worker_count(self):
+        pool = HashingPool(workers=2, backlog=10, wait=5)
+        lock = threading.Lock()
+        running = dict(now=0, most=0)
+
+        def work():
+            with lock:
+                running['now'] += 1
+                running['most'] = max(running['most'], running['now'])
+            time.sleep(0.02)
+            with lock:
+                running['now'] -= 1
+
+        threads = [threading.Thread(target=pool.run, args=(work,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(running['most'], 2)
+        self.assertEqual(pool.status()['completed'], 8)
+
+    def test_full_backlog_turns_callers_away(self):
+        pool = HashingPool(workers=1, backlog=1, wait=0.05)
+        release = threading.Event()
+        holders = [threading.Thread(target=pool.run, args=(release.wait, 5)) for _ in range(2)]
+        for thread in holders:
+            thread.start()
+        time.sleep(0.05)
+        with self.assertRaises(PasswordBusyError):
+            pool.run(len, 'password')
+        release.set()
+        for thread in holders:
+            thread.join(5)
+        self.assertEqual(pool.run(len, 'password'), 8)
+        self.assertEqual(pool.status()['busy'], 1)
+
+class TestPasswordCost(unittest.TestCase):
+    def make_app(self, rounds, **overrides):
+        return create_app(type('Config', (TestConfig,), dict(BCRYPT_LOG_ROUNDS=rounds, **overrides)))
+
+    def test_new_hashes_use_the_configured_cost(self):
+        app = self.make_app(5)
+        with app.app_context():
+            user = create_user('farmer', 'farmer')
+            self.assertEqual(hash_rounds(user.password_hash), 5)
+            self.assertTrue(user.check_password('pass'))
+            self.assertFalse(user.check_password('wrong'))
+            db.drop_all()
+
+    def test_login_rehashes_at_a_changed_cost(self):
+        app = self.make_app(4)
+        with app.app_context():
+            create_user('farmer', 'farmer')
+            app.config['BCRYPT_LOG_ROUNDS'] = 5
+            client = app.test_client()
+            login(client, 'farmer', 'wrong')
+            self.assertEqual(hash_rounds(User.query.one().password_hash), 4)
+            self.assertEqual(login(client, 'farmer').status_code, 302)
+            db.session.expire_all()
+            self.assertEqual(hash_rounds(User.query.one().password_hash), 5)
+            client.get('/logout')
+            self.assertEqual(login(client, 'farmer').status_code, 302)
+            db.drop_all()
+
+    def test_login_answers_503_when_hashing_is_saturated(self):
+        app = self.make_app(4, PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_BACKLOG=0, PASSWORD_HASH_WAIT=0.05)
+        with app.app_context():
+            create_user('farmer', 'farmer')
+            release = threading.Event()
+            holder = threading.Thread(target=app.extensions['password_hashing'].run, args=(release.wait, 5))
+            holder.start()
+            time.sleep(0.05)
+            response = login(app.test_client(), 'farmer')
+            release.set()
+            holder.join(5)
+            self.assertEqual(response.status_code, 503)
+            self.assertIn(b'Too many people are signing in', response.data)
+            db.drop_all()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from app import create_app, db
+from app.tracking import record_tracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+class TestProductList(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        self.manager = create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def track(self, product, status, **kwargs):
+        record_tracking(product.id, self.plant.id, status, product.quantity,
+                        processed_by=self.manager.id, **kwargs)
+
+    def list_query_count(self, **params):
+        with capture_queries() as statements:
+            response = self.client.get('/products', query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def test_query_count_is_constant(self):
+        """Listing issues the same number of queries whatever the product count"""
+        login(self.client, 'manager')
+        for product in create_products(self.farmer, 10):
+            self.track(product, 'received')
+        db.session.commit()
+        small = self.list_query_count()
+
+        for product in create_products(self.farmer, 200):
+            self.track(product, 'received')
+            self.track(product, 'processing')
+        db.session.commit()
+        large = self.list_query_count()
+        filtered = self.list_query_count(status='processing', product_type='tomato')
+
+        self.assertEqual(small, large)
+        self.assertLessEqual(filtered, large)
+
+    def test_keyset_pagination_walks_every_product(self):
+        login(self.client, 'manager')
+        products = create_products(self.farmer, 120)
+        seen, after = [], None
+        while True:
+            response = self.client.get('/products', query_string={'after': after} if after else {})
+            page = [p for p in products if f'/product/{p.id}"'.encode() in response.data]
+            seen.extend(page)
+            cursor = response.data.split(b'after=')
+            if len(cursor) < 2:
+                break
+            after = int(cursor[1].split(b'"')[0].split(b'&')[0])
+        self.assertEqual(sorted(p.id for p in seen), [p.id for p in products])
+
+    def test_latest_status_filter(self):
+        login(self.client, 'manager')
+        shipped, stored, pending = create_products(self.farmer, 3)
+        self.track(shipped, 'stored')
+        self.track(shipped, 'shipped')
+        self.track(stored, 'received', transition_date=stored.created_at)
+        self.track(stored, 'stored')
+        db.session.commit()
+
+        response = self.client.get('/products?status=shipped')
+        self.assertIn(f'/product/{shipped.id}"'.encode(), response.data)
+        self.assertNotIn(f'/product/{stored.id}"'.encode(), response.data)
+
+        response = self.client.get('/products?status=pending')
+        self.assertIn(f'/product/{pending.id}"'.encode(), response.data)
+        self.assertNotIn(f'/product/{shipped.id}"'.encode(), response.data)
+
+    def test_farmer_only_sees_own_products(self):
+        other = create_user('other', 'farmer')
+        own = create_products(self.farmer, 1)[0]
+        foreign = create_products(other, 1)[0]
+        login(self.client, 'farmer')
+        response = self.client.get('/products')
+        self.assertIn(f'/product/{own.id}"'.encode(), response.data)
+        self.assertNotIn(f'/product/{foreign.id}"'.encode(), response.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import re
+import unittest
+from app import create_app, db
+from app.tracking import record_tracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+# Tables that grow with traffic. A plan may only scan one in index order, when the index
+# leads with the statement's ORDER BY column, a LIMIT stops the scan and no WHERE clause
+# can make it skip rows; anything else may read the whole table.
+LARGE_TABLES = ('product', 'product_tracking', 'product_state', 'archived_tracking', 'tracking_rollup',
+                'stage_transition', 'change_log')
+
+# (role, url) pairs rendered on every page view or dashboard refresh
+HOT_ROUTES = [
+    ('plant_manager', '/dashboard'),
+    ('warehouse_manager', '/dashboard'),
+    ('farmer', '/dashboard'),
+    ('plant_manager', '/products'),
+    ('plant_manager', '/products?status=stored'),
+    ('plant_manager', '/products?status=stored&after=1000'),
+    ('plant_manager', '/products?status=pending'),
+    ('plant_manager', '/products?after=1000'),
+    ('farmer', '/products'),
+    ('farmer', '/products?status=stored'),
+    ('plant_manager', '/product/{product_id}'),
+    ('plant_manager', '/warehouse/{warehouse_id}'),
+    ('plant_manager', '/warehouse/{warehouse_id}?status=stored&start=2024-01-01&archived=1'),
+    ('plant_manager', '/warehouse/{warehouse_id}?after=2099-01-01T00:00:00_1000'),
+    ('plant_manager', '/api/warehouses/{warehouse_id}/history?status=received&after=2099-01-01T00:00:00_1000'),
+    ('plant_manager', '/api/products/{product_id}/history'),
+    ('plant_manager', '/warehouses'),
+    ('plant_manager', '/trace/{product_hash}'),
+]
+
+# The farmer's recent activity sorts only that farmer's own history; driving it from the
+# global transition_date index instead would walk the whole table for an inactive farmer.
+# A trace merges one product's hot and archived steps, found by index, before sorting them.
+ALLOWED_SORTS = {('farmer', '/dashboard'), ('plant_manager', '/trace/{product_hash}')}
+
+# Pending products are the ones without a state row, and no index finds an absence. The list
+# walks products newest first until it has a page; new products are the ones still pending.
+ALLOWED_SCANS = {('plant_manager', '/products?status=pending')}
+
+class TestQueryPlans(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        farmer = create_user('farmer', 'farmer')
+        for role in ('plant_manager', 'warehouse_manager'):
+            create_user(f'test_{role}', role)
+        plant = create_warehouse()
+        store = create_warehouse('Test Store', 'warehouse', 5000.0)
+        self.product = create_products(farmer, 20)[0]
+        for product in create_products(farmer, 20):
+            record_tracking(product.id, plant.id, 'received', 100.0)
+            record_tracking(product.id, store.id, 'stored', 95.0)
+        db.session.commit()
+        self.params = {'product_id': self.product.id, 'warehouse_id': plant.id,
+                       'product_hash': self.product.unique_hash}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def explain(self, statement, parameters):
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [row[3] for row in cursor.fetchall()]
+        finally:
+            connection.close()
+
+    def ordered_scan(self, step, statement):
+        """Whether a scan step reads an index in the statement's ORDER BY order up to a LIMIT"""
+        scan = re.fullmatch(r'SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?', step)
+        order = re.search(r'\bORDER BY (?:\w+\.)?(\w+)', statement)
+        if not scan or not order or not re.search(r'\bLIMIT\b', statement) or re.search(r'\bWHERE\b', statement):
+            return False
+        if scan.group(2) is None:
+            # A plain table scan runs in rowid order, which is the integer primary key
+            return order.group(1) == 'id'
+        columns = [row[2] for row in db.session.execute(db.text(f'PRAGMA index_info({scan.group(2)})'))]
+        return columns[:1] == [order.group(1)]
+
+    def test_hot_queries_use_indexes(self):
+        for role, route in HOT_ROUTES:
+            url = route.format(**self.params)
+            with self.subTest(role=role, url=url):
+                self.client.get('/logout')
+                login(self.client, 'farmer' if role == 'farmer' else f'test_{role}')
+                with capture_queries() as statements:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+
+                for statement, parameters in statements:
+                    plan = self.explain(statement, parameters)
+                    for step in plan:
+                        scan = re.match(r'SCAN (\w+)', step)
+                        if (scan and scan.group(1) in LARGE_TABLES and not self.ordered_scan(step, statement)
+                                and (role, route) not in ALLOWED_SCANS):
+                            self.fail(f'full scan of {scan.group(1)}: {statement}\n{plan}')
+                        if 'TEMP B-TREE' in step and (role, route) not in ALLOWED_SORTS:
+                            self.fail(f'temp b-tree sort: {statement}\n{plan}')
+
+if __name__ == '__main__':
+    unittest.main()
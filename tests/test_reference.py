@@ -0,0 +1,99 @@
+import importlib.util
+import re
+import unittest
+from app import create_app, db
+from app.models import ProductTracking, User
+from app.reference import users_by_id, warehouse_choices
+from app.tracking import record_tracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+def reads(statements, table):
+    """SELECTs reading from the given table"""
+    pattern = re.compile(rf'\bFROM "?{table}"?\b')
+    return [s for s, _ in statements if s.startswith('SELECT') and pattern.search(s)]
+
+class TestReferenceCache(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        self.manager = create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1000.0)
+        self.store = create_warehouse('Cold Store', type='warehouse', capacity=1000.0)
+        self.product = create_products(self.farmer, 1)[0]
+        for status, quantity in (('received', 100.0), ('processing', 95.0)):
+            record_tracking(self.product.id, self.plant.id, status, quantity, processed_by=self.manager.id)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def get(self, url):
+        self.client.get(url)
+        with capture_queries() as statements:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return statements
+
+    def test_repeated_requests_read_no_users_or_warehouses(self):
+        login(self.client, 'manager')
+        for url in (f'/product/{self.product.id}/track', f'/product/{self.product.id}', '/dashboard'):
+            statements = self.get(url)
+            self.assertEqual(reads(statements, 'user'), [], url)
+        self.assertEqual(reads(self.get(f'/product/{self.product.id}/track'), 'warehouse'), [])
+
+    def test_tracking_post_reads_warehouses_from_the_cache(self):
+        login(self.client, 'manager')
+        url = f'/product/{self.product.id}/track'
+        data = {'warehouse_id': self.store.id, 'status': 'stored', 'quantity': 90.0}
+        self.get(url)
+        with capture_queries() as statements:
+            response = self.client.post(url, data=data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(reads(statements, 'warehouse'), [])
+        self.assertEqual(ProductTracking.query.filter_by(status='stored').count(), 1)
+
+    def test_new_warehouse_is_offered_at_once(self):
+        login(self.client, 'manager')
+        self.get(f'/product/{self.product.id}/track')
+        self.client.post('/warehouse/new', data={'name': 'North Store', 'type': 'warehouse',
+                                                 'location': 'North', 'capacity': 500.0})
+        page = self.client.get(f'/product/{self.product.id}/track').get_data(as_text=True)
+        self.assertIn('North Store (warehouse)', page)
+
+    @unittest.skipUnless(importlib.util.find_spec('email_validator'), 'the registration form needs email_validator')
+    def test_registering_invalidates_cached_users(self):
+        version = self.app.extensions['reference'].stats()['versions']['users']
+        self.client.post('/register', data={'username': 'newfarmer', 'email': 'new@test.com', 'password': 'secret1',
+                                            'confirm_password': 'secret1', 'role': 'farmer',
+                                            'farm_location': 'Hill Farm'})
+        self.assertIsNotNone(User.query.filter_by(username='newfarmer').first())
+        self.assertEqual(self.app.extensions['reference'].stats()['versions']['users'], version + 1)
+
+    def test_users_are_attached_to_the_session_without_queries(self):
+        farmer_id, manager_id, product_id = self.farmer.id, self.manager.id, self.product.id
+        # Fresh sessions, as at the start of a request
+        db.session.remove()
+        users_by_id([farmer_id, manager_id])
+        db.session.remove()
+        with capture_queries() as statements:
+            users = users_by_id([farmer_id, manager_id, None])
+            tracking = ProductTracking.query.filter_by(product_id=product_id).first()
+            self.assertEqual((tracking.product.farmer.username, tracking.processor.username), ('farmer', 'manager'))
+        self.assertEqual(reads(statements, 'user'), [])
+        self.assertIs(users[farmer_id], db.session.get(User, farmer_id))
+        self.assertEqual(len(warehouse_choices()), 2)
+
+    def test_unflushed_changes_in_the_session_win(self):
+        users_by_id([self.farmer.id])
+        farmer = db.session.get(User, self.farmer.id)
+        farmer.farm_location = 'Valley Farm'
+        self.assertIs(users_by_id([self.farmer.id])[self.farmer.id], farmer)
+        self.assertEqual(farmer.farm_location, 'Valley Farm')
+
+if __name__ == '__main__':
+    unittest.main()
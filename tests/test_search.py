@@ -0,0 +1,144 @@
+import unittest
+from datetime import datetime
+from sqlalchemy import text
+from app import create_app, db
+from app.generator import generate_data
+from app.models import Product, ProductTracking, ProductState
+from app.search import deferred_search_index, match_expression, search
+from app.tracking import record_tracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+class TestMatchExpression(unittest.TestCase):
+    def test_words_are_quoted_and_last_is_a_prefix(self):
+        self.assertEqual(match_expression('Soft spots'), '"soft" "spots"*')
+        self.assertEqual(match_expression('bruised AND "NEAR(x'), '"bruised" "and" "near" "x"*')
+        self.assertIsNone(match_expression(' -*" '))
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        self.other = create_user('other', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+        self.tomato = create_products(self.farmer, 1, variety='Roma')[0]
+        self.pepper = create_products(self.other, 1, product_type='pepper', variety='Bell')[0]
+        record_tracking(self.tomato.id, self.plant.id, 'received', 100.0, quality_notes='Slightly bruised on arrival')
+        record_tracking(self.tomato.id, self.plant.id, 'processing', 95.0, quality_notes='Washed, bruising removed')
+        record_tracking(self.pepper.id, self.plant.id, 'rejected', 50.0,
+                        quality_notes='Soft spots <b>everywhere</b>, bruised')
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_notes_match_stemmed_words_with_highlights(self):
+        results = search('bruise', 10)
+        self.assertEqual(len(results), 3)
+        self.assertEqual({r['kind'] for r in results}, {'tracking'})
+        pepper = next(r for r in results if r['product_id'] == self.pepper.id)
+        self.assertEqual(pepper['status'], 'rejected')
+        self.assertEqual(pepper['warehouse'], 'Test Plant')
+        self.assertIn('&lt;b&gt;everywhere&lt;/b&gt;', pepper['snippet'])
+        self.assertIn('<mark>bruised</mark>', pepper['snippet'])
+
+    def test_products_match_type_and_variety(self):
+        results = search('rom', 10)
+        self.assertEqual([(r['kind'], r['product_id']) for r in results], [('product', self.tomato.id)])
+        self.assertEqual(search('pepper', 10)[0]['current_status'], 'rejected')
+
+    def test_every_word_must_match(self):
+        results = search('soft bruised', 10)
+        self.assertEqual([r['product_id'] for r in results], [self.pepper.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        tracking = ProductTracking.query.filter_by(status='rejected').one()
+        tracking.quality_notes = 'Mouldy stalks'
+        db.session.commit()
+        self.assertEqual(search('soft', 10), [])
+        self.assertEqual(len(search('mouldy', 10)), 1)
+
+        db.session.delete(ProductTracking.query.filter_by(status='processing').one())
+        for model, column in ((ProductTracking, ProductTracking.product_id),
+                              (ProductState, ProductState.product_id), (Product, Product.id)):
+            db.session.execute(db.delete(model).where(column == self.pepper.id))
+        db.session.commit()
+        self.assertEqual(search('washed', 10), [])
+        self.assertEqual(search('bell', 10), [])
+        self.assertEqual(search('mouldy', 10), [])
+
+    def test_api_pages_results_and_scopes_farmers(self):
+        login(self.client, 'manager')
+        first = self.client.get('/api/search?q=bruised&per_page=2').get_json()
+        self.assertEqual(len(first['results']), 2)
+        self.assertEqual(first['next_page'], 2)
+        second = self.client.get('/api/search?q=bruised&per_page=2&page=2').get_json()
+        self.assertEqual(len(second['results']), 1)
+        self.assertIsNone(second['next_page'])
+        ids = {r['tracking_id'] for r in first['results'] + second['results']}
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(self.client.get('/api/search?q=').status_code, 400)
+
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        results = self.client.get('/api/search?q=bruised').get_json()['results']
+        self.assertEqual({r['product_id'] for r in results}, {self.tomato.id})
+
+    def test_search_page(self):
+        login(self.client, 'manager')
+        with capture_queries() as statements:
+            response = self.client.get('/products/search?q=soft+spots')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<mark>Soft</mark> <mark>spots</mark>', response.data)
+        self.assertIn(f'/product/{self.pepper.id}'.encode(), response.data)
+        self.assertLessEqual(len([s for s, _ in statements if 'search' in s or 'product' in s]), 4)
+
+    def test_rebuild_command_restores_a_dropped_index(self):
+        db.session.execute(text('DROP TABLE tracking_search'))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['rebuild-search-index'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('3 tracking events', result.output)
+        self.assertEqual(len(search('bruised', 10)), 3)
+        # The triggers came back too
+        record_tracking(self.pepper.id, self.plant.id, 'received', 10.0, quality_notes='Bruised again')
+        db.session.commit()
+        self.assertEqual(len(search('bruised', 10)), 4)
+
+    def test_failed_bulk_load_restores_the_triggers(self):
+        with self.assertRaises(RuntimeError), deferred_search_index():
+            # A bulk load that commits part of its work and then fails
+            db.session.commit()
+            raise RuntimeError('disk full')
+        db.session.commit()
+        record_tracking(self.pepper.id, self.plant.id, 'received', 10.0, quality_notes='Bruised again')
+        db.session.commit()
+        self.assertEqual(len(search('bruised', 10)), 4)
+
+class TestGeneratedIndex(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_bulk_load_is_indexed_and_keeps_triggers(self):
+        generate_data(farmers=5, plants=1, stores=2, products=200, end=datetime(2024, 6, 1))
+        indexed = db.session.scalar(text("SELECT count(*) FROM tracking_search WHERE tracking_search MATCH 'bruising'"))
+        stored = ProductTracking.query.filter(ProductTracking.quality_notes.like('%bruising%')).count()
+        self.assertGreater(stored, 0)
+        self.assertEqual(indexed, stored)
+        triggers = db.session.scalar(text("SELECT count(*) FROM sqlite_master WHERE type = 'trigger'"))
+        self.assertEqual(triggers, 9)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from app import create_app, db, init_test_data
+from app.models import User, Warehouse, Product, ProductTracking, ProductState
+from app.tracking import check_product_state, record_tracking
+from tests.helpers import TestConfig, login, capture_queries
+
+class SeededConfig(TestConfig):
+    SEED_TEST_DATA = True
+
+class TestSeedData(unittest.TestCase):
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def start(self, config):
+        self.app = create_app(config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def test_not_seeded_by_default(self):
+        self.start(TestConfig)
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(Warehouse.query.count(), 0)
+
+    def test_seed_loads_consistent_sample_data(self):
+        self.start(SeededConfig)
+        self.assertEqual(User.query.count(), 4)
+        self.assertEqual(Warehouse.query.count(), 3)
+        self.assertEqual(Product.query.count(), 5)
+        self.assertEqual(ProductTracking.query.count(), 8)
+        self.assertEqual(ProductState.query.count(), 5)
+        self.assertEqual(check_product_state(), [])
+        self.assertEqual(len({p.unique_hash for p in Product.query}), 5)
+
+        response = login(self.app.test_client(), 'plant_manager', 'password123')
+        self.assertEqual(response.status_code, 302)
+
+    def test_seeded_warehouses_take_more_stock(self):
+        self.start(SeededConfig)
+        for warehouse in Warehouse.query:
+            self.assertLess(warehouse.current_stock, warehouse.capacity, warehouse.name)
+        plant = Warehouse.query.filter_by(name='Main Processing Plant').one()
+        product = Product.query.filter_by(product_type='carrot').first()
+        record_tracking(product.id, plant.id, 'processing', 190.0)
+        db.session.commit()
+        self.assertEqual(db.session.get(Warehouse, plant.id).current_stock, 1970.0)
+
+    def test_seed_is_idempotent_and_bulk(self):
+        self.start(TestConfig)
+        with capture_queries() as statements:
+            self.assertTrue(init_test_data())
+        # One statement per table rather than per row, whatever the number of samples
+        inserts = [s for s, _ in statements if s.startswith('INSERT')]
+        self.assertLessEqual(len(inserts), 8)
+        self.assertFalse(init_test_data())
+        self.assertEqual(User.query.count(), 4)
+
+    def test_cli_command(self):
+        self.start(TestConfig)
+        result = self.app.test_cli_runner().invoke(args=['seed-test-data'])
+        self.assertIn('Sample data loaded.', result.output)
+        result = self.app.test_cli_runner().invoke(args=['seed-test-data'])
+        self.assertIn('Sample data already present.', result.output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.models import ApiToken, ProductTracking
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+class TestApiTokens(unittest.TestCase):
+    # Requests run in their own app contexts, so flask-login resolves the user afresh each time
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        with self.app.app_context():
+            farmer = create_user('farmer', 'farmer')
+            self.manager_id = create_user('manager', 'plant_manager').id
+            self.plant_id = create_warehouse(capacity=1000.0).id
+            self.product_id = create_products(farmer, 1)[0].id
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def issue(self, username, name='scanner 1'):
+        client = self.app.test_client()
+        login(client, username)
+        response = client.post('/api/tokens', json={'name': name})
+        self.assertEqual(response.status_code, 201)
+        return response.get_json()
+
+    def post_batch(self, token, quantity=10.0):
+        return self.app.test_client().post('/api/trackings/batch', headers={'Authorization': f'Bearer {token}'},
+                                           json={'events': [dict(product_id=self.product_id, warehouse_id=self.plant_id,
+                                                                 status='received', quantity=quantity)]})
+
+    def test_issued_token_is_stored_only_as_a_digest(self):
+        issued = self.issue('manager')
+        self.assertTrue(issued['token'].startswith(issued['prefix']))
+        self.assertEqual(issued['role'], 'plant_manager')
+        with self.app.app_context():
+            api_token = db.session.get(ApiToken, issued['id'])
+            self.assertNotIn(issued['token'], (api_token.token_hash, api_token.prefix, api_token.name))
+            self.assertEqual(len(api_token.token_hash), 64)
+
+    def test_token_authenticates_json_routes_without_a_session(self):
+        token = self.issue('manager')['token']
+        response = self.post_batch(token)
+        self.assertEqual(response.get_json()['created'], 1)
+        self.assertNotIn('Set-Cookie', response.headers)
+        with self.app.app_context():
+            self.assertEqual(ProductTracking.query.one().processed_by, self.manager_id)
+
+    def test_repeated_calls_verify_from_the_cache(self):
+        token = self.issue('manager')['token']
+        self.post_batch(token)
+        with self.app.app_context(), capture_queries() as statements:
+            self.assertEqual(self.post_batch(token).status_code, 200)
+        self.assertFalse([s for s, _ in statements if re.search(r'\bFROM (api_token|"?user"?)\b', s)])
+
+    def test_revoked_and_unknown_tokens_are_refused(self):
+        issued = self.issue('manager')
+        self.assertEqual(self.post_batch(issued['token']).status_code, 200)
+        client = self.app.test_client()
+        login(client, 'manager')
+        self.assertIsNotNone(client.delete(f"/api/tokens/{issued['id']}").get_json()['revoked_at'])
+        self.assertEqual(self.post_batch(issued['token']).status_code, 401)
+        self.assertEqual(self.post_batch(issued['token'][:-2] + 'xx').status_code, 401)
+        self.assertEqual(self.post_batch('').status_code, 401)
+
+    def test_token_carries_its_users_role_and_only_covers_the_api(self):
+        farmer_token = self.issue('farmer')['token']
+        self.assertEqual(self.post_batch(farmer_token).status_code, 403)
+        headers = {'Authorization': f"Bearer {self.issue('manager')['token']}"}
+        client = self.app.test_client()
+        self.assertEqual(client.get('/dashboard', headers=headers).status_code, 302)
+        self.assertEqual(client.post('/api/tokens', headers=headers, json={'name': 'more'}).status_code, 403)
+        self.assertEqual(len(client.get('/api/tokens', headers=headers).get_json()['tokens']), 1)
+
+    def test_cli_issues_and_revokes_tokens(self):
+        runner = self.app.test_cli_runner()
+        output = runner.invoke(args=['issue-token', 'manager', '--name', 'dock scanner']).output
+        token = output.splitlines()[-1]
+        self.assertEqual(self.post_batch(token).status_code, 200)
+        with self.app.app_context():
+            token_id = ApiToken.query.filter_by(name='dock scanner').one().id
+        self.assertIn('Revoked', runner.invoke(args=['revoke-token', str(token_id)]).output)
+        self.assertEqual(self.post_batch(token).status_code, 401)
+
+class TestRevocationAcrossWorkers(unittest.TestCase):
+    # Two app instances on one database file stand in for two worker processes
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = type('Config', (TestConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.directory, 'tokens.db')})
+        self.admin, self.worker = create_app(config), create_app(config)
+        with self.worker.app_context():
+            create_user('manager', 'plant_manager')
+        self.now = 0.0
+        self.worker.extensions['api_token_revocations'].clock = lambda: self.now
+
+    def tearDown(self):
+        with self.admin.app_context():
+            db.drop_all()
+        for app in (self.admin, self.worker):
+            with app.app_context():
+                db.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def get_tokens(self, token):
+        return self.worker.test_client().get('/api/tokens', headers={'Authorization': f'Bearer {token}'})
+
+    def test_token_revoked_elsewhere_is_refused_after_the_next_check(self):
+        runner = self.admin.test_cli_runner()
+        token = runner.invoke(args=['issue-token', 'manager', '--name', 'dock scanner']).output.splitlines()[-1]
+        self.assertEqual(self.get_tokens(token).status_code, 200)
+        with self.admin.app_context():
+            token_id = ApiToken.query.one().id
+        self.assertIn('Revoked', runner.invoke(args=['revoke-token', str(token_id)]).output)
+        # Still served from the worker's cache until its next check
+        self.now += 0.5
+        self.assertEqual(self.get_tokens(token).status_code, 200)
+        self.now += 0.5
+        self.assertEqual(self.get_tokens(token).status_code, 401)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+from app import create_app, db
+from app.models import Product, trace_hash
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+class TestProductHash(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_identical_products_get_distinct_hashes(self):
+        products = [Product(farmer_id=self.farmer.id, product_type='tomato', quantity=100.0,
+                            quality_grade='A') for _ in range(50)]
+        for product in products:
+            product.generate_hash()
+        db.session.commit()
+        hashes = {product.unique_hash for product in products}
+        self.assertEqual(len(hashes), 50)
+        self.assertTrue(all(len(h) == 64 for h in hashes))
+        self.assertTrue(all(product.created_at is not None for product in products))
+
+    def test_hash_is_derived_from_the_id(self):
+        product = Product(farmer_id=self.farmer.id, product_type='tomato', quantity=100.0, quality_grade='A')
+        product.generate_hash()
+        db.session.commit()
+        self.assertEqual(product.unique_hash, trace_hash(product.id))
+        product.generate_hash()
+        self.assertEqual(product.unique_hash, trace_hash(product.id))
+        self.app.config['TRACE_HASH_KEY'] = 'another-key'
+        self.assertNotEqual(trace_hash(product.id), product.unique_hash)
+
+class TestTraceEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer', farm_location='Green Valley')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+        self.store = create_warehouse('Test Store', 'warehouse', 1e6)
+        self.product = create_products(self.farmer, 1, variety='Roma')[0]
+        self.url = f'/trace/{self.product.unique_hash}'
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def track(self, warehouse, status, quantity):
+        return self.client.post(f'/product/{self.product.id}/track', data={
+            'warehouse_id': warehouse.id, 'status': status, 'quantity': quantity})
+
+    def test_json_trace_lists_the_chain_in_order(self):
+        login(self.client, 'manager')
+        self.track(self.plant, 'received', 100.0)
+        self.track(self.plant, 'processing', 96.0)
+        self.track(self.store, 'stored', 95.0)
+        self.client.get('/logout')
+
+        response = self.client.get(self.url + '?format=json')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['farmer'], {'name': 'farmer', 'farm_location': 'Green Valley'})
+        self.assertEqual(data['product']['variety'], 'Roma')
+        self.assertEqual([step['status'] for step in data['chain']], ['received', 'processing', 'stored'])
+        self.assertEqual(data['chain'][-1]['warehouse'], 'Test Store')
+        self.assertEqual(data['current_status'], 'stored')
+
+        accept = self.client.get(self.url, headers={'Accept': 'application/json'})
+        self.assertEqual(accept.get_json(), data)
+
+    def test_html_trace_is_public(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Green Valley', response.data)
+        self.assertIn(b'not entered the supply chain', response.data)
+        self.assertIn('public', response.headers['Cache-Control'])
+        self.assertIn('Accept', response.headers['Vary'])
+        self.assertNotIn(b'Logout', response.data)
+
+    def test_unknown_or_malformed_hash_is_404(self):
+        self.assertEqual(self.client.get('/trace/' + 'f' * 64).status_code, 404)
+        self.assertEqual(self.client.get('/trace/not-a-hash').status_code, 404)
+        response = self.client.get('/trace/' + 'f' * 64 + '?format=json')
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('error', response.get_json())
+
+    def test_matching_etag_returns_not_modified(self):
+        first = self.client.get(self.url)
+        etag = first.headers['ETag']
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        json_response = self.client.get(self.url + '?format=json')
+        self.assertNotEqual(json_response.headers['ETag'], etag)
+
+    def test_repeat_lookups_are_cached_until_tracked(self):
+        etag = self.client.get(self.url).headers['ETag']
+        with capture_queries() as statements:
+            self.client.get(self.url)
+        self.assertEqual(statements, [])
+
+        login(self.client, 'manager')
+        self.track(self.plant, 'received', 100.0)
+        self.client.get('/logout')
+        with capture_queries() as statements:
+            response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([s for s, _ in statements if 'product_tracking' in s]), 1)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(b'Test Plant', response.data)
+
+    def test_product_page_links_to_trace(self):
+        login(self.client, 'manager')
+        response = self.client.get(f'/product/{self.product.id}')
+        self.assertIn(self.url.encode(), response.data)
+
+if __name__ == '__main__':
+    unittest.main()
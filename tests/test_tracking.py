@@ -0,0 +1,227 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import ProductTracking, ProductState, TrackingRollup, Warehouse
+from app.tracking import (record_tracking, record_trackings, rebuild_product_state, check_product_state,
+                          rebuild_rollups, StockError)
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login
+
+class TestProductState(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        self.manager = create_user('manager', 'plant_manager')
+        self.plant = create_warehouse()
+        self.store = create_warehouse('Test Store', 'warehouse', 5000.0)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_track_route_updates_state(self):
+        product = create_products(self.farmer, 1)[0]
+        login(self.client, 'manager')
+        for warehouse, status in ((self.plant, 'processing'), (self.store, 'stored')):
+            response = self.client.post(f'/product/{product.id}/track', data={
+                'warehouse_id': warehouse.id, 'status': status, 'quantity': '90'})
+            self.assertEqual(response.status_code, 302)
+
+        state = db.session.get(ProductState, product.id)
+        self.assertEqual(state.status, 'stored')
+        self.assertEqual(state.warehouse_id, self.store.id)
+        self.assertEqual(state.quantity, 90.0)
+        self.assertEqual(check_product_state(), [])
+
+    def test_out_of_order_event_does_not_regress_state(self):
+        product = create_products(self.farmer, 1)[0]
+        record_tracking(product.id, self.store.id, 'stored', 90.0)
+        record_tracking(product.id, self.plant.id, 'received', 100.0,
+                        transition_date=datetime.utcnow() - timedelta(days=1))
+        db.session.commit()
+        self.assertEqual(db.session.get(ProductState, product.id).status, 'stored')
+
+    def test_checker_and_rebuild(self):
+        first, second = create_products(self.farmer, 2)
+        record_tracking(first.id, self.plant.id, 'received', 100.0)
+        # Written behind the write path's back, leaving the state stale and missing
+        db.session.add_all([
+            ProductTracking(product_id=first.id, warehouse_id=self.plant.id, status='processing', quantity=95.0,
+                            transition_date=datetime.utcnow() + timedelta(minutes=1)),
+            ProductTracking(product_id=second.id, warehouse_id=self.plant.id, status='received', quantity=100.0),
+        ])
+        db.session.commit()
+
+        problems = dict(check_product_state())
+        self.assertIn('stale', problems[first.id])
+        self.assertEqual(problems[second.id], 'missing state row')
+
+        self.assertEqual(rebuild_product_state(), db.session.scalar(
+            db.select(db.func.count(db.distinct(ProductTracking.product_id)))))
+        db.session.commit()
+        self.assertEqual(check_product_state(), [])
+        self.assertEqual(db.session.get(ProductState, first.id).status, 'processing')
+
+    def test_cli_commands(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['rebuild-product-state'])
+        self.assertIn('Rebuilt state', result.output)
+        result = runner.invoke(args=['check-product-state'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('consistent', result.output)
+
+class TestStockUpdates(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        self.manager = create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=150.0)
+        self.product = create_products(self.farmer, 1)[0]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_stock_follows_status(self):
+        record_tracking(self.product.id, self.plant.id, 'received', 100.0)
+        record_tracking(self.product.id, self.plant.id, 'processing', 100.0)
+        record_tracking(self.product.id, self.plant.id, 'shipped', 40.0)
+        db.session.commit()
+        self.assertEqual(db.session.get(Warehouse, self.plant.id).current_stock, 60.0)
+
+    def test_capacity_is_enforced(self):
+        record_tracking(self.product.id, self.plant.id, 'stored', 100.0)
+        with self.assertRaises(StockError):
+            record_tracking(self.product.id, self.plant.id, 'stored', 60.0)
+        db.session.rollback()
+        self.assertEqual(db.session.get(Warehouse, self.plant.id).current_stock, 0.0)
+
+    def test_stock_cannot_go_negative(self):
+        with self.assertRaises(StockError):
+            record_tracking(self.product.id, self.plant.id, 'shipped', 1.0)
+
+    def test_route_rejects_overfill_without_writing(self):
+        login(self.client, 'manager')
+        response = self.client.post(f'/product/{self.product.id}/track', data={
+            'warehouse_id': self.plant.id, 'status': 'stored', 'quantity': '200'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'cannot take', response.data)
+        self.assertEqual(ProductTracking.query.filter_by(product_id=self.product.id).count(), 0)
+        self.assertEqual(db.session.get(Warehouse, self.plant.id).current_stock, 0.0)
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        self.plant = create_warehouse(capacity=1e6)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def snapshot(self):
+        return {(r.granularity, r.warehouse_id, r.bucket_start, r.status, r.product_type): (r.quantity, r.events)
+                for r in TrackingRollup.query.filter_by(warehouse_id=self.plant.id)}
+
+    def test_writes_fill_hourly_and_daily_buckets(self):
+        tomato = create_products(self.farmer, 1)[0]
+        potato = create_products(self.farmer, 1, product_type='potato')[0]
+        morning = datetime(2024, 5, 1, 8, 15)
+        record_tracking(tomato.id, self.plant.id, 'received', 100.0, transition_date=morning)
+        record_trackings([
+            dict(product_id=tomato.id, warehouse_id=self.plant.id, status='received', quantity=50.0,
+                 transition_date=morning + timedelta(minutes=30)),
+            dict(product_id=tomato.id, warehouse_id=self.plant.id, status='received', quantity=25.0,
+                 transition_date=morning + timedelta(hours=2)),
+            dict(product_id=potato.id, warehouse_id=self.plant.id, status='processing', quantity=80.0,
+                 transition_date=morning),
+        ])
+        db.session.commit()
+
+        rollups = self.snapshot()
+        self.assertEqual(rollups[('hour', self.plant.id, datetime(2024, 5, 1, 8), 'received', 'tomato')], (150.0, 2))
+        self.assertEqual(rollups[('hour', self.plant.id, datetime(2024, 5, 1, 10), 'received', 'tomato')], (25.0, 1))
+        self.assertEqual(rollups[('day', self.plant.id, datetime(2024, 5, 1), 'received', 'tomato')], (175.0, 3))
+        self.assertEqual(rollups[('day', self.plant.id, datetime(2024, 5, 1), 'processing', 'potato')], (80.0, 1))
+
+    def test_rebuild_matches_incremental_maintenance(self):
+        products = create_products(self.farmer, 5)
+        start = datetime(2024, 5, 1)
+        for i, product in enumerate(products):
+            for hours, status in ((i, 'received'), (i + 3, 'processing'), (i + 30, 'stored')):
+                record_tracking(product.id, self.plant.id, status, 10.0 * (i + 1),
+                                transition_date=start + timedelta(hours=hours, minutes=7 * i))
+        db.session.commit()
+        incremental = self.snapshot()
+
+        rebuild_rollups()
+        db.session.commit()
+        self.assertEqual(self.snapshot(), incremental)
+
+class TestConcurrentStockUpdates(unittest.TestCase):
+    THREADS = 8
+    EVENTS_PER_THREAD = 25
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = type('FileConfig', (TestConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.tmpdir, 'stress.db'),
+            'SQLALCHEMY_ENGINE_OPTIONS': {'connect_args': {'timeout': 30}},
+        })
+        self.app = create_app(config)
+        with self.app.app_context():
+            farmer = create_user('farmer', 'farmer')
+            self.warehouse_id = create_warehouse(capacity=1e6).id
+            self.product_id = create_products(farmer, 1)[0].id
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_no_lost_updates(self):
+        errors = []
+
+        def scanner():
+            with self.app.app_context():
+                try:
+                    for _ in range(self.EVENTS_PER_THREAD):
+                        record_tracking(self.product_id, self.warehouse_id, 'stored', 2.0)
+                        db.session.commit()
+                        record_tracking(self.product_id, self.warehouse_id, 'shipped', 1.0)
+                        db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=scanner) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Warehouse, self.warehouse_id).current_stock,
+                             self.THREADS * self.EVENTS_PER_THREAD)
+            self.assertEqual(ProductTracking.query.filter_by(product_id=self.product_id).count(),
+                             self.THREADS * self.EVENTS_PER_THREAD * 2)
+
+if __name__ == '__main__':
+    unittest.main()
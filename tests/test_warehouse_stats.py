@@ -0,0 +1,91 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.archive import archive_finished_chains
+from app.tracking import record_tracking
+from app.warehouse.stats import warehouse_stats
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+NOW = datetime(2024, 6, 1, 12)
+
+class TestWarehouseStats(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1000.0)
+        self.store = create_warehouse('Test Store', 'warehouse', 5000.0)
+        self.empty = create_warehouse('Empty Store', 'warehouse', 0.0)
+        old, washed, stored, fresh = create_products(farmer, 4)
+        self.track(old, self.plant, 'processing', 100.0, days=40)
+        self.track(old, self.store, 'stored', 100.0, days=39)
+        self.track(old, self.store, 'shipped', 100.0, days=38)
+        self.track(washed, self.plant, 'received', 80.0, hours=30)
+        self.track(washed, self.plant, 'processing', 80.0, hours=20)
+        self.track(stored, self.plant, 'processing', 60.0, hours=10)
+        self.track(stored, self.store, 'stored', 60.0, hours=5)
+        self.track(stored, self.store, 'shipped', 25.0, hours=2)
+        self.track(fresh, self.plant, 'received', 40.0, hours=1)
+        db.session.commit()
+        self.ids = (self.plant.id, self.store.id, self.empty.id)
+        self.fresh_id = fresh.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def track(self, product, warehouse, status, quantity, **age):
+        record_tracking(product.id, warehouse.id, status, quantity, transition_date=NOW - timedelta(**age))
+
+    def stats(self):
+        return {stats['name']: stats for stats in warehouse_stats(now=NOW)}
+
+    def test_occupancy_movement_and_last_activity(self):
+        plant, store, empty = (self.stats()[name] for name in ('Test Plant', 'Test Store', 'Empty Store'))
+        self.assertEqual(plant['products'], dict(received=1, processing=1, stored=0))
+        self.assertEqual((plant['inbound_24h'], plant['outbound_24h']), (140.0, 0.0))
+        self.assertEqual(plant['last_activity'], NOW - timedelta(hours=1))
+        self.assertEqual(plant['utilization'], round(plant['current_stock'] / 10, 1))
+        # The shipped product is no longer on hand; only the last day's movement counts
+        self.assertEqual(store['products'], dict(received=0, processing=0, stored=0))
+        self.assertEqual((store['inbound_24h'], store['outbound_24h']), (60.0, 25.0))
+        self.assertEqual(empty['products'], dict(received=0, processing=0, stored=0))
+        self.assertEqual((empty['utilization'], empty['last_activity']), (0.0, None))
+
+    def test_archived_history_still_counts(self):
+        before = self.stats()
+        self.assertEqual(archive_finished_chains(30, now=NOW), (1, 3))
+        self.assertEqual(self.stats(), before)
+
+    def test_one_statement(self):
+        with capture_queries() as statements:
+            warehouse_stats(now=NOW)
+        self.assertEqual(len(statements), 1)
+
+    def test_list_and_json_are_cached_until_a_tracking_write(self):
+        login(self.client, 'manager')
+        response = self.client.get('/warehouses')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Last Activity', response.data)
+        first = self.client.get('/api/warehouses').get_json()['warehouses']
+        self.assertEqual([stats['id'] for stats in first], list(self.ids))
+        with capture_queries() as statements:
+            self.assertEqual(self.client.get('/api/warehouses').get_json()['warehouses'], first)
+        self.assertFalse([s for s, _ in statements if 'product_state' in s])
+
+        response = self.client.post('/api/trackings/batch', json={'events': [dict(
+            product_id=self.fresh_id, warehouse_id=self.empty.id, status='received', quantity=5.0)]})
+        self.assertEqual(response.status_code, 200)
+        empty = self.client.get('/api/warehouses').get_json()['warehouses'][2]
+        self.assertIsNotNone(empty['last_activity'])
+
+    def test_json_is_for_managers(self):
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get('/api/warehouses').status_code, 403)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+import fcntl
+import glob
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+from app import create_app, db
+from app.models import ProductState, ProductTracking, Warehouse
+from app.writebehind import QueueFullError, TrackingWriter
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_dir = os.path.join(self.directory, 'journal')
+        self.app = self.make_app()
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1000.0)
+        self.products = create_products(self.farmer, 2)
+        self.writer = self.app.extensions['write_behind']
+
+    def tearDown(self):
+        self.writer.close()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.directory)
+
+    def make_app(self, **overrides):
+        config = type('Config', (TestConfig,), dict(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.directory, 'test.db'),
+            TRACKING_WRITE_BEHIND=True, WRITE_BEHIND_JOURNAL_DIR=self.journal_dir,
+            WRITE_BEHIND_FSYNC=False, WRITE_BEHIND_QUEUE_SIZE=3,
+            **overrides))
+        return create_app(config)
+
+    def event(self, product, status, quantity, **kwargs):
+        return dict(product_id=product.id, warehouse_id=self.plant.id, status=status, quantity=quantity, **kwargs)
+
+    def history(self, product):
+        db.session.expire_all()
+        return [(t.status, t.quantity) for t in
+                ProductTracking.query.filter_by(product_id=product.id).order_by(ProductTracking.id)]
+
+    def journals(self):
+        return sorted(glob.glob(os.path.join(self.journal_dir, 'tracking-*.ndjson')))
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def pause_writer(self):
+        """Hold the writer inside its next batch until the returned event is set"""
+        release = threading.Event()
+        write_batch = TrackingWriter.write_batch
+
+        def blocked(writer, batch):
+            release.wait(5)
+            write_batch(writer, batch)
+
+        patcher = mock.patch.object(TrackingWriter, 'write_batch', blocked)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return release
+
+    def test_form_posts_are_queued_and_written_in_order_per_product(self):
+        login(self.client, 'manager')
+        steps = [('received', 100.0), ('processing', 95.0), ('stored', 90.0)]
+        for status, quantity in steps:
+            for product in self.products:
+                response = self.client.post(f'/product/{product.id}/track', data={
+                    'warehouse_id': self.plant.id, 'status': status, 'quantity': quantity})
+                self.assertEqual(response.status_code, 302)
+        self.assertTrue(self.writer.flush(5))
+        for product in self.products:
+            self.assertEqual(self.history(product), steps)
+            self.assertEqual(db.session.get(ProductState, product.id).status, 'stored')
+        self.assertEqual(db.session.get(Warehouse, self.plant.id).current_stock, 2 * (95.0 + 90.0))
+        self.assertEqual(os.path.getsize(self.writer.journal_path), 0)
+
+    def test_events_in_one_batch_are_group_committed(self):
+        release = self.pause_writer()
+        self.writer.submit(self.event(self.products[0], 'received', 100.0))
+        self.writer.submit(self.event(self.products[0], 'processing', 100.0))
+        self.writer.submit(self.event(self.products[1], 'processing', 100.0))
+        release.set()
+        self.assertTrue(self.writer.flush(5))
+        status = self.writer.status()
+        self.assertEqual((status['written'], status['depth']), (3, 0))
+        self.assertLessEqual(status['batches'], 2)
+        self.assertEqual(self.history(self.products[0]), [('received', 100.0), ('processing', 100.0)])
+
+    def test_full_queue_pushes_back(self):
+        self.writer.enqueue_timeout = 0.05
+        release = self.pause_writer()
+        for _ in range(3):
+            self.writer.submit(self.event(self.products[0], 'received', 10.0))
+        with self.assertRaises(QueueFullError):
+            self.writer.submit(self.event(self.products[0], 'received', 10.0))
+        login(self.client, 'manager')
+        response = self.client.post(f'/product/{self.products[0].id}/track', data={
+            'warehouse_id': self.plant.id, 'status': 'received', 'quantity': 10.0})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.client.get('/api/trackings/queue').get_json()['depth'], 3)
+        release.set()
+        self.assertTrue(self.writer.flush(5))
+        self.assertEqual(len(self.history(self.products[0])), 3)
+
+    def test_overfilling_event_only_rejects_itself(self):
+        release = self.pause_writer()
+        self.writer.submit(self.event(self.products[0], 'processing', 600.0))
+        self.writer.submit(self.event(self.products[1], 'processing', 900.0))
+        release.set()
+        self.assertTrue(self.writer.flush(5))
+        self.assertEqual(self.history(self.products[0]), [('processing', 600.0)])
+        self.assertEqual(self.history(self.products[1]), [])
+        self.assertEqual(self.writer.status()['rejected'], 1)
+
+    def test_close_writes_everything_queued_and_removes_the_journal(self):
+        release = self.pause_writer()
+        self.writer.submit(self.event(self.products[0], 'received', 100.0))
+        self.writer.submit(self.event(self.products[0], 'processing', 100.0))
+        journal = self.writer.journal_path
+        release.set()
+        self.writer.close()
+        self.assertEqual(len(self.history(self.products[0])), 2)
+        self.assertFalse(os.path.exists(journal))
+        with self.assertRaises(RuntimeError):
+            self.writer.submit(self.event(self.products[0], 'stored', 100.0))
+
+    def test_committed_journal_files_are_removed_while_events_are_waiting(self):
+        self.writer.batch_size = self.writer.segment_size = 1
+        gate = threading.Semaphore(0)
+        write_batch = TrackingWriter.write_batch
+
+        def gated(writer, batch):
+            gate.acquire(timeout=5)
+            write_batch(writer, batch)
+
+        with mock.patch.object(TrackingWriter, 'write_batch', gated):
+            keys = [self.writer.submit(self.event(self.products[0], 'received', 10.0)) for _ in range(3)]
+            self.assertEqual(len(self.journals()), 3)
+            gate.release()
+            self.wait_for(lambda: len(self.journals()) == 2)
+            # Only the events still waiting are left on disk
+            journaled = [json.loads(line)['idempotency_key'] for path in self.journals() for line in open(path)]
+            self.assertEqual(journaled, keys[1:])
+            gate.release()
+            gate.release()
+            self.assertTrue(self.writer.flush(5))
+        self.assertEqual(self.journals(), [self.writer.journal_path])
+        self.assertEqual(os.path.getsize(self.writer.journal_path), 0)
+        self.assertEqual(len(self.history(self.products[0])), 3)
+
+    def test_new_journal_files_are_locked_before_recovery_can_see_them(self):
+        self.writer.segment_size = 1
+        release = self.pause_writer()
+        visible, flock = [], fcntl.flock
+
+        def locking(file, operation):
+            visible.append(self.journals())
+            flock(file, operation)
+
+        with mock.patch('app.writebehind.fcntl.flock', locking):
+            self.writer.submit(self.event(self.products[0], 'received', 10.0))
+            first = self.writer.journal_path
+            self.writer.submit(self.event(self.products[0], 'received', 10.0))
+        release.set()
+        self.assertTrue(self.writer.flush(5))
+        # Each file was locked before it showed up as a journal
+        self.assertEqual(visible, [[], [first]])
+
+    def test_batch_that_keeps_failing_is_dead_lettered(self):
+        self.writer.batch_size = 1
+        self.writer.max_attempts = 2
+        write_batch = TrackingWriter.write_batch
+
+        def failing(writer, batch):
+            if batch[0]['product_id'] == self.products[0].id:
+                raise RuntimeError('database says no')
+            write_batch(writer, batch)
+
+        with mock.patch('app.writebehind.RETRY_DELAYS', (0,)), \
+                mock.patch.object(TrackingWriter, 'write_batch', failing), self.assertLogs('app.writebehind', 'ERROR'):
+            key = self.writer.submit(self.event(self.products[0], 'received', 10.0))
+            self.writer.submit(self.event(self.products[1], 'received', 10.0))
+            self.assertTrue(self.writer.flush(5))
+        self.assertEqual(self.history(self.products[0]), [])
+        self.assertEqual(self.history(self.products[1]), [('received', 10.0)])
+        with open(self.writer.dead_letter_path) as dead_letters:
+            self.assertEqual([json.loads(line)['idempotency_key'] for line in dead_letters], [key])
+        status = self.writer.status()
+        self.assertEqual((status['dead_lettered'], status['written']), (1, 1))
+        self.assertEqual(status['last_error'], 'RuntimeError: database says no')
+        self.assertEqual(os.path.getsize(self.writer.journal_path), 0)
+
+    def test_orphaned_journal_is_replayed_on_start(self):
+        product = self.products[0]
+        committed = self.event(product, 'received', 100.0, idempotency_key='wb-1',
+                               transition_date=datetime(2024, 6, 1, 8).isoformat())
+        self.writer.submit(dict(committed, transition_date=datetime(2024, 6, 1, 8)))
+        self.assertTrue(self.writer.flush(5))
+        lines = [json.dumps(committed)] + [json.dumps(self.event(
+            product, status, 90.0, idempotency_key=f'wb-{i}', transition_date=datetime(2024, 6, 1, 8 + i).isoformat()))
+            for i, status in ((2, 'processing'), (3, 'stored'))]
+        # A crashed process: the first event was committed, the rest were still queued
+        orphan = os.path.join(self.journal_dir, 'tracking-999999.ndjson')
+        with open(orphan, 'w') as f:
+            f.write('\n'.join(lines) + '\n{"product_id": ')
+
+        self.make_app()
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(self.history(product), [('received', 100.0), ('processing', 90.0), ('stored', 90.0)])
+        self.assertEqual(db.session.get(ProductState, product.id).status, 'stored')
+        # The live writer's own journal is left alone
+        self.assertTrue(os.path.exists(self.writer.journal_path))
+
+    def test_replay_retries_and_sets_aside_what_keeps_failing(self):
+        lines = [json.dumps(self.event(product, 'received', 50.0, idempotency_key=key,
+                                       transition_date=datetime(2024, 6, 1, 8).isoformat()))
+                 for product, key in ((self.products[1], 'wb-1'), (self.products[0], 'wb-poison'))]
+        orphan = os.path.join(self.journal_dir, 'tracking-999999.ndjson')
+        os.makedirs(self.journal_dir, exist_ok=True)
+        with open(orphan, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        write_batch, calls = TrackingWriter.write_batch, []
+
+        def flaky(writer, batch):
+            calls.append(batch[0]['idempotency_key'])
+            # The database is locked at first, and one event never goes in
+            if len(calls) == 1 or batch[0]['idempotency_key'] == 'wb-poison':
+                raise RuntimeError('database is locked')
+            write_batch(writer, batch)
+
+        with mock.patch('app.writebehind.RETRY_DELAYS', (0,)), \
+                mock.patch.object(TrackingWriter, 'write_batch', flaky), self.assertLogs('app.writebehind', 'ERROR'):
+            writer = self.make_app(WRITE_BEHIND_BATCH_SIZE=1, WRITE_BEHIND_MAX_ATTEMPTS=3).extensions['write_behind']
+        self.assertEqual(calls, ['wb-1', 'wb-1'] + ['wb-poison'] * 3)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(self.history(self.products[1]), [('received', 50.0)])
+        self.assertEqual(self.history(self.products[0]), [])
+        with open(writer.dead_letter_path) as dead_letters:
+            self.assertEqual([json.loads(line)['idempotency_key'] for line in dead_letters], ['wb-poison'])
+
+    def test_status_endpoint(self):
+        login(self.client, 'manager')
+        status = self.client.get('/api/trackings/queue').get_json()
+        self.assertEqual((status['enabled'], status['depth'], status['capacity']), (True, 0, 3))
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get('/api/trackings/queue').status_code, 403)
+
+class TestWriteBehindDisabled(unittest.TestCase):
+    def test_requests_write_synchronously_by_default(self):
+        app = create_app(TestConfig)
+        with app.app_context():
+            create_user('manager', 'plant_manager')
+            client = app.test_client()
+            login(client, 'manager')
+            self.assertEqual(client.get('/api/trackings/queue').get_json(), {'enabled': False})
+            db.session.remove()
+            db.drop_all()
+
+    def test_memory_database_is_refused(self):
+        config = type('Config', (TestConfig,), dict(TRACKING_WRITE_BEHIND=True))
+        with self.assertRaises(RuntimeError):
+            create_app(config)
+
+if __name__ == '__main__':
+    unittest.main()
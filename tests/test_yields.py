@@ -0,0 +1,120 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.dashboard.yields import yield_report
+from app.models import StageTransition
+from app.tracking import record_tracking, record_trackings, rebuild_stage_transitions
+from tests.helpers import TestConfig, create_user, create_warehouse, create_products, login, capture_queries
+
+START = datetime(2024, 6, 1, 8)
+
+class TestYieldReport(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.farmer = create_user('farmer', 'farmer')
+        create_user('manager', 'plant_manager')
+        self.plant = create_warehouse(capacity=1e6)
+        self.store = create_warehouse('Test Store', 'warehouse', 1e6)
+        self.tomatoes = create_products(self.farmer, 2)
+        self.pepper = create_products(self.farmer, 1, product_type='pepper')[0]
+        for product in self.tomatoes:
+            self.chain(product, [(self.plant, 'received', 100.0, 0), (self.plant, 'processing', 90.0, 6),
+                                 (self.store, 'stored', 81.0, 30)])
+        self.chain(self.pepper, [(self.plant, 'received', 50.0, 0), (self.plant, 'rejected', 50.0, 2)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def chain(self, product, steps):
+        for warehouse, status, quantity, hours in steps:
+            record_tracking(product.id, warehouse.id, status, quantity,
+                            transition_date=START + timedelta(hours=hours))
+
+    def snapshot(self):
+        return db.session.execute(db.select(StageTransition).order_by(StageTransition.tracking_id)).scalars().all()
+
+    def test_stage_yield_dwell_and_rejection_per_type(self):
+        groups = {group['key']: group for group in yield_report('product_type')}
+        tomato = groups['tomato']
+        self.assertEqual((tomato['products'], tomato['rejected'], tomato['rejection_rate']), (2, 0, 0.0))
+        self.assertEqual([(s['from_status'], s['to_status']) for s in tomato['stages']],
+                         [('received', 'processing'), ('processing', 'stored')])
+        received, processing = tomato['stages']
+        self.assertEqual((received['events'], received['input_kg'], received['output_kg']), (2, 200.0, 180.0))
+        self.assertEqual(received['yield_rate'], 0.9)
+        self.assertEqual(received['avg_dwell_hours'], 6.0)
+        self.assertEqual(processing['avg_dwell_hours'], 24.0)
+        self.assertEqual(tomato['loss_kg'], 38.0)
+        self.assertEqual(groups['pepper']['rejection_rate'], 1.0)
+
+    def test_stages_belong_to_the_warehouse_the_product_left(self):
+        groups = {group['label']: group for group in yield_report('warehouse')}
+        self.assertEqual(len(groups['Test Plant']['stages']), 3)
+        self.assertNotIn('Test Store', groups)
+        self.assertEqual(yield_report('farmer')[0]['label'], 'farmer')
+
+    def test_date_range(self):
+        groups = yield_report('product_type', start=START + timedelta(hours=12))
+        tomato = next(group for group in groups if group['key'] == 'tomato')
+        self.assertEqual([s['to_status'] for s in tomato['stages']], ['stored'])
+        self.assertEqual(yield_report('product_type', end=START), [])
+
+    def test_out_of_order_event_rederives_the_following_stage(self):
+        # A late scan of an earlier wash step splits received -> processing in two
+        record_tracking(self.tomatoes[0].id, self.plant.id, 'processing', 95.0,
+                        transition_date=START + timedelta(hours=3))
+        db.session.commit()
+        rows = [(t.from_status, t.to_status, t.input_quantity, t.output_quantity)
+                for t in StageTransition.query.filter_by(product_id=self.tomatoes[0].id)
+                .order_by(StageTransition.ended_at)]
+        self.assertEqual(rows, [(None, 'received', None, 100.0), ('received', 'processing', 100.0, 95.0),
+                                ('processing', 'processing', 95.0, 90.0), ('processing', 'stored', 90.0, 81.0)])
+
+    def test_incremental_matches_rebuild(self):
+        record_trackings([dict(product_id=product.id, warehouse_id=self.store.id, status='shipped', quantity=81.0,
+                               transition_date=START + timedelta(hours=48)) for product in self.tomatoes])
+        db.session.commit()
+        incremental = [(t.tracking_id, t.from_status, t.to_status, t.warehouse_id, t.dwell_seconds)
+                       for t in self.snapshot()]
+        self.assertEqual(rebuild_stage_transitions(), 10)
+        rebuilt = [(t.tracking_id, t.from_status, t.to_status, t.warehouse_id, t.dwell_seconds)
+                   for t in self.snapshot()]
+        self.assertEqual(incremental, rebuilt)
+
+    def test_json_endpoint_is_cached_until_tracked(self):
+        login(self.client, 'manager')
+        first = self.client.get('/api/yields?by=warehouse').get_json()
+        self.assertEqual(first['by'], 'warehouse')
+        with capture_queries() as statements:
+            self.assertEqual(self.client.get('/api/yields?by=warehouse').get_json(), first)
+        self.assertFalse([s for s, _ in statements if 'stage_transition' in s])
+
+        self.client.post(f'/product/{self.tomatoes[0].id}/track', data={
+            'warehouse_id': self.store.id, 'status': 'shipped', 'quantity': 81.0})
+        groups = self.client.get('/api/yields?by=warehouse').get_json()['groups']
+        self.assertIn('Test Store', [group['label'] for group in groups])
+
+    def test_json_endpoint_validation_and_access(self):
+        login(self.client, 'manager')
+        self.assertEqual(self.client.get('/api/yields?by=colour').status_code, 400)
+        self.assertEqual(self.client.get('/api/yields?start=yesterday').status_code, 400)
+        self.client.get('/logout')
+        login(self.client, 'farmer')
+        self.assertEqual(self.client.get('/api/yields').status_code, 403)
+
+    def test_report_page(self):
+        login(self.client, 'manager')
+        response = self.client.get('/reports/yield?by=product_type&days=all')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Received &rarr; Processing', response.data)
+        self.assertIn(b'90.0%', response.data)
+        self.assertIn(b'100.0% rejected', response.data)
+
+if __name__ == '__main__':
+    unittest.main()